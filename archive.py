@@ -0,0 +1,249 @@
+# Recording of fetched live feeds, and replay of recorded feeds through the GTFS engine.
+#
+# The recorder keeps each FeedMessage as fetched, gzipped and named after its feed timestamp, in a
+# directory per (local) day:  <directory>/2023-09-15/1694765519.pb.gz
+#
+# The replay driver feeds a recorded period back through the engine's parser, on a clock that runs
+# at 1x or faster, while query threads ask the engine for arrivals as of the replayed time. It reports
+# query latency (separately for queries that overlapped a parse), parse times and memory growth.
+import os
+import sys
+import gzip
+import time
+import random
+import logging
+import datetime
+import argparse
+import threading
+
+import gtfsr
+
+SUFFIX = ".pb.gz"
+
+
+class Recorder:
+    def __init__(self, directory: str, retention: datetime.timedelta = datetime.timedelta(days=7), compresslevel: int = 6):
+        self.directory = directory
+        self.retention = retention
+        self.compresslevel = compresslevel
+
+    def record(self, buf: bytes, timestamp: int = None):
+        """
+        Store a raw FeedMessage, and drop recordings older than the retention period. Returns the
+        path written, or None if a feed with the same timestamp was already recorded.
+        """
+        timestamp = timestamp or gtfsr.feed_timestamp(buf) or int(time.time())
+        day = datetime.datetime.fromtimestamp(timestamp).date().isoformat()
+        os.makedirs(os.path.join(self.directory, day), exist_ok=True)
+        path = os.path.join(self.directory, day, f"{timestamp}{SUFFIX}")
+        if os.path.exists(path):
+            # the feed hasn't been updated since the last poll
+            return None
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(gzip.compress(buf, compresslevel=self.compresslevel))
+        os.replace(tmp_path, path)
+        self.prune(timestamp - self.retention.total_seconds())
+        return path
+
+    def prune(self, before: float):
+        # remove recordings with timestamps before `before`, and any days left empty
+        for day in os.listdir(self.directory):
+            day_dir = os.path.join(self.directory, day)
+            if not os.path.isdir(day_dir):
+                continue
+            for timestamp, path in _day_recordings(day_dir):
+                if timestamp < before:
+                    os.remove(path)
+            if not os.listdir(day_dir):
+                os.rmdir(day_dir)
+
+
+def _day_recordings(day_dir: str):
+    # (timestamp, path) of each recording in a day's directory, in timestamp order
+    recordings = []
+    for name in os.listdir(day_dir):
+        if name.endswith(SUFFIX):
+            recordings.append((int(name[:-len(SUFFIX)]), os.path.join(day_dir, name)))
+    recordings.sort()
+    return recordings
+
+
+def iter_recordings(directory: str, start: int = None, end: int = None):
+    """
+    Yield (timestamp, path) for each recording in a directory with start <= timestamp < end,
+    in timestamp order.
+    """
+    days = sorted(day for day in os.listdir(directory) if os.path.isdir(os.path.join(directory, day)))
+    for day in days:
+        for timestamp, path in _day_recordings(os.path.join(directory, day)):
+            if (start is None or timestamp >= start) and (end is None or timestamp < end):
+                yield timestamp, path
+
+
+def iter_feeds(directory: str, start: int = None, end: int = None):
+    # yield (timestamp, raw FeedMessage) for each recording, decompressing one at a time
+    for timestamp, path in iter_recordings(directory, start, end):
+        with open(path, "rb") as f:
+            yield timestamp, gzip.decompress(f.read())
+
+
+class LatencyStats:
+    def __init__(self):
+        self.samples = []
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def summary(self) -> dict:
+        # count and latency percentiles in milliseconds
+        samples = sorted(self.samples)
+        if not samples:
+            return {'count': 0}
+        def percentile(p):
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 3)
+        return {
+            'count': len(samples),
+            'mean': round(sum(samples) / len(samples) * 1000, 3),
+            'p50': percentile(0.5),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'max': round(samples[-1] * 1000, 3),
+        }
+
+
+def _peak_rss_mb():
+    # peak resident set size of this process, where the platform reports it
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def replay(engine, feeds, speed: float = 1.0, queries_per_second: float = 10, stops: list = None,
+           minutes: int = 30, threads: int = 2) -> dict:
+    """
+    Replay (timestamp, raw FeedMessage) pairs through engine._parse_live_data, spaced as they were
+    recorded and sped up by `speed` (0 replays as fast as possible), while `threads` threads query
+    the arrivals at random `stops` as of the replayed time, at `queries_per_second` in total.
+    Returns statistics for the run.
+    """
+    stops = list(stops or engine.filter_stops or [])
+    if not stops:
+        raise ValueError("No stops to query")
+    feeds = iter(feeds)
+    first = next(feeds, None)
+    if first is None:
+        raise ValueError("No recorded feeds to replay")
+
+    parse_stats = LatencyStats()
+    query_stats = {'idle': LatencyStats(), 'during_parse': LatencyStats()}
+    parsing = threading.Event()
+    done = threading.Event()
+    stats_lock = threading.Lock()
+    # the replayed time, as a unix timestamp
+    clock = {'now': first[0]}
+    rss_before = _peak_rss_mb()
+
+    def query_load():
+        rng = random.Random()
+        interval = threads / queries_per_second if queries_per_second else 0
+        while not done.is_set():
+            now = datetime.datetime.fromtimestamp(clock['now'])
+            overlapped = parsing.is_set()
+            start = time.perf_counter()
+            engine.get_scheduled_arrivals(rng.choice(stops), now, datetime.timedelta(minutes=minutes))
+            elapsed = time.perf_counter() - start
+            overlapped = overlapped or parsing.is_set()
+            with stats_lock:
+                query_stats['during_parse' if overlapped else 'idle'].record(elapsed)
+            if interval:
+                done.wait(max(0, interval - elapsed))
+
+    workers = [threading.Thread(target=query_load, daemon=True) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+
+    wall_start = time.monotonic()
+    try:
+        for timestamp, buf in _chain(first, feeds):
+            if speed:
+                # wait until the replayed clock reaches the feed, ticking the clock for the queries
+                while True:
+                    replayed = first[0] + (time.monotonic() - wall_start) * speed
+                    if replayed >= timestamp:
+                        break
+                    clock['now'] = replayed
+                    time.sleep(min(1, (timestamp - replayed) / speed))
+            clock['now'] = timestamp
+            parsing.set()
+            start = time.perf_counter()
+            engine._parse_live_data(buf)
+            parse_stats.record(time.perf_counter() - start)
+            parsing.clear()
+    finally:
+        done.set()
+        for worker in workers:
+            worker.join()
+
+    return {
+        'feeds': parse_stats.summary()['count'],
+        'replayed_seconds': clock['now'] - first[0],
+        'wall_seconds': round(time.monotonic() - wall_start, 3),
+        'parse_ms': parse_stats.summary(),
+        'query_ms': {key: value.summary() for key, value in query_stats.items()},
+        'peak_rss_mb': {'before': rss_before, 'after': _peak_rss_mb()},
+    }
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+if __name__ == "__main__":
+    import json
+
+    import gtfs
+    import settings
+
+    parser = gtfs.make_base_arg_parser("Replay recorded live feeds through the engine under a query load.")
+    parser.add_argument('directory', type=str,
+                        help="Directory of recorded feeds (see ARCHIVE_DIR)")
+    parser.add_argument('--date', type=str, default=None,
+                        help="Only replay feeds recorded on this day (YYYY-MM-DD)")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="Replay speed, relative to real time. 0 replays as fast as possible (default: 1)")
+    parser.add_argument('--qps', type=float, default=10,
+                        help="Queries per second to make against the engine (default: 10)")
+    parser.add_argument('--threads', type=int, default=2,
+                        help="Threads making queries (default: 2)")
+    parser.add_argument('--stops', type=str, default=None,
+                        help="Comma separated stop numbers to query (default: the filter stops)")
+    args = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level))
+
+    filter_stops = args.filter.split(',') if args.filter is not None else settings.FILTER_STOPS
+    engine = gtfs.GTFS(
+        live_url=args.live_url,
+        api_key=args.api_key,
+        redis_url=args.redis,
+        filter_stops=filter_stops,
+    )
+    start = end = None
+    if args.date:
+        day = datetime.datetime.fromisoformat(args.date)
+        start, end = int(day.timestamp()), int((day + datetime.timedelta(days=1)).timestamp())
+    stats = replay(
+        engine,
+        iter_feeds(args.directory, start, end),
+        speed=args.speed,
+        queries_per_second=args.qps,
+        stops=args.stops.split(',') if args.stops else None,
+        minutes=args.minutes,
+        threads=args.threads,
+    )
+    print(json.dumps(stats, indent=4))
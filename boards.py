@@ -0,0 +1,91 @@
+# Precomputed departure boards for a configured set of busy ("hot") stops.
+#
+# The upcoming arrivals at a stop only change when the clock passes an arrival, or when a new
+# live feed lands. So for hot stops, the thread that polls the live feed computes the arrivals
+# once after each refresh, along with pre-rendered response bodies, and request handlers only
+# have to drop arrivals that have passed since.
+import datetime
+
+import render
+
+
+def is_upcoming(scheduled_arrival, real_time_arrival, now, until):
+    # the same rule GTFS.get_scheduled_arrivals uses for "not arrived yet", bounded by `until`
+    expected = real_time_arrival or scheduled_arrival
+    return (scheduled_arrival > now or (real_time_arrival and real_time_arrival > now)) and expected <= until
+
+
+class Board:
+    def __init__(self, generation: int, computed_at: datetime.datetime, covered_until: datetime.datetime, entries: list):
+        self.generation = generation
+        self.computed_at = computed_at
+        # the latest time up to which the board holds every arrival
+        self.covered_until = covered_until
+        # (scheduled_arrival, real_time_arrival, API arrival dict), ordered by expected arrival
+        self.entries = entries
+        # pre-rendered bodies for `minutes`, keyed on format
+        self.minutes = None
+        self.bodies = {}
+        self.bodies_valid_until = computed_at
+
+    def arrivals(self, now: datetime.datetime, minutes: int):
+        # return the API arrival dicts that are upcoming in the next `minutes`, or None if the
+        # board doesn't cover that window.
+        until = now + datetime.timedelta(minutes=minutes)
+        if now < self.computed_at or until > self.covered_until:
+            return None
+        return [arrival for scheduled, real_time, arrival in self.entries if is_upcoming(scheduled, real_time, now, until)]
+
+    def prerender(self, minutes: int):
+        # Render the bodies for a `minutes` window as of computed_at, and work out how long they
+        # stay correct: until an included arrival passes, or an excluded one enters the window.
+        window = datetime.timedelta(minutes=minutes)
+        arrivals = self.arrivals(self.computed_at, minutes)
+        if arrivals is None:
+            return
+        valid_until = self.covered_until - window
+        for scheduled, real_time, _ in self.entries:
+            expected = real_time or scheduled
+            if is_upcoming(scheduled, real_time, self.computed_at, self.computed_at + window):
+                valid_until = min(valid_until, max(scheduled, expected))
+            elif expected > self.computed_at + window:
+                valid_until = min(valid_until, expected - window)
+        self.minutes = minutes
+        self.bodies = {fmt: render.render(fmt, arrivals) for fmt in render.MIMETYPES}
+        self.bodies_valid_until = valid_until
+
+    def body(self, fmt: str, now: datetime.datetime, minutes: int):
+        # return the pre-rendered body if it is still exactly what would be rendered now, else None
+        if minutes == self.minutes and self.computed_at <= now < self.bodies_valid_until:
+            return self.bodies.get(fmt)
+        return None
+
+
+class DepartureBoards:
+    def __init__(self, stops: dict, minutes: int, horizon: datetime.timedelta):
+        # stops maps the stop_id used in requests to the stop_number used by the GTFS engine.
+        # Boards are computed for `minutes` plus `horizon` (normally the polling period), so
+        # that they can answer queries for `minutes` until the next refresh.
+        self.stops = stops
+        self.minutes = minutes
+        self.horizon = horizon
+        self.generation = 0
+        self.boards = {}
+
+    def refresh(self, engine, now: datetime.datetime):
+        window = datetime.timedelta(minutes=self.minutes) + self.horizon
+        self.generation += 1
+        boards = {}
+        for stop_id, stop_number in self.stops.items():
+            entries = [
+                (arrival["scheduled_arrival"], arrival["real_time_arrival"], render.format_arrival(arrival, stop_id))
+                for arrival in engine.get_scheduled_arrivals(stop_number, now, window)
+            ]
+            board = Board(self.generation, now, now + window, entries)
+            board.prerender(self.minutes)
+            boards[stop_id] = board
+        # replace all boards at once, so that request threads never see a partial refresh
+        self.boards = boards
+
+    def get(self, stop_id: str):
+        return self.boards.get(stop_id)
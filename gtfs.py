@@ -1,19 +1,31 @@
 import os
 import csv
 import json
+import math
 import datetime
 import collections
 import time
 import sys
 import struct
-import urllib.request
 import logging
 import argparse
-
-from google.transit import gtfs_realtime_pb2
+import pickle
+import threading
+import zlib
+import shutil
+import functools
+import itertools
+import heapq
+import contextlib
 
 import settings
 import store
+import gtfsr
+import stopindex
+import partitions
+import republish
+import tracing
+import ingest
 
 def _s2b(s):
     return s.encode('utf-8')
@@ -21,12 +33,129 @@ def _s2b(s):
 def _b2s(b):
     return b.decode('utf-8').split(chr(0))[0]
 
+# Value stored in packed live delays for stops whose update carried an absolute arrival time
+# rather than a delay.
+NO_DELAY = -0x80000000
+
+# Size in degrees of the cells of the grid used to index stop locations. In Ireland, 0.01 degrees is
+# about 1.1km north-south and 0.65km east-west.
+GRID_SIZE = 0.01
+# Refuse bounding box queries that would have to look at more cells than this (about 2x2 degrees).
+MAX_GRID_CELLS = 40000
+# Latitude beyond which nearby stop searches treat grid cells as no narrower east-west. There are no
+# stops this close to the poles.
+NARROWEST_CELL_LATITUDE = 80
+EARTH_RADIUS = 6371000
+
+def _grid_cell(lat, lon):
+    return math.floor(lat / GRID_SIZE), math.floor(lon / GRID_SIZE)
+
+def _distance(lat1, lon1, lat2, lon2):
+    # great circle distance in metres between two points
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+# GTFS arrival times are seconds since the start of a service day, and run past 24:00:00 for trips
+# that continue after midnight. Times are assumed to stay below this.
+MAX_SERVICE_DAY_SECONDS = 48 * 3600
+# Scheduled arrivals up to this long before a query window are considered, in case they are running
+# late, and up to MAX_EARLINESS after it, in case they are running early.
+MAX_LATENESS = datetime.timedelta(hours=2)
+MAX_EARLINESS = datetime.timedelta(minutes=30)
+# A trip_id runs on every day its service is calendared, so live data about it refers to the run
+# closest to the feed timestamp. It is only applied to runs within this long of that timestamp.
+LIVE_DATA_HORIZON = datetime.timedelta(hours=12)
+
+class _ServiceCodec(store.Codec):
+    # calendar entries are read for every trip considered, so pack them rather than pickling
+    def encode(self, value):
+        return struct.pack('<ii7?', value['start_date'].toordinal(), value['end_date'].toordinal(), *value['days'])
+
+    def decode(self, data):
+        start_date, end_date, *days = struct.unpack('<ii7?', data)
+        return {
+            'start_date': datetime.date.fromordinal(start_date),
+            'end_date': datetime.date.fromordinal(end_date),
+            'days': days
+        }
+
+# How values of each namespace are stored by data store backends that store bytes. Every namespace
+# is listed, as a redis store only clears the namespaces it is configured with.
+NAMESPACE_CODECS = {
+    'status': store.PICKLE,
+    'route': store.MSGPACK,
+    'agency': store.STR,
+    'service': _ServiceCodec(),
+    'exception': store.INT,
+    'stop': store.STR,
+    'stop_names': store.STR,
+    'stop_grid': store.BYTES,
+    'stop_numbers': store.PICKLE,
+    'stop_times': store.FixedWidthListCodec(struct.calcsize('12s4b')),
+    'trip': store.BYTES,
+    'trip_stops': store.BYTES,
+    'route_trips': store.MSGPACK,
+    'route_ids': store.MSGPACK,
+    'live_delays': store.BYTES,
+    'live_cancelations': store.INT,
+    'live_additions': store.PICKLE,
+    'live_feed': store.INT,
+    'live_vehicles': store.BYTES,
+    'live_alerts': store.MSGPACK,
+}
+
+# Sizes and lifetimes (in seconds) of the in-memory caches of static data kept in a backend outside
+# the process. Unknown stops and trips are remembered for less time, in case they are being loaded.
+NAMESPACE_CACHES = {
+    'route': {'cache_size': 5000, 'expiry': 3600},
+    'agency': {'cache_size': 100, 'expiry': 3600},
+    'service': {'cache_size': 5000, 'expiry': 3600},
+    'exception': {'cache_size': 20000, 'expiry': 3600},
+    'trip': {'cache_size': 50000, 'expiry': 3600, 'negative_expiry': 300},
+}
+
+# Methods timed by tracing (see instrument()): the phases of a query and of the live feed parse
+TRACED_METHODS = (
+    'get_arrivals_in_window', '_scheduled_stop_times', 'get_trip_info', '_is_service_running', '_is_cancelled',
+    '_get_live_delay', 'get_trip_timeline', 'get_route_trips', '_parse_live_data', '_decode_live_feed',
+    '_is_known_trip', '_pack_live_delays', 'load_vehicle_positions', '_vehicle_delay', 'load_service_alerts',
+)
+
+# protobuf and urllib.request take a good part of a second to import on a cold container, and
+# aren't needed until live data is fetched, so they are imported on first use.
+def _gtfs_realtime_pb2():
+    from google.transit import gtfs_realtime_pb2
+    return gtfs_realtime_pb2
+
+@functools.lru_cache(maxsize=None)
+def selective_decode() -> bool:
+    # When only a few trips are of interest, the live feed can be filtered by scanning the raw bytes and
+    # only decoding matching entities. That is far faster than the pure python protobuf runtime (used on
+    # platforms without a compiled wheel), but slower than the compiled runtimes decoding the whole feed.
+    from google.protobuf.internal import api_implementation
+    return api_implementation.Type() == 'python'
+
+def _translated(translated_string) -> str:
+    # the English (or untagged, or else the first) translation of a GTFS-R TranslatedString
+    translations = translated_string.translation
+    for translation in translations:
+        if translation.language in ('', 'en'):
+            return translation.text
+    return translations[0].text if translations else None
+
 class GTFS:
-    def __init__(self, live_url:str, api_key: str, redis_url:str=None, rebuild_cache:bool = False, filter_stops:list=None, profile_memory:bool=False):
-        # Exit with error if static data doesn't exist
-        if check_for_new_static_data():
-            logging.error("New static GTFS data exists. Download it with `python gtfs.py --download` and try again.")
+    def __init__(self, live_url:str, api_key: str, redis_url:str=None, rebuild_cache:bool = False, filter_stops:list=None, profile_memory:bool=False,
+                 partitions:int=0, partition_memory_mb:int=256):
+        start_time = time.monotonic()
+        # Exit with error if there is no static data to serve from
+        if not has_static_data():
+            logging.error("No static GTFS data exists. Download it with `python gtfs.py --download` and try again.")
             sys.exit(1)
+        # Serve from the static data we have straight away, and check for newer data in the background.
+        # new_static_data becomes True or False once the check is done.
+        self.new_static_data = None
+        threading.Thread(target=self._check_for_new_static_data, daemon=True).start()
 
         logging.info(f"""Initializing GTFS with:
             live_url={live_url}
@@ -35,26 +164,61 @@ class GTFS:
             rebuild_cache={rebuild_cache}
             filter_stops={filter_stops}
             profile_memory={profile_memory}
+            partitions={partitions}
         """.replace('\t', ' '))
         self.live_url = live_url
         self.api_key = api_key
         self.filter_stops = set(filter_stops) if filter_stops is not None else None
         self.filter_trips = None
-        # The set of trip_ids serving each stop. Used in conjunction with filter_stops. 
-        self.stop_trips = collections.defaultdict(set) 
         self.rate_limit_count = 0
-        namespace_config = {}
-        if redis_url:
-            namespace_config['route'] = namespace_config['service'] = namespace_config['stop'] = namespace_config['stop_numbers'] = {
-                'cache': True,
-                'expiry': 3600
-            }
-        self.store = store.Store(redis_url=redis_url, namespace_config=namespace_config)
+        # serialises changes to the filter at runtime
+        self.filter_lock = threading.Lock()
+        # incremented each time live data is loaded, so that callers can tell when results may have changed
+        self.live_generation = 0
+        # live feeds are loaded by their own threads, so changes to the generation are serialised
+        self.live_lock = threading.Lock()
+        # trips with a TripUpdate in the latest TripUpdates feed, whose delays aren't estimated from vehicles
+        self.trip_update_trips = set()
+        # keys of the live_alerts namespace set from the latest ServiceAlerts feed
+        self.alert_keys = set()
+        # an archive.Recorder to keep each fetched live feed, if set
+        self.recorder = None
+        # the latest live feed, for re-serving to downstream consumers
+        self.republisher = republish.Republisher()
+        # a partitions.PartitionCache, if the static data is loaded a partition at a time
+        self.partitions = None
+        store_url = redis_url or settings.STORE_URL
+        # Partitions are only loaded lazily into the in-process store. Other backends are loaded in
+        # full, once, and a filtered dataset is small already.
+        lazy = bool(partitions) and filter_stops is None and not store_url
+        namespace_config = {namespace: {'codec': codec} for namespace, codec in NAMESPACE_CODECS.items()}
+        if store_url:
+            # keep frequently used values in memory too
+            for namespace, cache_config in NAMESPACE_CACHES.items():
+                namespace_config.setdefault(namespace, {}).update(cache_config, cache=True)
+        self.store = store.Store(store_url, namespace_config=namespace_config, load_cache=not lazy)
         if rebuild_cache:
             self.store.clear_cache()
+            if os.path.exists(MASTER_FILE):
+                os.remove(MASTER_FILE)
+            shutil.rmtree(PARTITIONS_DIR, ignore_errors=True)
 
-        if self.store.get('status', "initialized") is None:
+        if lazy:
+            self.load_partitions(partitions, partition_memory_mb * 1024 * 1024)
+        elif self.store.get('status', "initialized") is None:
             self.load_static()
+        elif os.path.exists(CACHE_INFO_FILE) and not check_cache_info(self.filter_stops):
+            # The cache was cut for a different set of stops, so cut it again from the master index
+            logging.info("Cached data was filtered for different stops.")
+            self.set_filter_stops(filter_stops)
+        if self.filter_stops is not None and self.filter_trips is None:
+            # Loaded from cache, so recover the trips serving the filtered stops from the stop times.
+            self.filter_trips = self._trips_for_stops(self.filter_stops)
+        # stops are looked up for every request and live update, so they are indexed in memory
+        self.stops = stopindex.StopIndex.from_store(self.store)
+
+        self.startup_seconds = time.monotonic() - start_time
+        logging.info(f"GTFS data ready in {self.startup_seconds:.2f} seconds")
 
         if profile_memory:
             logging.info("Profiling memory usage...")
@@ -62,28 +226,141 @@ class GTFS:
             for key in stats:
                 logging.info(f"{ key }: { stats[key] / 1024 / 1024 :.02f} MB")
     
+    def instrument(self):
+        # time queries and live feed parses, by phase, while a trace is active in their thread
+        tracing.instrument(self, TRACED_METHODS, prefix='gtfs')
+        tracing.instrument(self.store, ('get', 'set', 'delete'), prefix='store')
+        tracing.instrument(self.republisher, ('publish',), prefix='republish')
+        if self.partitions is not None:
+            tracing.instrument(self.partitions, ('pin_stop', 'pin_trip', 'pin_partition'), prefix='partitions')
+
+    def _check_for_new_static_data(self):
+        self.new_static_data = check_for_new_static_data()
+        if self.new_static_data:
+            logging.warning("New static GTFS data exists. Download it with `python gtfs.py --download` and restart to use it.")
+
     def load_static(self):
-        logging.info("Loading GTFS static data from scratch.")
-        logging.info("Loading routes.")
-        self._read_routes()
-        logging.info("Loading agencies.")
-        self._read_agencies()
-        logging.info("Loading calendar.")
-        self._read_calendar()
-        logging.info("Loading calendar exceptions.")
-        self._read_exceptions()
-        logging.info("Loading stops.")
-        self._read_stops()
-        logging.info("Loading stop times.")
-        self._read_stop_times()
-        logging.info("Loading trips.")
-        self._read_trips()
+        # Build the master index of the whole feed if needed, and cut the dataset for our stops from it
+        if not os.path.exists(MASTER_FILE):
+            self.build_master_index()
+        logging.info("Loading GTFS static data from the master index.")
+        self.filter_trips = self._derive_from_master(self.filter_stops, self.store)
         self.store.set('status', "initialized", True)
         logging.info("Persisting data.")
         self.store.write_cache()
         # write a json file containing the self.filter_stops to cache_info.txt
         write_cache_info(self.filter_stops)
-    
+
+    def load_partitions(self, shards: int, memory_budget: int):
+        # Load the base data, leaving stop times and trips to be loaded a partition at a time as they
+        # are queried. The master index is split into partitions first if needed.
+        if not partitions.exists(PARTITIONS_DIR, shards):
+            if not os.path.exists(MASTER_FILE):
+                self.build_master_index()
+            logging.info(f"Splitting the master index into {shards} partitions.")
+            partitions.write_partitions(
+                read_master_index(), PARTITIONS_DIR, shards,
+                lambda value: (self._unpack_stop_data(packed_stop_data)[0] for packed_stop_data in value),
+            )
+        self.partitions = partitions.PartitionCache(PARTITIONS_DIR, self.store, memory_budget)
+        self.partitions.load_base()
+
+    def build_master_index(self):
+        # Parse the static CSVs once, unfiltered, into the master index. Filtered datasets are then cut
+        # from the master without parsing the feed again.
+        logging.info("Building master index from GTFS static data.")
+        full_store = store.Store(load_cache=False)
+        static_store, self.store = self.store, full_store
+        tmp_file = f"{MASTER_FILE}.tmp"
+        try:
+            with open(tmp_file, "wb") as f:
+                logging.info("Loading routes.")
+                self._read_routes()
+                logging.info("Loading agencies.")
+                self._read_agencies()
+                logging.info("Loading calendar.")
+                self._read_calendar()
+                logging.info("Loading calendar exceptions.")
+                self._read_exceptions()
+                logging.info("Loading stops.")
+                self._read_stops()
+                logging.info("Loading stop times.")
+                # Stop times and trip timelines are the bulk of the feed, so they are streamed into the
+                # master rather than held. stop_times must come first, as the trips to keep are worked
+                # out from it when deriving.
+                self._read_stop_times(f)
+                logging.info("Loading trips.")
+                self._read_trips()
+                for namespace in list(full_store.data):
+                    _write_master_namespace(f, namespace, full_store.data.pop(namespace))
+            os.replace(tmp_file, MASTER_FILE)
+            # partitions of an older master index are out of date
+            shutil.rmtree(PARTITIONS_DIR, ignore_errors=True)
+        finally:
+            self.store = static_store
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def _derive_from_master(self, filter_stops, target_store) -> set:
+        # Copy the master index into target_store, keeping only the stop times of filter_stops and the
+        # trips that serve them. The master is read a chunk at a time, so this never holds more than
+        # the filtered dataset and one chunk. Returns the kept trip_ids, or None if not filtering.
+        filter_trips = set() if filter_stops else None
+        for namespace, chunk in read_master_index():
+            if isinstance(chunk, set):
+                for value in chunk:
+                    target_store.add(namespace, value)
+                continue
+            for key, value in chunk.items():
+                if filter_stops:
+                    if namespace == 'stop_times':
+                        # keys are "<stop_number>:<hour>"
+                        if key.rsplit(':', 1)[0] not in filter_stops:
+                            continue
+                        filter_trips.update(self._unpack_stop_data(packed_stop_data)[0] for packed_stop_data in value)
+                    elif namespace in ('trip', 'trip_stops'):
+                        if key not in filter_trips:
+                            continue
+                    elif namespace == 'route_trips':
+                        value = [trip_id for trip_id in value if trip_id in filter_trips]
+                        if not value:
+                            continue
+                target_store.set(namespace, key, value)
+        return filter_trips
+
+    def set_filter_stops(self, filter_stops: list):
+        """
+        Change the stops that stored data relates to (None for all stops), by cutting a new dataset
+        from the master index. Live data is kept.
+        """
+        filter_stops = set(filter_stops) if filter_stops else None
+        with self.filter_lock:
+            if not os.path.exists(MASTER_FILE):
+                self.build_master_index()
+            start_time = time.time()
+            if self.store.is_local:
+                # cut the new dataset on the side, then swap it in so that readers never see a partial one
+                derived_store = store.Store(load_cache=False)
+                filter_trips = self._derive_from_master(filter_stops, derived_store)
+                derived_store.set('status', "initialized", True)
+                self.store.replace_with(derived_store, keep=LIVE_NAMESPACES)
+            else:
+                # other backends may be shared with other processes, so the new dataset is written
+                # alongside the old, which they keep reading until it is swapped in in one transaction
+                staged_store = self.store.staged()
+                filter_trips = self._derive_from_master(filter_stops, staged_store)
+                staged_store.set('status', "initialized", True)
+                self.store.swap_in_staged(keep=LIVE_NAMESPACES)
+            self.filter_stops = filter_stops
+            self.filter_trips = filter_trips
+            # the whole dataset for the filter is loaded now
+            self.partitions = None
+            self.stops = stopindex.StopIndex.from_store(self.store)
+            self._live_data_changed()
+            logging.info(f"Derived data for stops {sorted(filter_stops) if filter_stops else 'all'} in {time.time() - start_time:.1f} seconds")
+            self.store.write_cache()
+            write_cache_info(filter_stops)
+
     def _read_agencies(self):
         with(open(settings.DATA_DIR / "agency.txt", "r")) as f:
             reader = csv.reader(f)
@@ -94,6 +371,8 @@ class GTFS:
                 self.store.set('agency', agency_id, agency_name)
 
     def _read_routes(self):
+        # route name -> route_ids, as agencies can give different routes the same name
+        route_ids = collections.defaultdict(list)
         with(open(settings.DATA_DIR / "routes.txt", "r")) as f:
             reader = csv.reader(f)
             # skip the first row of fieldnames
@@ -104,6 +383,9 @@ class GTFS:
                     'name': short_name,
                     'agency': agency
                 })
+                route_ids[short_name].append(route_id)
+        for route_name, ids in route_ids.items():
+            self.store.set('route_ids', route_name, ids)
 
     def _read_calendar(self):
         # each service_id maps to a dict keyed on day of week
@@ -150,6 +432,7 @@ class GTFS:
     def _read_stops(self):
         # open stops.txt and parse it as a CSV file, then return a dict
         # of stop_number -> stop_id (stop_number, as written on bus stops)
+        locations = []
         with(open(settings.DATA_DIR / "stops.txt", "r")) as f:
             reader = csv.reader(f)
             # skip the first row of fieldnames
@@ -162,6 +445,27 @@ class GTFS:
                 self.store.set('stop', stop_id, stop_number)
                 self.store.set('stop_names', stop_number, stop_name)
                 self.store.add('stop_numbers', stop_number)
+                if row[4] and row[5]:
+                    locations.append((stop_number, float(row[4]), float(row[5])))
+        self._index_stop_locations(locations)
+
+    def _pack_stop_location(self, stop_number, lat, lon):
+        # byte pack the data to save space
+        return struct.pack('12s2f', _s2b(stop_number), lat, lon)
+
+    def _unpack_stop_locations(self, cell_buffer):
+        # unpack all the stop locations in a grid cell
+        for stop_number, lat, lon in struct.iter_unpack('12s2f', cell_buffer):
+            yield _b2s(stop_number), lat, lon
+
+    def _index_stop_locations(self, locations):
+        # Bucket stop locations into a grid of GRID_SIZE cells, so that stops near a point can be
+        # found by looking at a handful of cells.
+        cells = collections.defaultdict(list)
+        for stop_number, lat, lon in locations:
+            cells[_grid_cell(lat, lon)].append(self._pack_stop_location(stop_number, lat, lon))
+        for (row, col), packed_locations in cells.items():
+            self.store.set('stop_grid', f"{row}:{col}", b''.join(packed_locations))
     
     def _pack_stop_data(self, trip_id, arrival_hour, arrival_min, arrival_sec, stop_sequence):
         # byte pack the data to save space
@@ -174,49 +478,80 @@ class GTFS:
         return _b2s(trip_id), arrival_hour, arrival_min, arrival_sec, stop_sequence
 
 
-    def _read_stop_times(self) -> dict:
-        # open stop_times.txt and parse it as a CSV file, then return a dict
-        # stop_id -> list of (trip_id, arrival_time, departure_time, stop_sequence)
+    def _read_stop_times(self, f):
+        """
+        Parse stop_times.txt into the stop_times and then the trip_stops namespaces of the master index
+        being written to f. Only STOP_TIMES_BATCH_ROWS rows are held in memory at a time: each batch is
+        spilled to a run file sorted by key, and the runs are then merged into the master a chunk at a
+        time.
+        """
         start_time = time.time()
         print("Loading stop times...", end='')
-        stop_times = collections.defaultdict(dict)
-        with(open(settings.DATA_DIR / "stop_times.txt", "r")) as f:
-            reader = csv.reader(f)
-            # skip the first row of fieldnames
-            next(reader)
-            for idx, row in enumerate(reader):
-                if idx % 10000 == 0:
+        runs_directory = f"{MASTER_FILE}.runs"
+        shutil.rmtree(runs_directory, ignore_errors=True)
+        os.makedirs(runs_directory)
+        try:
+            num_runs, num_rows = 0, 0
+            with(open(settings.DATA_DIR / "stop_times.txt", "r")) as csv_file:
+                reader = csv.reader(csv_file)
+                # skip the first row of fieldnames
+                next(reader)
+                while True:
+                    # "<stop_number>:<hour>" -> packed stop data, in file order
+                    stop_times = collections.defaultdict(list)
+                    # the packed (stop_number, arrival time, stop_sequence) of each stop served by each trip
+                    trip_stops = collections.defaultdict(list)
+                    for row in itertools.islice(reader, STOP_TIMES_BATCH_ROWS):
+                        trip_id, arrival_time, _, stop_id, stop_sequence = row[0:5]
+                        stop_number = self.store.get('stop', stop_id)
+                        arrival_hour, arrival_min, arrival_sec = [int(x) for x in arrival_time.split(':')]
+                        if stop_number is not None:
+                            trip_stops[trip_id].append(self._pack_trip_stop(stop_number, arrival_hour * 3600 + arrival_min * 60 + arrival_sec, stop_sequence))
+                        # arrival time is in the format HH:MM:SS. Pull out the hour so that trips can be
+                        # looked up by stop and hour.
+                        stop_times[f"{stop_number}:{arrival_hour % 24}"].append(self._pack_stop_data(trip_id, arrival_hour, arrival_min, arrival_sec, stop_sequence))
+                        num_rows += 1
+                    if not stop_times:
+                        break
+                    for namespace, values in (('stop_times', stop_times), ('trip_stops', trip_stops)):
+                        _write_run(os.path.join(runs_directory, f"{num_runs}.{namespace}"), values)
+                    num_runs += 1
                     sys.stdout.write('.')
                     sys.stdout.flush()
-                trip_id, arrival_time, _, stop_id, stop_sequence = row[0:5]
-                stop_number = self.store.get('stop', stop_id)
-                # keep track of which trips serve which stops
-                self.stop_trips[stop_number].add(trip_id)
-                # skip this stop if we have a filter list and it's not in it
-                if self.filter_stops and stop_number not in self.filter_stops:
-                    continue
-                arrival_hour, arrival_min, arrival_sec = [int(x) for x in arrival_time.split(':')]
-                # arrival time is in the format HH:MM:SS. Pull out the hour so that trips can be 
-                # looked up by stop and hour.
-                hour = arrival_hour % 24
-                if hour not in stop_times[stop_number]:
-                     stop_times[stop_number][hour] = []
-                stop_times[stop_number][hour].append(self._pack_stop_data(trip_id, arrival_hour, arrival_min, arrival_sec, stop_sequence))
-
-        logging.info(f"\n\nLoaded {idx + 1} stop times in {time.time() - start_time:.0f} seconds")
-        for stop_number in stop_times:
-            for hour in stop_times[stop_number]:
-                self.store.set('stop_times', f"{stop_number}:{hour}", stop_times[stop_number][hour])
-
-        # make a set containing the trip_ids that serve any of the stops in self.filter_stops
-        # so that we can filter out trips that don't serve any of the stops we are interested in.
-        if self.filter_stops is not None:
-            # flatten the list of lists into a single list
-            self.filter_trips = set([
-                trip_id for trip_ids in 
-                [self.stop_trips[stop_number] for stop_number in self.filter_stops] 
-                for trip_id in trip_ids
-            ])
+
+            logging.info(f"\n\nLoaded {num_rows} stop times in {time.time() - start_time:.0f} seconds")
+            _write_master_items(f, 'stop_times', _merge_runs(
+                [os.path.join(runs_directory, f"{run}.stop_times") for run in range(num_runs)]))
+            # store the timeline of each trip, in stop_sequence order
+            _write_master_items(f, 'trip_stops', (
+                (trip_id, b''.join(sorted(packed_trip_stops, key=lambda packed_trip_stop: self._unpack_trip_stop(packed_trip_stop)[2])))
+                for trip_id, packed_trip_stops in _merge_runs([os.path.join(runs_directory, f"{run}.trip_stops") for run in range(num_runs)])
+            ))
+        finally:
+            shutil.rmtree(runs_directory, ignore_errors=True)
+
+    def _pack_trip_stop(self, stop_number, arrival_seconds, stop_sequence):
+        # byte pack the data to save space. arrival_seconds is the time since midnight of the
+        # service day, which can be more than 24 hours.
+        return struct.pack('12sIH', _s2b(stop_number), arrival_seconds, int(stop_sequence))
+
+    def _unpack_trip_stop(self, trip_stop_buffer):
+        stop_number, arrival_seconds, stop_sequence = struct.unpack('12sIH', trip_stop_buffer)
+        return _b2s(stop_number), arrival_seconds, stop_sequence
+
+    def _unpack_trip_stops(self, trip_stops_buffer):
+        # unpack all the stops of a trip, in stop_sequence order
+        for stop_number, arrival_seconds, stop_sequence in struct.iter_unpack('12sIH', trip_stops_buffer):
+            yield _b2s(stop_number), arrival_seconds, stop_sequence
+
+    def _trips_for_stops(self, stop_numbers) -> set:
+        # the set of trip_ids with scheduled arrivals at any of the given stops
+        trip_ids = set()
+        for stop_number in stop_numbers:
+            for hour in range(24):
+                for packed_stop_data in self.store.get('stop_times', f"{stop_number}:{hour}", []):
+                    trip_ids.add(self._unpack_stop_data(packed_stop_data)[0])
+        return trip_ids
 
     def _pack_trip(self, route_id, service_id, headsign):
         # byte pack the data to save space
@@ -232,6 +567,8 @@ class GTFS:
         # that maps trip_id -> route_id and service_id
         
         
+        # route_id -> trip_ids, so that the trips of a route can be found without a scan
+        route_trips = collections.defaultdict(list)
         with(open(settings.DATA_DIR / "trips.txt", "r")) as f:
             reader = csv.reader(f)
             # skip the first row of fieldnames
@@ -241,9 +578,10 @@ class GTFS:
                 service_id = row[1]
                 trip_id = row[2]
                 headsign = row[3]
-                if self.filter_trips and trip_id not in self.filter_trips:
-                    continue
                 self.store.set('trip', trip_id, self._pack_trip(route_id, service_id, headsign))
+                route_trips[route_id].append(trip_id)
+        for route_id, trip_ids in route_trips.items():
+            self.store.set('route_trips', route_id, trip_ids)
 
     def get_trip_info(self, trip_id):
         try:
@@ -258,6 +596,7 @@ class GTFS:
                 calendar_info = self.store.get('service', service_id)
                 return {
                     'route': route_info['name'],
+                    'route_id': route_id,
                     'headsign': headsign,
                     'agency': agency_info,
                     'service_id': service_id,
@@ -268,7 +607,67 @@ class GTFS:
         except KeyError:
             return None
 
-    def _parse_live_data(self, buf: bytes):
+    def _route_name(self, route_id):
+        route_info = self.store.get('route', route_id)
+        return route_info['name'] if route_info is not None else None
+
+    def _route_ids(self, route: str, agency: str = None) -> list:
+        # the route_ids of a route name (e.g. "46A"), only those of an agency (by agency_id or name)
+        # if given, as different agencies' routes can share a name
+        route_ids = self.store.get('route_ids', route, [])
+        if agency is None:
+            return route_ids
+        matching = []
+        for route_id in route_ids:
+            agency_id = self.store.get('route', route_id)['agency']
+            if agency in (agency_id, self.store.get('agency', agency_id)):
+                matching.append(route_id)
+        return matching
+
+    def _is_known_trip(self, trip_id):
+        if self.partitions is not None:
+            # the trip needn't be loaded to be known
+            return self.store.get(partitions.TRIP_PARTITION, trip_id) is not None
+        return self.get_trip_info(trip_id) is not None
+
+    def _using_stop(self, stop_number: str):
+        # keep the partition of a stop loaded while a query reads it
+        return self.partitions.pin_stop(stop_number) if self.partitions is not None else contextlib.nullcontext()
+
+    def _using_trip(self, trip_id: str, load: bool = True):
+        # the same for a trip. Read and unpack its values inside the with block: the partition may be
+        # dropped as soon as it is exited.
+        return self.partitions.pin_trip(trip_id, load) if self.partitions is not None else contextlib.nullcontext()
+
+    def _each_trip_in_use(self, trip_ids):
+        # yield trip_ids with the partition of each kept loaded, pinning a partition at a time for all
+        # of its trips, so that a query over many trips loads each partition once
+        if self.partitions is None:
+            yield from trip_ids
+            return
+        for partition, partition_trip_ids in self.partitions.group_trips(trip_ids).items():
+            with self.partitions.pin_partition(partition):
+                yield from partition_trip_ids
+
+    def _decode_live_feed(self, buf: bytes, selective: bool):
+        # returns the feed timestamp and an iterable of the FeedEntity messages to process
+        if selective and self.filter_trips:
+            # Skip entities for other trips without building protobuf objects for them.
+            FeedEntity = _gtfs_realtime_pb2().FeedEntity
+            entities = (
+                FeedEntity.FromString(buf[start:end])
+                for start, end in gtfsr.iter_entities(buf)
+                if gtfsr.entity_trip_id(buf, start, end) in self.filter_trips
+            )
+            return gtfsr.feed_timestamp(buf), entities
+        feed = _gtfs_realtime_pb2().FeedMessage()
+        feed.ParseFromString(buf)
+        return feed.header.timestamp, feed.entity
+
+    def _parse_live_data(self, buf: bytes, selective: bool = None):
+        # selective defaults to selective_decode()
+        if selective is None:
+            selective = selective_decode()
         # https://developers.google.com/transit/gtfs-realtime/reference#enum-schedulerelationship-2
         TRIP_SCHEDULED = 0
         TRIP_ADDED = 1
@@ -280,22 +679,25 @@ class GTFS:
         STOP_SKIPPED = 1
         STOP_NO_DATA = 2
 
-        # data structure into which updates from the live feed will be loaded.
-        feed = gtfs_realtime_pb2.FeedMessage()
-        feed.ParseFromString(buf)
-        timestamp = feed.header.timestamp
+        timestamp, entities = self._decode_live_feed(buf, selective)
         num_updates, num_unrecognised_trips, num_added, num_cancelled = 0, 0, 0, 0
-        for entity in feed.entity:
+        trip_update_trips = set()
+        for entity in entities:
             if entity.HasField('trip_update'):
                 trip_id = entity.trip_update.trip.trip_id
                 if self.filter_trips and trip_id not in self.filter_trips:
                     continue
+                trip_update_trips.add(trip_id)
+                # marked before its delays are written, so that vehicle positions loaded meanwhile
+                # don't overwrite them with an estimate
+                with self.live_lock:
+                    self.trip_update_trips.add(trip_id)
                 trip_delays = []
                 for stop_time_update in entity.trip_update.stop_time_update:
                     if stop_time_update.schedule_relationship != STOP_SCHEDULED:
                         continue
                     
-                    stop_number = self.store.get('stop', stop_time_update.stop_id)
+                    stop_number = self.stops.stop_number(stop_time_update.stop_id)
                     if self.filter_stops is None and stop_number is None:
                         # Not filtering stops, so we should recognise all of them.
                         logging.warning(f"Unrecognised stop_id {stop_time_update.stop_id} in live data feed.")
@@ -323,15 +725,12 @@ class GTFS:
                         self.store.set('live_cancelations', trip_id, timestamp)
                     
                     elif entity.trip_update.trip.schedule_relationship == TRIP_SCHEDULED:
-                        trip_info = self.get_trip_info(trip_id)
-                        if trip_info is None:
+                        if not self._is_known_trip(trip_id):
                             num_unrecognised_trips += 1
                             continue
 
-                        delay = arrival_time = None
-                        if stop_time_update.arrival.time:
-                            arrival_time = datetime.datetime.fromtimestamp(stop_time_update.arrival.time)
-                        else:
+                        delay = None
+                        if not stop_time_update.arrival.time:
                             delay = stop_time_update.arrival.delay
                             # Ignore delays greater than a week
                             # Some updates contain delays that are approximately equal to the timestamp but negative.
@@ -339,29 +738,157 @@ class GTFS:
                             if delay < -60 * 60 * 24 * 7: 
                                 continue
                         num_updates += 1
-                        trip_delays.append({
-                            'stop_sequence': stop_time_update.stop_sequence,
-                            'stop_number': stop_number,
-                            'delay': delay,
-                            'arrival_time': arrival_time,
-                            'timestamp': timestamp
-                        })
+                        trip_delays.append((stop_time_update.stop_sequence, delay))
 
                 if len(trip_delays):
-                    self.store.set('live_delays', trip_id, trip_delays)
+                    self.store.set('live_delays', trip_id, self._pack_live_delays(trip_delays))
+        self.store.set('live_feed', 'timestamp', timestamp)
+        with self.live_lock:
+            self.trip_update_trips = trip_update_trips
+        generation = self._live_data_changed()
+        self.republisher.publish(republish.FeedSnapshot(buf, generation, self.stops.stop_number, self._route_name))
         logging.debug(f"Got {num_updates} trip updates, {num_unrecognised_trips} unrecognised trips, {num_added} added trips, {num_cancelled} cancelled trips")
     
+    def _live_data_changed(self) -> int:
+        # bump and return the live generation
+        with self.live_lock:
+            self.live_generation += 1
+            return self.live_generation
+
+    def load_trip_updates(self, buf: bytes):
+        # load a fetched TripUpdates feed, keeping a copy if feeds are being recorded
+        if self.recorder is not None:
+            try:
+                self.recorder.record(buf)
+            except OSError as e:
+                logging.error(f"Error recording live feed: {e}")
+        self._parse_live_data(buf)
+
+    def load_vehicle_positions(self, buf: bytes):
+        """
+        Load a VehiclePositions feed. A trip with a vehicle but no TripUpdate in the latest TripUpdates
+        feed is given a delay from the vehicle's position, applied from its current stop on.
+        """
+        feed = _gtfs_realtime_pb2().FeedMessage.FromString(buf)
+        num_vehicles, num_estimated = 0, 0
+        for entity in feed.entity:
+            if not entity.HasField('vehicle'):
+                continue
+            vehicle = entity.vehicle
+            trip_id = vehicle.trip.trip_id
+            if not trip_id or (self.filter_trips and trip_id not in self.filter_trips):
+                continue
+            timestamp = vehicle.timestamp or feed.header.timestamp
+            self.store.set('live_vehicles', trip_id, struct.pack('<IqBff',
+                vehicle.current_stop_sequence, timestamp, vehicle.current_status, vehicle.position.latitude, vehicle.position.longitude))
+            num_vehicles += 1
+            if trip_id in self.trip_update_trips:
+                continue
+            estimate = self._vehicle_delay(trip_id, vehicle, timestamp)
+            if estimate is None:
+                continue
+            # the TripUpdates feed may have been loaded meanwhile, and its delays take precedence
+            with self.live_lock:
+                if trip_id in self.trip_update_trips:
+                    continue
+                self.store.set('live_delays', trip_id, self._pack_live_delays([estimate]))
+            num_estimated += 1
+        self._live_data_changed()
+        logging.debug(f"Got {num_vehicles} vehicles, estimated delays for {num_estimated} trips without trip updates")
+
+    def _vehicle_delay(self, trip_id: str, vehicle, timestamp: int):
+        # (stop_sequence, delay) of a trip from the stop its vehicle is at or heading to, or None if the
+        # vehicle can't be placed on the trip. With partitions, only trips already loaded are placed,
+        # rather than loading a partition for every vehicle.
+        STOPPED_AT = 1
+        has_sequence = vehicle.HasField('current_stop_sequence')
+        stop_number = self.stops.stop_number(vehicle.stop_id) if vehicle.stop_id else None
+        if not has_sequence and stop_number is None:
+            return None
+        with self._using_trip(trip_id, load=False):
+            packed_trip_stops = self.store.get('trip_stops', trip_id)
+            if packed_trip_stops is None:
+                return None
+            for trip_stop_number, arrival_seconds, stop_sequence in self._unpack_trip_stops(packed_trip_stops):
+                if (stop_sequence == vehicle.current_stop_sequence) if has_sequence else (trip_stop_number == stop_number):
+                    break
+            else:
+                return None
+        # the run of the trip is the one starting on start_date, or else the one due nearest the position's time
+        position_time = datetime.datetime.fromtimestamp(timestamp)
+        if vehicle.trip.start_date:
+            service_dates = [datetime.datetime.strptime(vehicle.trip.start_date, '%Y%m%d')]
+        else:
+            today = datetime.datetime(position_time.year, position_time.month, position_time.day)
+            service_dates = [today - datetime.timedelta(days=1), today]
+        scheduled_arrival = min(
+            (midnight + datetime.timedelta(seconds=arrival_seconds) for midnight in service_dates),
+            key=lambda scheduled_arrival: abs((scheduled_arrival - position_time).total_seconds()),
+        )
+        delay = int((position_time - scheduled_arrival).total_seconds())
+        if vehicle.current_status != STOPPED_AT:
+            # still on its way to the stop, so it is at least this late, or on time
+            delay = max(delay, 0)
+        if not -MAX_EARLINESS.total_seconds() <= delay <= MAX_LATENESS.total_seconds():
+            return None
+        return stop_sequence, delay
+
+    def load_service_alerts(self, buf: bytes):
+        """
+        Load a ServiceAlerts feed, replacing the alerts of the last one. Alerts are kept by the stops
+        they inform of, or by route for those about a route as a whole.
+        """
+        Alert = _gtfs_realtime_pb2().Alert
+        feed = _gtfs_realtime_pb2().FeedMessage.FromString(buf)
+        alerts = collections.defaultdict(list)
+        for entity in feed.entity:
+            if not entity.HasField('alert'):
+                continue
+            alert = entity.alert
+            keys = set()
+            for informed_entity in alert.informed_entity:
+                if informed_entity.stop_id:
+                    stop_number = self.stops.stop_number(informed_entity.stop_id)
+                    if stop_number is not None:
+                        keys.add(f"stop:{stop_number}")
+                elif informed_entity.route_id:
+                    route_name = self._route_name(informed_entity.route_id)
+                    if route_name is not None:
+                        keys.add(f"route:{route_name}")
+            value = {
+                'id': entity.id,
+                'cause': Alert.Cause.Name(alert.cause),
+                'effect': Alert.Effect.Name(alert.effect),
+                'header': _translated(alert.header_text),
+                'description': _translated(alert.description_text),
+                'url': _translated(alert.url),
+                'active_periods': [[period.start or None, period.end or None] for period in alert.active_period],
+            }
+            for key in keys:
+                alerts[key].append(value)
+        for key, values in alerts.items():
+            self.store.set('live_alerts', key, values)
+        for key in self.alert_keys - alerts.keys():
+            self.store.delete('live_alerts', key)
+        self.alert_keys = set(alerts)
+        self._live_data_changed()
+        logging.debug(f"Got alerts for {len(alerts)} stops and routes")
+
+    def get_alerts(self, stop_number: str = None, route: str = None, now: datetime.datetime = None):
+        # the alerts about a stop and/or a route (by name) that are active at now (by default, any time)
+        alerts = []
+        for key in ([f"stop:{stop_number}"] if stop_number else []) + ([f"route:{route}"] if route else []):
+            alerts.extend(self.store.get('live_alerts', key, []))
+        if now is not None:
+            timestamp = now.timestamp()
+            alerts = [alert for alert in alerts if not alert['active_periods'] or any(
+                (start or 0) <= timestamp <= (end or math.inf) for start, end in alert['active_periods'])]
+        return alerts
+
     def refresh_live_data(self):
-        now = time.time()
+        import urllib.error
         try:
-            # Time to get new data
-            req = urllib.request.Request(self.live_url, None, {
-                'x-api-key': self.api_key,
-                'Cache-Control': 'no-cache'
-            })
-            f = urllib.request.urlopen(req)
-            self._parse_live_data(f.read())
-            f.close()
+            self.load_trip_updates(ingest.fetch(self.live_url, self.api_key))
             self.rate_limit_count = 0
         except urllib.error.HTTPError as e:
             # so long as we get rate-limited, back off exponentially
@@ -370,126 +897,434 @@ class GTFS:
                 self.rate_limit_count += 1
             else:
                 logging.error(f"Error fetching real time updates: {e}")
-        except urllib.error.URLError as e:
+        except (urllib.error.URLError, ingest.FeedError) as e:
             logging.error(f"Error fetching real time updates: {e}")
 
         return self.rate_limit_count
     
 
+    def _pack_live_delays(self, trip_delays):
+        # trip_delays is a list of (stop_sequence, delay) tuples in feed order, where delay may be None.
+        # Byte pack them into a dense array of delays indexed by stop_sequence, starting at the first
+        # updated stop. Stops without an update of their own take the delay of the closest preceding
+        # update, so that the propagation is done once here rather than on every lookup.
+        trip_delays = sorted(trip_delays, key=lambda update: update[0])
+        first_sequence = trip_delays[0][0]
+        delays = [NO_DELAY] * (trip_delays[-1][0] - first_sequence + 1)
+        for idx, (stop_sequence, delay) in enumerate(trip_delays):
+            next_sequence = trip_delays[idx + 1][0] if idx + 1 < len(trip_delays) else stop_sequence + 1
+            start, end = stop_sequence - first_sequence, next_sequence - first_sequence
+            delays[start:end] = [NO_DELAY if delay is None else delay] * (end - start)
+        return struct.pack(f'<I{len(delays)}i', first_sequence, *delays)
+
     def _get_live_delay(self, trip_id: str, stop_sequence: int):
         # find the real time update for this stop or the one with the highest sequence number
         # lower than this stop
-        updates = self.store.get('live_delays', trip_id)
-        if updates:
-            # updates is a sorted list of dicts, each of which contain a stop_sequence and delay
-            # binary search through the list to find the item with the closest stop_sequence that is 
-            # less than or equal to the stop_sequence we are looking for
-            left, right = 0, len(updates) - 1
-            while left <= right:
-                mid = (left + right) // 2
-                if updates[mid]['stop_sequence'] < stop_sequence:
-                    left = mid + 1
-                elif updates[mid]['stop_sequence'] > stop_sequence:
-                    right = mid - 1
-                else:
-                    return updates[mid]['delay']
-            # if we get here, we didn't find an exact match. left is the index of the first item
-            # with a stop_sequence greater than the one we are looking for. If left is 0, there
-            # is no update for this trip at this stop. Otherwise, return the delay of the previous
-            # stop.
-            if left == 0:
+        packed_delays = self.store.get('live_delays', trip_id)
+        if packed_delays:
+            # packed_delays holds the first updated stop_sequence followed by one delay per stop
+            # from there on. Stops after the last update take the delay of the last update.
+            first_sequence, = struct.unpack_from('<I', packed_delays)
+            if stop_sequence < first_sequence:
                 return None
-            else:
-                return updates[left - 1]['delay']
+            idx = min(stop_sequence - first_sequence, len(packed_delays) // 4 - 2)
+            delay, = struct.unpack_from('<i', packed_delays, 4 + 4 * idx)
+            return None if delay == NO_DELAY else delay
 
     def is_valid_stop_number(self, stop_number: str):
-        return self.store.has('stop_numbers', stop_number)
+        return stop_number in self.stops
 
     def get_stop_name(self, stop_number: str):
-        return self.store.get('stop_names', stop_number)
+        return self.stops.name(stop_number)
     
-    def get_scheduled_arrivals(self, stop_number: str, now: datetime, max_wait: datetime.timedelta):
-        # get all the scheduled arrivals at a given stop_id
-        # returns a list of (trip_id, arrival_time, stop_sequence)
-        scheduled_arrivals = []
-        # try the previous hour and the next few (per minutes)
-        try_hours: list
-        if now.hour == 0:
-            try_hours = [23]
-        else:
-            try_hours = [now.hour - 1]
-        try_hours.extend([h % 24 for h in range(now.hour, now.hour + int(max_wait.total_seconds() // 3600) + 1)])
-        for hour in try_hours:
-            stop_times = self.store.get('stop_times', f"{stop_number}:{hour}")
-            if stop_times is None:
-                continue
-            for packed_stop_data in self.store.get('stop_times', f"{stop_number}:{hour}"):
-                trip_id, arrival_hour, arrival_min, arrival_sec, stop_sequence = self._unpack_stop_data(packed_stop_data)
-                time_since_midnight = datetime.timedelta(hours=now.hour, minutes=now.minute, seconds=now.second)
-                
-                # arrival time is stored as HH:MM:SS. Convert to datetime.
-                arrival_time = datetime.timedelta(hours=arrival_hour, minutes=arrival_min, seconds=arrival_sec)
-                stop_sequence = int(stop_sequence)
-
-                # if the arrival time over 12 hours in the past, assume it refers to tomorrow and add one day.
-                if time_since_midnight - datetime.timedelta(hours=12) > arrival_time:
-                    arrival_time += datetime.timedelta(days=1)
-                
-                # Check if service is calendared to run
-                arrival_datetime = datetime.datetime(now.year, now.month, now.day) + arrival_time
-                trip_info = self.get_trip_info(trip_id)
-                if trip_info is None:
+    def _stops_in_cell(self, row, col):
+        return self._unpack_stop_locations(self.store.get('stop_grid', f"{row}:{col}", b''))
+
+    def _stop_result(self, stop_number, lat, lon, distance=None):
+        result = {
+            'stop_number': stop_number,
+            'name': self.get_stop_name(stop_number),
+            'lat': round(lat, 6),
+            'lon': round(lon, 6),
+        }
+        if distance is not None:
+            result['distance'] = round(distance)
+        return result
+
+    def get_nearby_stops(self, lat: float, lon: float, count: int = 10, max_distance: float = 1000):
+        # return up to `count` stops within `max_distance` metres of a point, closest first.
+        # Search outwards from the cell containing the point, one ring of cells at a time.
+        row, col = _grid_cell(lat, lon)
+        # every cell outside the rings searched so far is at least this far away per ring
+        cell_height = math.radians(GRID_SIZE) * EARTH_RADIUS
+        # Cells narrow towards the poles. Beyond NARROWEST_CELL_LATITUDE they are treated as no narrower,
+        # so that the search is bounded however close to a pole the point is.
+        ring_distance = cell_height * math.cos(math.radians(min(abs(lat), NARROWEST_CELL_LATITUDE)))
+        max_ring = math.ceil(max_distance / ring_distance) + 1
+        candidates = []
+        for ring in range(max_ring + 1):
+            for r in range(row - ring, row + ring + 1):
+                for c in range(col - ring, col + ring + 1):
+                    if max(abs(r - row), abs(c - col)) != ring:
+                        continue
+                    for stop_number, stop_lat, stop_lon in self._stops_in_cell(r, c):
+                        distance = _distance(lat, lon, stop_lat, stop_lon)
+                        if distance <= max_distance:
+                            candidates.append((distance, stop_number, stop_lat, stop_lon))
+            candidates.sort()
+            if ring * ring_distance >= max_distance:
+                break
+            if len(candidates) >= count and candidates[count - 1][0] <= ring * ring_distance:
+                break
+        return [self._stop_result(stop_number, stop_lat, stop_lon, distance) for distance, stop_number, stop_lat, stop_lon in candidates[:count]]
+
+    def get_stops_in_bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float):
+        # return all stops within a bounding box
+        min_row, min_col = _grid_cell(min_lat, min_lon)
+        max_row, max_col = _grid_cell(max_lat, max_lon)
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > MAX_GRID_CELLS:
+            raise ValueError("Bounding box is too large")
+        stops = []
+        for r in range(min_row, max_row + 1):
+            for c in range(min_col, max_col + 1):
+                for stop_number, stop_lat, stop_lon in self._stops_in_cell(r, c):
+                    if min_lat <= stop_lat <= max_lat and min_lon <= stop_lon <= max_lon:
+                        stops.append(self._stop_result(stop_number, stop_lat, stop_lon))
+        return stops
+
+    def get_arrivals_for_stops(self, stop_numbers: list, now: datetime, max_wait: datetime.timedelta):
+        # merge the upcoming arrivals at several stops into one list, tagging each with its stop
+        arrivals = []
+        for stop_number in stop_numbers:
+            for arrival in self.get_scheduled_arrivals(stop_number, now, max_wait):
+                arrival['stop_number'] = stop_number
+                arrivals.append(arrival)
+        arrivals.sort(key=lambda x: x['real_time_arrival'] or x['scheduled_arrival'])
+        return arrivals
+
+    def _is_service_running(self, trip_info: dict, date: datetime.date):
+        # Check if service is calendared to run on the given date
+        service_is_scheduled = \
+            trip_info['start_date'] <= date <= trip_info['end_date'] and \
+            trip_info['days'][date.weekday()]
+        calendar_exception = self.store.get('exception', f"{trip_info['service_id']}:{date}")
+        # check if there is a calendar exception
+        added = calendar_exception == 1
+        removed = calendar_exception == 2
+        return added or service_is_scheduled and not removed
+
+    def _is_live(self, scheduled_arrival: datetime, live_timestamp: int):
+        # whether the live data (taken at live_timestamp) is about the run of a trip that is
+        # scheduled to arrive at scheduled_arrival, rather than its run on another day
+        return bool(live_timestamp) and \
+            abs(scheduled_arrival.timestamp() - live_timestamp) < LIVE_DATA_HORIZON.total_seconds()
+
+    def _is_cancelled(self, trip_id: str, scheduled_arrival: datetime, live_timestamp: int):
+        cancelled_timestamp = self.store.get('live_cancelations', trip_id)
+        if cancelled_timestamp:
+            if live_timestamp and cancelled_timestamp < live_timestamp - 3600 * 24:
+                # clean it up if it's more than 24 hours older than the live data
+                self.store.delete('live_cancelations', trip_id)
+                return False
+            # the cancellation refers to the run closest to when it was reported
+            return self._is_live(scheduled_arrival, cancelled_timestamp)
+        return False
+
+    def _scheduled_stop_times(self, stop_number: str, start: datetime, end: datetime):
+        # yield (trip_id, trip_info, scheduled_arrival, stop_sequence) for every run of a trip that is
+        # calendared to arrive at a stop between start and end inclusive, in no particular order.
+        # Each service day that can overlap the window is resolved separately, in service-day seconds.
+        # Stop times are bucketed by service-day hour modulo 24, so a bucket holds the times of that
+        # hour on the service day and of the same hour after midnight, which are told apart by time.
+        with self._using_stop(stop_number):
+            service_date = start.date() - datetime.timedelta(days=MAX_SERVICE_DAY_SECONDS // 86400 - 1)
+            while service_date <= end.date():
+                midnight = datetime.datetime(service_date.year, service_date.month, service_date.day)
+                first_second = max(0, math.ceil((start - midnight).total_seconds()))
+                last_second = min(MAX_SERVICE_DAY_SECONDS - 1, math.floor((end - midnight).total_seconds()))
+                if first_second <= last_second:
+                    hours = range(first_second // 3600, last_second // 3600 + 1)
+                    for hour in sorted(set(hour % 24 for hour in hours)):
+                        for packed_stop_data in self.store.get('stop_times', f"{stop_number}:{hour}", []):
+                            trip_id, arrival_hour, arrival_min, arrival_sec, stop_sequence = self._unpack_stop_data(packed_stop_data)
+                            arrival_seconds = arrival_hour * 3600 + arrival_min * 60 + arrival_sec
+                            if not first_second <= arrival_seconds <= last_second:
+                                continue
+                            trip_info = self.get_trip_info(trip_id)
+                            if trip_info is None or not self._is_service_running(trip_info, service_date):
+                                continue
+                            yield trip_id, trip_info, midnight + datetime.timedelta(seconds=arrival_seconds), int(stop_sequence)
+                service_date += datetime.timedelta(days=1)
+
+    def get_arrivals_in_window(self, stop_number: str, start: datetime, end: datetime):
+        """
+        Return the arrivals at a stop that have not arrived by `start` and are expected by `end`,
+        ordered by expected arrival. `start` can be any time, past or future: live data is only
+        applied to runs of trips near the time it was taken.
+        """
+        live_timestamp = self.store.get('live_feed', 'timestamp')
+        arrivals = []
+        for trip_id, trip_info, scheduled_arrival, stop_sequence in self._scheduled_stop_times(stop_number, start - MAX_LATENESS, end + MAX_EARLINESS):
+            delay = None
+            if self._is_live(scheduled_arrival, live_timestamp):
+                if self._is_cancelled(trip_id, scheduled_arrival, live_timestamp):
                     continue
-                service_is_scheduled = \
-                    trip_info['start_date'] <= arrival_datetime.date() <= trip_info['end_date'] and \
-                    trip_info['days'][arrival_datetime.date().weekday()]
-                calendar_exception = self.store.get('exception', f"{trip_info['service_id']}:{arrival_datetime.date()}")
-                # check if there is a calendar exception
-                added = calendar_exception == 1
-                removed = calendar_exception == 2
-                if added or service_is_scheduled and not removed:
-                    delay = self._get_live_delay(trip_id, stop_sequence)
-                    cancelled_timestamp = self.store.get('live_cancelations', trip_id)
-                    if cancelled_timestamp:
-                        # if the trip has been cancelled in the last 24 hours, skip it
-                        if cancelled_timestamp > now.timestamp() - 3600 * 24:
-                            continue
-                        else:
-                            # clean it up if it's older than 24 hours
-                            self.store.delete('live_cancelations', trip_id)
-                    
-                    # We expect this arrival.
-                    arrival = {
-                        'route': trip_info['route'],
-                        'agency': trip_info['agency'],
-                        'headsign': trip_info['headsign'],
-                        'scheduled_arrival': arrival_datetime,
-                        'real_time_arrival': arrival_datetime + datetime.timedelta(seconds=delay) if delay is not None else None,
-                    }
-                    # if it has not already arrived, add it to the list.
-                    if arrival['scheduled_arrival'] > now or \
-                        (arrival['real_time_arrival'] and arrival['real_time_arrival'] > now):
-                        scheduled_arrivals.append(arrival)
-        
+                delay = self._get_live_delay(trip_id, stop_sequence)
+            real_time_arrival = scheduled_arrival + datetime.timedelta(seconds=delay) if delay is not None else None
+            # skip it if it has already arrived, or isn't expected in the window
+            if not (scheduled_arrival > start or (real_time_arrival and real_time_arrival > start)):
+                continue
+            if (real_time_arrival or scheduled_arrival) > end:
+                continue
+            arrivals.append({
+                'route': trip_info['route'],
+                'route_id': trip_info['route_id'],
+                'agency': trip_info['agency'],
+                'headsign': trip_info['headsign'],
+                'scheduled_arrival': scheduled_arrival,
+                'real_time_arrival': real_time_arrival,
+            })
+
         # add any added trips
         for added_trip in self.store.get('live_additions', stop_number, []):
-            # if the trip is in the past, skip it
-            if added_trip['arrival'] < now:
+            if not start <= added_trip['arrival'] <= end:
                 continue
             route_info = self.store.get('route', added_trip['route_id'])
             agency_name = self.store.get('agency', route_info['agency'])
-            scheduled_arrivals.append({
+            arrivals.append({
                 'route': route_info['name'],
+                'route_id': added_trip['route_id'],
                 'headsign': "",
                 'agency': agency_name,
                 'scheduled_arrival': added_trip['arrival'],
                 'real_time_arrival': added_trip['arrival'],
             })
-        scheduled_arrivals.sort(key=lambda x: x['real_time_arrival'] or x['scheduled_arrival'])
-        return scheduled_arrivals
+        arrivals.sort(key=lambda x: x['real_time_arrival'] or x['scheduled_arrival'])
+        return arrivals
+
+    def get_scheduled_arrivals(self, stop_number: str, now: datetime, max_wait: datetime.timedelta):
+        # get the arrivals at a stop that are expected in the next max_wait
+        return self.get_arrivals_in_window(stop_number, now, now + max_wait)
+
+    def get_trip_timeline(self, trip_id: str, service_date: datetime.date):
+        # return every stop of a trip on a given service day, in order, with live delays applied.
+        # Returns None if the trip is unknown.
+        midnight = datetime.datetime(service_date.year, service_date.month, service_date.day)
+        live_timestamp = self.store.get('live_feed', 'timestamp')
+        timeline = []
+        with self._using_trip(trip_id):
+            packed_trip_stops = self.store.get('trip_stops', trip_id)
+            if packed_trip_stops is None:
+                return None
+            for stop_number, arrival_seconds, stop_sequence in self._unpack_trip_stops(packed_trip_stops):
+                scheduled_arrival = midnight + datetime.timedelta(seconds=arrival_seconds)
+                delay = self._get_live_delay(trip_id, stop_sequence) if self._is_live(scheduled_arrival, live_timestamp) else None
+                timeline.append({
+                    'stop_number': stop_number,
+                    'stop_sequence': stop_sequence,
+                    'scheduled_arrival': scheduled_arrival,
+                    'real_time_arrival': scheduled_arrival + datetime.timedelta(seconds=delay) if delay is not None else None,
+                })
+        return timeline
+
+    def get_route_trips(self, route: str, now: datetime, max_wait: datetime.timedelta, agency: str = None):
+        # return the trips of a route (by name, e.g. "46A", and of one agency if given) that are running
+        # between now and now + max_wait, each with the stops it has yet to reach.
+        trips = []
+        live_timestamp = self.store.get('live_feed', 'timestamp')
+        trip_ids = [trip_id for route_id in self._route_ids(route, agency) for trip_id in self.store.get('route_trips', route_id, [])]
+        for trip_id in self._each_trip_in_use(trip_ids):
+            trip_info = self.get_trip_info(trip_id)
+            if trip_info is None:
+                continue
+            # trips that started yesterday can still be running after midnight
+            for service_date in (now.date() - datetime.timedelta(days=1), now.date()):
+                if not self._is_service_running(trip_info, service_date):
+                    continue
+                timeline = self.get_trip_timeline(trip_id, service_date)
+                if not timeline or self._is_cancelled(trip_id, timeline[0]['scheduled_arrival'], live_timestamp):
+                    continue
+                first_expected = timeline[0]['real_time_arrival'] or timeline[0]['scheduled_arrival']
+                if first_expected > now + max_wait:
+                    continue
+                upcoming = [stop for stop in timeline if (stop['real_time_arrival'] or stop['scheduled_arrival']) > now]
+                if upcoming:
+                    trips.append({
+                        'trip_id': trip_id,
+                        'route': trip_info['route'],
+                        'route_id': trip_info['route_id'],
+                        'headsign': trip_info['headsign'],
+                        'agency': trip_info['agency'],
+                        'stops': upcoming,
+                    })
+        trips.sort(key=lambda trip: trip['stops'][0]['real_time_arrival'] or trip['stops'][0]['scheduled_arrival'])
+        return trips
+
+    def get_route_headways(self, stop_number: str, now: datetime, max_wait: datetime.timedelta, route: str = None, agency: str = None):
+        # return, by route_id, for each route serving a stop (or only those with the name route, and of
+        # agency if given), its name and agency, the number of upcoming arrivals and the min, mean and
+        # max gap in seconds between them (None if there are fewer than two).
+        route_ids = set(self._route_ids(route, agency)) if route is not None else None
+        expected = collections.defaultdict(list)
+        routes = {}
+        for arrival in self.get_scheduled_arrivals(stop_number, now, max_wait):
+            if route_ids is not None and arrival['route_id'] not in route_ids:
+                continue
+            expected[arrival['route_id']].append(arrival['real_time_arrival'] or arrival['scheduled_arrival'])
+            routes[arrival['route_id']] = (arrival['route'], arrival['agency'])
+        headways = {}
+        for route_id, arrival_times in expected.items():
+            arrival_times.sort()
+            gaps = [(b - a).total_seconds() for a, b in zip(arrival_times, arrival_times[1:])]
+            headways[route_id] = {
+                'route': routes[route_id][0],
+                'agency': routes[route_id][1],
+                'arrivals': len(arrival_times),
+                'min_headway': min(gaps) if gaps else None,
+                'mean_headway': sum(gaps) / len(gaps) if gaps else None,
+                'max_headway': max(gaps) if gaps else None,
+            }
+        return headways
+
+    def iter_departures(self, service_date: datetime.date, shard: int = 0, shards: int = 1):
+        """
+        Yield a row (with EXPORT_FIELDS) for every scheduled arrival on a service day, stop by stop
+        and in time order within each stop. If shards > 1, only stops in the given shard (by a
+        hash of the stop number) are included.
+        """
+        # Each stop's hour buckets are read once, and each service and trip is resolved once for
+        # the day, so memory is bounded by one stop's arrivals plus the per-trip lookups.
+        midnight = datetime.datetime(service_date.year, service_date.month, service_date.day)
+        services = {}
+        trips = {}
+        stop_numbers = self.filter_stops if self.filter_stops else self.stops.stop_numbers()
+        for stop_number in sorted(stop_numbers):
+            if shards > 1 and zlib.crc32(_s2b(stop_number)) % shards != shard:
+                continue
+            stop_name = self.get_stop_name(stop_number)
+            rows = []
+            with self._using_stop(stop_number):
+                for hour in range(24):
+                    for packed_stop_data in self.store.get('stop_times', f"{stop_number}:{hour}", []):
+                        trip_id, arrival_hour, arrival_min, arrival_sec, stop_sequence = self._unpack_stop_data(packed_stop_data)
+                        if trip_id not in trips:
+                            trip_info = self.get_trip_info(trip_id)
+                            if trip_info is not None and trip_info['service_id'] not in services:
+                                services[trip_info['service_id']] = self._is_service_running(trip_info, service_date)
+                            if trip_info is None or not services[trip_info['service_id']]:
+                                trips[trip_id] = None
+                            else:
+                                trips[trip_id] = (trip_info['route'], trip_info['agency'], trip_info['headsign'])
+                        if trips[trip_id] is None:
+                            continue
+                        route, agency, headsign = trips[trip_id]
+                        arrival_seconds = arrival_hour * 3600 + arrival_min * 60 + arrival_sec
+                        rows.append((
+                            stop_number, stop_name, service_date.isoformat(),
+                            f"{arrival_hour:02}:{arrival_min:02}:{arrival_sec:02}",
+                            (midnight + datetime.timedelta(seconds=arrival_seconds)).isoformat(),
+                            route, agency, headsign, trip_id, stop_sequence,
+                        ))
+            # the arrival_time strings sort in time order, even past 24:00:00
+            rows.sort(key=lambda row: (row[3], row[4]))
+            yield from rows
+
+    def export_departures(self, service_date: datetime.date, path: str, fmt: str, shard: int = 0, shards: int = 1):
+        # write the departures of a service day to path ("-" for stdout) and return the number of rows
+        return write_departures(self.iter_departures(service_date, shard, shards), path, fmt)
+
+
+# Columns of exported departures. arrival_time is in GTFS form, relative to the start of the
+# service day, so can be 24:00:00 or later.
+EXPORT_FIELDS = ['stop_number', 'stop_name', 'service_date', 'arrival_time', 'scheduled_arrival',
+                 'route', 'agency', 'headsign', 'trip_id', 'stop_sequence']
+EXPORT_FORMATS = ['csv', 'ndjson', 'parquet']
+# Rows per Parquet row group
+EXPORT_BATCH_SIZE = 65536
+
+def write_departures(rows, path: str, fmt: str) -> int:
+    # stream rows (tuples with EXPORT_FIELDS) to a file in the given format, returning the row count
+    count = 0
+    if fmt == 'parquet':
+        if path == '-':
+            raise ValueError("Parquet can't be exported to stdout")
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet export requires the pyarrow package")
+        schema = pyarrow.schema([(field, pyarrow.int32() if field == 'stop_sequence' else pyarrow.string()) for field in EXPORT_FIELDS])
+        with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == EXPORT_BATCH_SIZE:
+                    writer.write_table(pyarrow.Table.from_pylist([dict(zip(EXPORT_FIELDS, row)) for row in batch], schema))
+                    count += len(batch)
+                    batch = []
+            if batch or not count:
+                writer.write_table(pyarrow.Table.from_pylist([dict(zip(EXPORT_FIELDS, row)) for row in batch], schema))
+                count += len(batch)
+        return count
+
+    f = sys.stdout if path == '-' else open(path, 'w', newline='')
+    try:
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_FIELDS)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        elif fmt == 'ndjson':
+            for row in rows:
+                f.write(json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False))
+                f.write('\n')
+                count += 1
+        else:
+            raise ValueError(f"Unknown export format {fmt}")
+    finally:
+        if f is not sys.stdout:
+            f.close()
+    return count
+
+# The engine that forked export workers share
+_export_engine = None
+
+def _export_shard(args):
+    service_date, path, fmt, shard, shards = args
+    return _export_engine.export_departures(service_date, path, fmt, shard, shards)
+
+def export_departures_in_parallel(engine, service_date: datetime.date, path: str, fmt: str, processes: int) -> list:
+    """
+    Export the departures of a service day across several processes, one shard of the stops each.
+    Shard i is written to "<path stem>-<i><suffix>". Returns the paths written. The workers are
+    forked, so that they share the loaded engine rather than each loading the cache.
+    """
+    global _export_engine
+    _export_engine = engine
+    stem, suffix = os.path.splitext(path)
+    jobs = [(service_date, f"{stem}-{shard}{suffix}", fmt, shard, processes) for shard in range(processes)]
+    import multiprocessing
+    with multiprocessing.get_context('fork').Pool(processes) as pool:
+        counts = pool.map(_export_shard, jobs)
+    logging.info(f"Exported {sum(counts)} departures in {processes} shards")
+    return [job[1] for job in jobs]
 
 
 CACHE_INFO_FILE = settings.DATA_DIR / "cache_info.txt"
+# The whole static feed, parsed and packed, which filtered datasets are cut from
+MASTER_FILE = settings.DATA_DIR / "master.pickle"
+# The master index split into partitions by stop, for loading on demand
+PARTITIONS_DIR = settings.DATA_DIR / "partitions"
+# Number of keys pickled together in the master index
+MASTER_CHUNK_SIZE = 10000
+# rows of stop_times.txt parsed at a time when building the master index, which bounds its memory use
+STOP_TIMES_BATCH_ROWS = 500000
+# Seconds to wait for the static data server when checking for new data
+STATIC_CHECK_TIMEOUT = 10
+# Namespaces holding live data rather than static data
+LIVE_NAMESPACES = ('live_delays', 'live_cancelations', 'live_additions', 'live_feed', 'live_vehicles', 'live_alerts')
+
 def write_cache_info(filter_stops):
     with open(CACHE_INFO_FILE, "w") as f:
         f.write(json.dumps({
@@ -504,25 +1339,79 @@ def check_cache_info(filter_stops):
         return False
     with open(CACHE_INFO_FILE, "r") as f:
         cache_info = json.load(f)
-        if cache_info.get('filter_stops') != sorted(list(filter_stops)) if filter_stops else None:
+        if cache_info.get('filter_stops') != (sorted(list(filter_stops)) if filter_stops else None):
             return False
     return True
 
+def _write_master_namespace(f, namespace, values):
+    # append a namespace to the master index as a series of (namespace, chunk) pickles
+    if isinstance(values, set):
+        pickle.dump((namespace, values), f)
+        return
+    _write_master_items(f, namespace, values.items())
+
+def _write_master_items(f, namespace, items):
+    # the same, for an iterable of (key, value) pairs
+    items = iter(items)
+    while True:
+        chunk = dict(itertools.islice(items, MASTER_CHUNK_SIZE))
+        if not chunk:
+            return
+        pickle.dump((namespace, chunk), f)
+
+def _write_run(path, values: dict):
+    # spill a dict of lists to a file, as chunks of (key, list) pairs sorted by key
+    with open(path, "wb") as f:
+        items = sorted(values.items())
+        for start in range(0, len(items), MASTER_CHUNK_SIZE):
+            pickle.dump(items[start:start + MASTER_CHUNK_SIZE], f)
+
+def _read_run(path):
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield from pickle.load(f)
+            except EOFError:
+                return
+
+def _merge_runs(paths):
+    # merge runs written by _write_run into one sorted stream of (key, list) pairs, joining the lists
+    # of a key in the order of the runs
+    merged = heapq.merge(*(_read_run(path) for path in paths), key=lambda item: item[0])
+    for key, items in itertools.groupby(merged, key=lambda item: item[0]):
+        values = []
+        for _, run_values in items:
+            values.extend(run_values)
+        yield key, values
+
+def read_master_index():
+    # yield (namespace, chunk) pairs from the master index, where chunk is a dict or a set
+    with open(MASTER_FILE, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def has_static_data():
+    return os.path.exists(settings.DATA_DIR / "timestamp.txt")
 
 def check_for_new_static_data():
-    if not os.path.exists(settings.DATA_DIR / "timestamp.txt"):
+    import urllib.request
+    if not has_static_data():
         return True
     else:
         with open(settings.DATA_DIR / "timestamp.txt", "r") as f:
             timestamp = datetime.datetime.fromisoformat(f.read())
             try:
                 with urllib.request.urlopen(
-                    urllib.request.Request(settings.GTFS_STATIC_URL, method="HEAD")
+                    urllib.request.Request(settings.GTFS_STATIC_URL, method="HEAD"), timeout=STATIC_CHECK_TIMEOUT
                 ) as response:
                     last_modified_datetime = datetime.datetime.strptime(response.headers['Last-Modified'], '%a, %d %b %Y %H:%M:%S %Z')
                     if last_modified_datetime > timestamp:
                         return True
-            except urllib.error.URLError as e:
+            except (urllib.error.URLError, TimeoutError) as e:
                 logging.error(f"Error checking for new static data: {e}")
             
     return False
@@ -555,9 +1444,10 @@ def download_static_data():
                     # Write the last modified date of the GTFS file to timestamp.txt
                     last_modified_datetime = datetime.datetime.strptime(response.headers['Last-Modified'], '%a, %d %b %Y %H:%M:%S %Z')
                     f.write(last_modified_datetime.isoformat())
-                # remove the cache file
-                if os.path.exists(store.CACHE_FILE):
-                    os.remove(store.CACHE_FILE)
+                # remove the cache file and the master index it was cut from
+                for file in (store.CACHE_FILE, MASTER_FILE):
+                    if os.path.exists(file):
+                        os.remove(file)
         logging.info("Finished downloading static GTFS data.")
     except urllib.error.URLError as e:
         logging.error(f"Error downloading static GTFS data: {e}")
@@ -571,7 +1461,7 @@ def make_base_arg_parser(description):
     parser.add_argument('-k', '--api-key', type=str, default=settings.API_KEY,
                         help=f"Your API key for the live GTFS feed")
     parser.add_argument('-r', '--redis', type=str, default=settings.REDIS_URL,
-                        help=f"URL of a redis instance to use as a data store backend (default: {settings.REDIS_URL})")
+                        help=f"URL of a data store backend: a redis instance (redis://), SQLite file (sqlite:///) or LMDB directory (lmdb:///) (default: {settings.REDIS_URL or settings.STORE_URL})")
     parser.add_argument('-m', '--minutes', type=int, default=settings.MAX_MINUTES,
                         help=f"Maximum minutes in the future to return results for (default: {settings.MAX_MINUTES})")
     parser.add_argument('-f', '--filter', type=str, default=None,
@@ -592,6 +1482,18 @@ if __name__ == "__main__":
                         help='Download and extract the static GTFS archive and exit')
     parser.add_argument('--rebuild-cache', action='store_true',default=False,
                         help="Ignore cached GTFS data and load static data from scratch")
+    parser.add_argument('--export', type=str, default=None, metavar='DATE',
+                        help="Export every departure on a service day (YYYY-MM-DD, or 'today') and exit")
+    parser.add_argument('--export-format', type=str, choices=EXPORT_FORMATS, default='csv',
+                        help="Format of exported departures (default: csv)")
+    parser.add_argument('--output', type=str, default='-',
+                        help="File to export departures to (default: stdout)")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Export in this many processes, each writing a shard of the stops to its own file (default: 1)")
+    parser.add_argument('--shard', type=str, default=None, metavar='I/N',
+                        help="Only export shard I of N of the stops, for spreading an export across machines")
+    parser.add_argument('--partitions', type=int, default=settings.PARTITIONS,
+                        help=f"Split the static data into this many partitions by stop, loaded as their stops are queried. 0 loads everything at startup (default: {settings.PARTITIONS})")
     parser.add_argument('stop_numbers', metavar='stop numbers', type=str, nargs='*',
                         help='Stop numbers to query (as shown on the bus stop)')
     args = parser.parse_args()
@@ -601,7 +1503,7 @@ if __name__ == "__main__":
     if args.download:
         download_static_data()
     
-    if not args.api_key:
+    if not args.api_key and not args.export:
         logging.error("No API key provided. Exiting.")
         sys.exit(1)
     filter_stops = settings.FILTER_STOPS
@@ -613,9 +1515,24 @@ if __name__ == "__main__":
         redis_url=args.redis,
         rebuild_cache=args.rebuild_cache,
         filter_stops=filter_stops,
-        profile_memory=args.profile
+        profile_memory=args.profile,
+        partitions=args.partitions,
+        partition_memory_mb=settings.PARTITION_MEMORY_MB,
     )
 
+    if args.export:
+        service_date = datetime.date.today() if args.export == 'today' else datetime.date.fromisoformat(args.export)
+        if args.processes > 1:
+            if args.output == '-':
+                logging.error("--processes needs an --output file to write shards next to.")
+                sys.exit(1)
+            export_departures_in_parallel(gtfs, service_date, args.output, args.export_format, args.processes)
+        else:
+            shard, shards = (int(x) for x in args.shard.split('/')) if args.shard else (0, 1)
+            count = gtfs.export_departures(service_date, args.output, args.export_format, shard, shards)
+            logging.info(f"Exported {count} departures")
+        sys.exit(0)
+
     logging.info("Updating from live feed.")
     gtfs.refresh_live_data()
     logging.info("Live feed loaded.")
@@ -0,0 +1,237 @@
+# Minimal reader for the protobuf wire format of GTFS-R feeds.
+#
+# Decoding a whole FeedMessage builds python objects for every vehicle in the country. When we only
+# care about a few trips, it is much cheaper to walk the raw bytes, peek at the trip_id of each
+# entity, and only hand the matching entities to the real protobuf decoder.
+# See https://protobuf.dev/programming-guides/encoding/ and https://gtfs.org/realtime/proto/
+
+# wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# field numbers of the messages we look inside
+FEED_MESSAGE_HEADER = 1
+FEED_MESSAGE_ENTITY = 2
+FEED_HEADER_INCREMENTALITY = 2
+FEED_HEADER_TIMESTAMP = 3
+FEED_ENTITY_ID = 1
+FEED_ENTITY_IS_DELETED = 2
+FEED_ENTITY_TRIP_UPDATE = 3
+FEED_ENTITY_VEHICLE = 4
+FEED_ENTITY_ALERT = 5
+TRIP_UPDATE_TRIP = 1
+TRIP_UPDATE_STOP_TIME_UPDATE = 2
+STOP_TIME_UPDATE_STOP_ID = 4
+TRIP_DESCRIPTOR_TRIP_ID = 1
+TRIP_DESCRIPTOR_ROUTE_ID = 5
+VEHICLE_POSITION_TRIP = 1
+VEHICLE_POSITION_STOP_ID = 7
+ALERT_INFORMED_ENTITY = 5
+ENTITY_SELECTOR_ROUTE_ID = 2
+ENTITY_SELECTOR_TRIP = 4
+ENTITY_SELECTOR_STOP_ID = 5
+
+# FeedHeader.incrementality values
+FULL_DATASET = 0
+DIFFERENTIAL = 1
+
+
+def read_varint(buf, pos):
+    # decode a base 128 varint starting at pos, returning its value and the position after it
+    b = buf[pos]
+    if b < 0x80:
+        return b, pos + 1
+    result, shift = b & 0x7f, 7
+    while True:
+        pos += 1
+        b = buf[pos]
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos + 1
+        shift += 7
+
+
+def iter_fields(buf, pos=0, end=None):
+    # yield (field_number, wire_type, value) for each field of the message in buf[pos:end]. Varints
+    # and fixed width fields are returned as ints, and length-delimited fields as (start, end) offsets
+    # into buf, so that nothing is copied.
+    if end is None:
+        end = len(buf)
+    while pos < end:
+        tag, pos = read_varint(buf, pos)
+        field_number, wire_type = tag >> 3, tag & 7
+        if wire_type == LENGTH_DELIMITED:
+            length, pos = read_varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == VARINT:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == FIXED64:
+            value = int.from_bytes(buf[pos:pos + 8], 'little')
+            pos += 8
+        elif wire_type == FIXED32:
+            value = int.from_bytes(buf[pos:pos + 4], 'little')
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        yield field_number, wire_type, value
+
+
+def find_field(buf, pos, end, field_number):
+    # return the value of the first occurrence of a field in buf[pos:end], or None. Encoders write
+    # singular fields once, so we can stop at the first match rather than scanning the whole message.
+    # This is the hot loop when filtering a feed, so it skips fields inline rather than going
+    # through iter_fields.
+    while pos < end:
+        tag, pos = read_varint(buf, pos)
+        wire_type = tag & 7
+        if wire_type == LENGTH_DELIMITED:
+            length, pos = read_varint(buf, pos)
+            if tag >> 3 == field_number:
+                return pos, pos + length
+            pos += length
+        elif wire_type == VARINT:
+            value, pos = read_varint(buf, pos)
+            if tag >> 3 == field_number:
+                return value
+        elif wire_type == FIXED64 or wire_type == FIXED32:
+            width = 8 if wire_type == FIXED64 else 4
+            if tag >> 3 == field_number:
+                return int.from_bytes(buf[pos:pos + width], 'little')
+            pos += width
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+    return None
+
+
+def feed_timestamp(buf):
+    buf = memoryview(buf)
+    header = find_field(buf, 0, len(buf), FEED_MESSAGE_HEADER)
+    if header is None:
+        return 0
+    return find_field(buf, *header, FEED_HEADER_TIMESTAMP) or 0
+
+
+def iter_entities(buf):
+    # yield (start, end) offsets of each FeedEntity in a raw FeedMessage, without decoding them
+    buf = memoryview(buf)
+    for field_number, wire_type, value in iter_fields(buf):
+        if field_number == FEED_MESSAGE_ENTITY and wire_type == LENGTH_DELIMITED:
+            yield value
+
+
+def entity_trip_id(buf, start, end):
+    # return the trip_id of the trip_update in the raw FeedEntity at buf[start:end], or None if the
+    # entity is not a trip update
+    buf = memoryview(buf)
+    trip_update = find_field(buf, start, end, FEED_ENTITY_TRIP_UPDATE)
+    if trip_update is None:
+        return None
+    trip = find_field(buf, *trip_update, TRIP_UPDATE_TRIP)
+    if trip is None:
+        return ""
+    trip_id = find_field(buf, *trip, TRIP_DESCRIPTOR_TRIP_ID)
+    if trip_id is None:
+        return ""
+    return bytes(buf[trip_id[0]:trip_id[1]]).decode('utf-8')
+
+
+def _string(buf, span):
+    return bytes(buf[span[0]:span[1]]).decode('utf-8')
+
+
+def _trip_descriptor_ids(buf, start, end, trip_ids, route_ids):
+    trip_id = find_field(buf, start, end, TRIP_DESCRIPTOR_TRIP_ID)
+    if trip_id is not None:
+        trip_ids.add(_string(buf, trip_id))
+    route_id = find_field(buf, start, end, TRIP_DESCRIPTOR_ROUTE_ID)
+    if route_id is not None:
+        route_ids.add(_string(buf, route_id))
+
+
+def entity_references(buf, start, end):
+    """
+    Return (entity id, trip_ids, route_ids, stop_ids) of the raw FeedEntity at buf[start:end]: the
+    trips, routes and stops that a trip update, vehicle position or alert refers to.
+    """
+    buf = memoryview(buf)
+    entity_id, trip_ids, route_ids, stop_ids = "", set(), set(), set()
+    for field_number, wire_type, value in iter_fields(buf, start, end):
+        if wire_type != LENGTH_DELIMITED:
+            continue
+        if field_number == FEED_ENTITY_ID:
+            entity_id = _string(buf, value)
+        elif field_number == FEED_ENTITY_TRIP_UPDATE:
+            for inner_field, _, inner in iter_fields(buf, *value):
+                if inner_field == TRIP_UPDATE_TRIP:
+                    _trip_descriptor_ids(buf, *inner, trip_ids, route_ids)
+                elif inner_field == TRIP_UPDATE_STOP_TIME_UPDATE:
+                    stop_id = find_field(buf, *inner, STOP_TIME_UPDATE_STOP_ID)
+                    if stop_id is not None:
+                        stop_ids.add(_string(buf, stop_id))
+        elif field_number == FEED_ENTITY_VEHICLE:
+            trip = find_field(buf, *value, VEHICLE_POSITION_TRIP)
+            if trip is not None:
+                _trip_descriptor_ids(buf, *trip, trip_ids, route_ids)
+            stop_id = find_field(buf, *value, VEHICLE_POSITION_STOP_ID)
+            if stop_id is not None:
+                stop_ids.add(_string(buf, stop_id))
+        elif field_number == FEED_ENTITY_ALERT:
+            for inner_field, inner_type, inner in iter_fields(buf, *value):
+                if inner_field != ALERT_INFORMED_ENTITY or inner_type != LENGTH_DELIMITED:
+                    continue
+                for selector_field, selector_type, selector in iter_fields(buf, *inner):
+                    if selector_type != LENGTH_DELIMITED:
+                        continue
+                    if selector_field == ENTITY_SELECTOR_ROUTE_ID:
+                        route_ids.add(_string(buf, selector))
+                    elif selector_field == ENTITY_SELECTOR_STOP_ID:
+                        stop_ids.add(_string(buf, selector))
+                    elif selector_field == ENTITY_SELECTOR_TRIP:
+                        _trip_descriptor_ids(buf, *selector, trip_ids, route_ids)
+    return entity_id, trip_ids, route_ids, stop_ids
+
+
+def iter_field_spans(buf, pos=0, end=None):
+    # yield (field_number, start, end) of each whole field (tag included) of the message in buf[pos:end],
+    # for copying fields into another message unchanged
+    if end is None:
+        end = len(buf)
+    while pos < end:
+        start = pos
+        tag, pos = read_varint(buf, pos)
+        wire_type = tag & 7
+        if wire_type == LENGTH_DELIMITED:
+            length, pos = read_varint(buf, pos)
+            pos += length
+        elif wire_type == VARINT:
+            _, pos = read_varint(buf, pos)
+        elif wire_type == FIXED64:
+            pos += 8
+        elif wire_type == FIXED32:
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        yield tag >> 3, start, pos
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def encode_varint_field(field_number: int, value: int) -> bytes:
+    return encode_varint(field_number << 3 | VARINT) + encode_varint(value)
+
+
+def encode_bytes_field(field_number: int, data) -> bytes:
+    # a length-delimited field: a string, bytes or an encoded sub-message
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return encode_varint(field_number << 3 | LENGTH_DELIMITED) + encode_varint(len(data)) + bytes(data)
@@ -0,0 +1,174 @@
+# Polling of the live GTFS-R feeds.
+#
+# Each feed (TripUpdates, and optionally VehiclePositions and ServiceAlerts) is polled on its own
+# schedule by its own thread, which also parses what it fetches. A slow or failing feed never holds up
+# another, and queries are answered from the data last loaded while a feed is being fetched and parsed.
+# A feed that fails, or is rate limited, is polled exponentially less often until it recovers, up to
+# MAX_BACKOFF times its period. A response bigger than the feed's byte budget is dropped unread.
+import time
+import logging
+import threading
+
+import tracing
+
+# most times a feed's period to wait between polls while it keeps failing
+MAX_BACKOFF = 32
+# seconds to wait for a feed to respond
+FETCH_TIMEOUT = 30
+
+
+class FeedError(Exception):
+    pass
+
+
+def fetch(url: str, api_key: str, max_bytes: int = None, timeout: float = FETCH_TIMEOUT) -> bytes:
+    """
+    Fetch a feed. Raises urllib.error.HTTPError or URLError if the request fails, and FeedError if
+    the response is bigger than max_bytes.
+    """
+    import urllib.request
+    req = urllib.request.Request(url, None, {
+        'x-api-key': api_key,
+        'Cache-Control': 'no-cache'
+    })
+    with urllib.request.urlopen(req, timeout=timeout) as f:
+        length = f.headers.get('Content-Length')
+        if max_bytes and length and length.isdigit() and int(length) > max_bytes:
+            raise FeedError(f"response of {int(length)} bytes is over the budget of {max_bytes}")
+        buf = f.read(max_bytes + 1) if max_bytes else f.read()
+    if max_bytes and len(buf) > max_bytes:
+        raise FeedError(f"response is over the budget of {max_bytes} bytes")
+    return buf
+
+
+class Feed:
+    """
+    A live feed to poll every `period` seconds. handler is called with each FeedMessage fetched.
+    """
+    def __init__(self, name: str, url: str, period: float, handler, max_bytes: int = None):
+        self.name = name
+        self.url = url
+        self.period = period
+        self.handler = handler
+        self.max_bytes = max_bytes
+
+
+class Poller:
+    """
+    Polls one feed in a thread of its own. on_update is called after each feed loaded, and traces
+    (a tracing.Recorder) is given a trace of each poll if set.
+    """
+    def __init__(self, feed: Feed, api_key: str, on_update=None, traces=None):
+        self.feed = feed
+        self.api_key = api_key
+        self.on_update = on_update
+        self.traces = traces
+        self.backoff = 1
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.polls = self.failures = self.rate_limited = self.oversized = self.bytes = 0
+        self.last_loaded = self.last_error = self.last_seconds = None
+
+    def poll(self) -> float:
+        """
+        Fetch and load the feed once. Returns the seconds to wait before the next poll.
+        """
+        import urllib.error
+        if self.traces is not None:
+            tracing.start(f"{self.feed.name} refresh")
+        start_time = time.monotonic()
+        error = None
+        try:
+            buf = fetch(self.feed.url, self.api_key, self.feed.max_bytes)
+            self.feed.handler(buf)
+        except urllib.error.HTTPError as e:
+            error = f"HTTP {e.code}"
+            if e.code == 429:
+                with self.lock:
+                    self.rate_limited += 1
+        except FeedError as e:
+            error = str(e)
+            with self.lock:
+                self.oversized += 1
+        except (urllib.error.URLError, OSError) as e:
+            error = str(e)
+        except Exception as e:
+            # a feed that can't be parsed mustn't stop it being polled
+            logging.exception(f"Error loading the {self.feed.name} feed")
+            error = repr(e)
+        with self.lock:
+            self.polls += 1
+            self.last_seconds = time.monotonic() - start_time
+            if error is None:
+                self.bytes += len(buf)
+                self.last_loaded = time.time()
+                self.backoff = 1
+            else:
+                self.failures += 1
+                self.last_error = error
+                self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+            wait = self.feed.period * self.backoff
+        if error is not None:
+            logging.warning(f"Error polling the {self.feed.name} feed: {error}. Polling again in {wait:.0f}s.")
+        elif self.on_update is not None:
+            try:
+                self.on_update(self.feed)
+            except Exception:
+                logging.exception(f"Error updating after the {self.feed.name} feed")
+        if self.traces is not None:
+            self.traces.record(tracing.stop())
+        return wait
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(self.poll())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f"{self.feed.name} poller", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'url': self.feed.url,
+                'period': self.feed.period,
+                'backoff': self.backoff,
+                'polls': self.polls,
+                'failures': self.failures,
+                'rate_limited': self.rate_limited,
+                'oversized': self.oversized,
+                'bytes': self.bytes,
+                'last_loaded': self.last_loaded,
+                'last_error': self.last_error,
+                'last_seconds': round(self.last_seconds, 3) if self.last_seconds is not None else None,
+            }
+
+
+class Ingester:
+    """
+    Polls a set of feeds concurrently. on_update(feed) is called after any of them is loaded, never
+    by two pollers at once.
+    """
+    def __init__(self, feeds: list, api_key: str, on_update=None, traces=None):
+        self.update_lock = threading.Lock()
+        self.on_update = on_update
+        self.pollers = [Poller(feed, api_key, self._updated if on_update is not None else None, traces) for feed in feeds]
+
+    def _updated(self, feed: Feed):
+        with self.update_lock:
+            self.on_update(feed)
+
+    def start(self):
+        for poller in self.pollers:
+            poller.start()
+
+    def stop(self):
+        for poller in self.pollers:
+            poller.stop()
+
+    def stats(self) -> dict:
+        return {poller.feed.name: poller.stats() for poller in self.pollers}
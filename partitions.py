@@ -0,0 +1,254 @@
+# Static data split into partitions by stop, loaded on demand.
+#
+# A deployment that serves a handful of stops, not known in advance, needn't hold the schedule of the
+# whole network. The master index is split by a hash of the stop number: each partition file holds
+# the stop times of its stops, and the trips (and trip timelines) serving them. Everything else
+# (stops, routes, calendars) is small, and goes into a base file that is loaded at startup.
+#
+# A partition is loaded into the store the first time one of its stops is queried. When the loaded
+# partitions take more than a memory budget, the least recently used are dropped. A trip serving
+# stops in several partitions is loaded once and counted, so that it stays while any of them is.
+#
+#   <directory>/info.json       the number of partitions
+#   <directory>/base.pickle     a stream of (namespace, chunk) pickles, like the master index
+#   <directory>/<n>.pickle      the same, for partition n
+import os
+import json
+import zlib
+import pickle
+import shutil
+import logging
+import threading
+import collections
+
+import size
+
+# namespaces split between partitions. The rest go into the base file.
+PARTITIONED_NAMESPACES = ('stop_times', 'trip', 'trip_stops')
+# namespace of the base file mapping each trip to a partition holding it
+TRIP_PARTITION = 'trip_partition'
+BASE_FILE = "base.pickle"
+INFO_FILE = "info.json"
+
+
+def partition_of(stop_number: str, shards: int) -> int:
+    return zlib.crc32(stop_number.encode('utf-8')) % shards
+
+
+def _read_chunks(path):
+    # yield the (namespace, chunk) pickles of a file
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def exists(directory, shards: int) -> bool:
+    # whether the directory holds a complete set of `shards` partitions
+    try:
+        with open(os.path.join(directory, INFO_FILE), "r") as f:
+            return json.load(f)['shards'] == shards
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def write_partitions(chunks, directory, shards: int, trips_in_stop_times):
+    """
+    Split (namespace, chunk) pairs read from the master index into `shards` partitions. stop_times
+    must come before trip and trip_stops. trips_in_stop_times returns the trip_ids of a stop_times
+    value.
+    """
+    tmp_directory = f"{directory}.tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    files = {}
+    # trip_id -> partitions with stop times of the trip
+    trip_partitions = collections.defaultdict(set)
+    try:
+        base = open(os.path.join(tmp_directory, BASE_FILE), "wb")
+        files[None] = base
+        for namespace, chunk in chunks:
+            if namespace not in PARTITIONED_NAMESPACES:
+                pickle.dump((namespace, chunk), base)
+                continue
+            by_partition = collections.defaultdict(dict)
+            for key, value in chunk.items():
+                if namespace == 'stop_times':
+                    # keys are "<stop_number>:<hour>"
+                    partition = partition_of(key.rsplit(':', 1)[0], shards)
+                    by_partition[partition][key] = value
+                    for trip_id in trips_in_stop_times(value):
+                        trip_partitions[trip_id].add(partition)
+                else:
+                    for partition in trip_partitions.get(key, ()):
+                        by_partition[partition][key] = value
+            for partition, values in by_partition.items():
+                if partition not in files:
+                    files[partition] = open(os.path.join(tmp_directory, f"{partition}.pickle"), "wb")
+                pickle.dump((namespace, values), files[partition])
+        # trips looked up directly (rather than through a stop) are loaded with one partition holding them
+        pickle.dump((TRIP_PARTITION, {trip_id: min(partitions) for trip_id, partitions in trip_partitions.items()}), base)
+    finally:
+        for f in files.values():
+            f.close()
+    with open(os.path.join(tmp_directory, INFO_FILE), "w") as f:
+        json.dump({'shards': shards}, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+
+
+class _Pin:
+    # keeps a partition loaded until exited
+    def __init__(self, cache, partition):
+        self.cache = cache
+        self.partition = partition
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.partition is not None:
+            self.cache._unpin(self.partition)
+            self.partition = None
+
+
+class PartitionCache:
+    """
+    Loads partitions into a store as their stops and trips are asked for, and drops the least
+    recently used when those loaded take more than memory_budget bytes. A partition is pinned while a
+    query uses it, and pinned partitions are never dropped, so the budget can be exceeded while more
+    partitions than fit in it are in use.
+    """
+    def __init__(self, directory, store, memory_budget: int):
+        self.directory = directory
+        self.store = store
+        self.memory_budget = memory_budget
+        with open(os.path.join(directory, INFO_FILE), "r") as f:
+            self.shards = json.load(f)['shards']
+        # partition -> (stop_times keys, trip_ids, size in bytes), least recently used first
+        self.loaded = collections.OrderedDict()
+        # partition -> number of queries using it
+        self.pins = collections.Counter()
+        # trip_id -> number of loaded partitions holding it
+        self.trip_refs = collections.Counter()
+        self.memory_used = 0
+        self.lock = threading.Lock()
+        self.hits = self.loads = self.evictions = 0
+
+    def load_base(self):
+        for namespace, chunk in _read_chunks(os.path.join(self.directory, BASE_FILE)):
+            if isinstance(chunk, set):
+                for value in chunk:
+                    self.store.add(namespace, value)
+                continue
+            for key, value in chunk.items():
+                self.store.set(namespace, key, value)
+
+    def pin_stop(self, stop_number: str) -> _Pin:
+        """
+        Load the stop times of a stop (and the trips serving it), and keep them loaded until the
+        returned pin is exited:
+
+            with partitions.pin_stop(stop_number):
+                ...
+        """
+        return self._pin(partition_of(stop_number, self.shards))
+
+    def pin_trip(self, trip_id: str, load: bool = True) -> _Pin:
+        # the same for a trip and its timeline. With load=False, the trip is only pinned if its
+        # partition is loaded already.
+        partition = self.store.get(TRIP_PARTITION, trip_id)
+        if partition is None:
+            return _Pin(self, None)
+        return self._pin(partition, load)
+
+    def pin_partition(self, partition) -> _Pin:
+        # the same for a partition, as grouped by group_trips. None pins nothing.
+        return self._pin(partition) if partition is not None else _Pin(self, None)
+
+    def group_trips(self, trip_ids) -> dict:
+        # trip_ids grouped by the partition holding them (None for trips in no partition)
+        groups = collections.defaultdict(list)
+        for trip_id in trip_ids:
+            groups[self.store.get(TRIP_PARTITION, trip_id)].append(trip_id)
+        return groups
+
+    def _pin(self, partition: int, load: bool = True) -> _Pin:
+        with self.lock:
+            if partition in self.loaded:
+                self.loaded.move_to_end(partition)
+                self.hits += 1
+            elif load:
+                self._load(partition)
+            else:
+                return _Pin(self, None)
+            self.pins[partition] += 1
+            self._evict()
+        return _Pin(self, partition)
+
+    def _unpin(self, partition: int):
+        with self.lock:
+            self.pins[partition] -= 1
+            if not self.pins[partition]:
+                del self.pins[partition]
+            self._evict()
+
+    def _evict(self):
+        # drop the least recently used partitions not in use until within the budget, always keeping
+        # the most recently used. Must be called with the lock held.
+        while self.memory_used > self.memory_budget and len(self.loaded) > 1:
+            partition = next((partition for partition in self.loaded if not self.pins[partition]), None)
+            if partition is None or partition == next(reversed(self.loaded)):
+                return
+            self._unload(partition)
+            self.evictions += 1
+
+    def _load(self, partition: int):
+        path = os.path.join(self.directory, f"{partition}.pickle")
+        stop_times_keys, trip_ids, size_bytes = [], set(), 0
+        if os.path.exists(path):
+            for namespace, chunk in _read_chunks(path):
+                size_bytes += size.total_size(chunk)
+                for key, value in chunk.items():
+                    if namespace == 'stop_times':
+                        stop_times_keys.append(key)
+                        self.store.set(namespace, key, value)
+                    else:
+                        trip_ids.add(key)
+                        # trips already loaded by another partition are shared
+                        if not self.trip_refs.get(key):
+                            self.store.set(namespace, key, value)
+        for trip_id in trip_ids:
+            self.trip_refs[trip_id] += 1
+        self.loaded[partition] = (stop_times_keys, trip_ids, size_bytes)
+        self.memory_used += size_bytes
+        self.loads += 1
+        logging.debug(f"Loaded partition {partition} ({len(stop_times_keys)} stop hours, {len(trip_ids)} trips, {size_bytes / 1024:.0f} KB)")
+
+    def _unload(self, partition: int):
+        stop_times_keys, trip_ids, size_bytes = self.loaded.pop(partition)
+        for key in stop_times_keys:
+            self.store.delete('stop_times', key)
+        for trip_id in trip_ids:
+            self.trip_refs[trip_id] -= 1
+            if not self.trip_refs[trip_id]:
+                del self.trip_refs[trip_id]
+                self.store.delete('trip', trip_id)
+                self.store.delete('trip_stops', trip_id)
+        self.memory_used -= size_bytes
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'shards': self.shards,
+                'loaded': len(self.loaded),
+                'pinned': len(self.pins),
+                'trips': len(self.trip_refs),
+                'memory_used': self.memory_used,
+                'memory_budget': self.memory_budget,
+                'hits': self.hits,
+                'loads': self.loads,
+                'evictions': self.evictions,
+            }
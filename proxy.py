@@ -0,0 +1,193 @@
+# The client used by a public node (ROLE=public) to call its core upstream.
+#
+# Calls go through one keep-alive session with a pool of connections. Responses are cached for a few
+# seconds, and identical calls made while one is in progress share it, so a spike of requests at the
+# edge becomes a trickle at the core. If the core fails, the last response for the same call is served
+# for a while longer, flagged as stale. After repeated failures a circuit breaker stops calling the core
+# for a cool-off period, so that a struggling core isn't kept busy and requests fail fast.
+import time
+import logging
+import threading
+import collections
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import singleflight
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class UpstreamRejected(UpstreamError):
+    """
+    The upstream refused the request itself (a 4xx other than 429), so its answer is passed on
+    as it is rather than served stale or reported as an outage.
+    """
+    def __init__(self, status_code: int, body: bytes, content_type: str = None):
+        super().__init__(f"upstream returned {status_code}")
+        self.status_code = status_code
+        self.body = body
+        self.content_type = content_type
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, refusing calls for `reset_timeout` seconds.
+    Then one trial call is let through (half open): success closes the breaker, failure opens it again.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.times_opened = 0
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def retry_after(self) -> float:
+        # seconds until a call will be let through again
+        if self.opened_at is None:
+            return 0
+        return max(0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def allow(self) -> bool:
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.trial_in_progress:
+                self.trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            # a failed trial opens the breaker again
+            if self.trial_in_progress or (self.opened_at is None and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+            self.trial_in_progress = False
+
+
+class Upstream:
+    """
+    A pooled, cached and circuit broken client of a core node's API.
+    """
+    def __init__(self, base_url: str, api_key: str, ttl: float = 10, stale_ttl: float = 600, timeout: float = 3,
+                 failure_threshold: int = 5, reset_timeout: float = 30, pool_size: int = 32, maxsize: int = 4096,
+                 session: requests.Session = None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timeout = timeout
+        self.maxsize = maxsize
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.flights = singleflight.SingleFlight(timeout)
+        # (path, params) -> (time fetched, decoded JSON), least recently used first
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.fetches = self.stale_served = self.failures = 0
+
+    def get(self, path: str, params: dict):
+        """
+        Return (decoded JSON, status) for a GET of path with params. The JSON is None if the upstream
+        failed and nothing recent enough was cached. status is a dict with:
+         - stale: whether the JSON is an older response, served because the upstream failed
+         - age: seconds since the JSON was fetched
+         - error: why the upstream failed, if it did
+         - rejected: the UpstreamRejected, if the upstream refused the request
+        """
+        key = (path, tuple(sorted(params.items())))
+        cached = self._cached(key)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            with self.lock:
+                self.hits += 1
+            return cached[1], {'stale': False, 'age': time.monotonic() - cached[0]}
+        try:
+            data = self.flights.do(key, self._fetch, path, params)
+        except UpstreamRejected as e:
+            return None, {'stale': False, 'age': None, 'error': str(e), 'rejected': e}
+        except UpstreamError as e:
+            with self.lock:
+                self.failures += 1
+                if cached is not None and time.monotonic() - cached[0] < self.stale_ttl:
+                    self.stale_served += 1
+                    return cached[1], {'stale': True, 'age': time.monotonic() - cached[0], 'error': str(e)}
+            return None, {'stale': False, 'age': None, 'error': str(e)}
+        return data, {'stale': False, 'age': 0}
+
+    def _cached(self, key):
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+            return cached
+
+    def _fetch(self, path: str, params: dict):
+        key = (path, tuple(sorted(params.items())))
+        if not self.breaker.allow():
+            raise UpstreamError(f"circuit open, retrying in {self.breaker.retry_after():.0f}s")
+        with self.lock:
+            self.fetches += 1
+        try:
+            r = self.session.get(f"{self.base_url}{path}", params=params, headers={"x-api-key": self.api_key}, timeout=self.timeout)
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            logging.warning(f"Upstream call failed: {e}")
+            raise UpstreamError(str(e))
+        if r.status_code != 200:
+            logging.warning(f"Upstream error: {r.status_code} {r.text[:200]}")
+            if r.status_code >= 500 or r.status_code == 429:
+                self.breaker.record_failure()
+                raise UpstreamError(f"upstream returned {r.status_code}")
+            # errors in the request itself say nothing about the health of the upstream
+            self.breaker.record_success()
+            raise UpstreamRejected(r.status_code, r.content, r.headers.get("Content-Type"))
+        try:
+            data = r.json()
+        except ValueError as e:
+            self.breaker.record_failure()
+            logging.warning(f"Upstream returned invalid JSON: {e}")
+            raise UpstreamError("upstream returned invalid JSON")
+        self.breaker.record_success()
+        with self.lock:
+            self.cache[key] = (time.monotonic(), data)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return data
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'cached': len(self.cache),
+                'hits': self.hits,
+                'fetches': self.fetches,
+                'failures': self.failures,
+                'stale_served': self.stale_served,
+                'breaker': self.breaker.state,
+                'breaker_opened': self.breaker.times_opened,
+                'coalescing': self.flights.stats(keys=0)['totals'],
+            }
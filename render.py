@@ -0,0 +1,149 @@
+# Rendering of upcoming arrivals into the response formats served by the API, and a cache of
+# encoded (and compressed) response bodies.
+import csv
+import io
+import json
+import html
+import gzip
+import hashlib
+import threading
+import collections
+
+import yaml
+
+# Faster serialisers, if installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# format name -> mimetype, in order of preference when the client accepts several
+MIMETYPES = {
+    "json": "application/json",
+    "yaml": "application/yaml",
+    "csv": "text/csv",
+    "text": "text/plain",
+    "html": "text/html",
+}
+FIELDS = ["route", "destination", "expected", "scheduled", "real_time", "agency", "stop_id"]
+# content codings we can produce, in order of preference
+ENCODINGS = (["br"] if brotli is not None else []) + ["gzip"]
+# bodies smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 512
+
+
+def format_arrival(arrival: dict, stop_id: str) -> dict:
+    """
+    Convert an arrival returned by the GTFS engine into the dict returned by the API.
+    """
+    expected = arrival["real_time_arrival"] or arrival["scheduled_arrival"]
+    return {
+        "route": arrival["route"],
+        "destination": arrival["headsign"],
+        "expected": expected.astimezone().isoformat(),
+        "scheduled": arrival["scheduled_arrival"].astimezone().isoformat(),
+        "real_time": arrival["real_time_arrival"] is not None,
+        "agency": arrival["agency"],
+        "stop_id": stop_id,
+    }
+
+
+def negotiate(accept_mimetypes) -> str:
+    """
+    Pick a format name from a werkzeug Accept header, defaulting to JSON.
+    """
+    best = accept_mimetypes.best_match(list(MIMETYPES.values()), default=MIMETYPES["json"])
+    return next(fmt for fmt, mimetype in MIMETYPES.items() if mimetype == best)
+
+
+def negotiate_encoding(accept_encodings):
+    """
+    Pick a content coding from a werkzeug Accept-Encoding header, or None for identity.
+    """
+    return accept_encodings.best_match(ENCODINGS)
+
+
+def render(fmt: str, arrivals: list) -> bytes:
+    """
+    Serialise a list of API arrival dicts in the given format.
+    """
+    if fmt in ("csv", "text"):
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(arrivals)
+        return out.getvalue().encode("utf-8")
+    if fmt == "yaml":
+        return yaml.dump({"arrivals": arrivals}, Dumper=YamlDumper, sort_keys=False, allow_unicode=True).encode("utf-8")
+    if fmt == "html":
+        header = "".join(f"<th>{field}</th>" for field in FIELDS)
+        rows = "".join(
+            "<tr>" + "".join(f"<td>{html.escape(str(arrival.get(field, '')))}</td>" for field in FIELDS) + "</tr>"
+            for arrival in arrivals
+        )
+        return (
+            "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Arrivals</title></head><body>"
+            f"<table><thead><tr>{header}</tr></thead><tbody>{rows}</tbody></table></body></html>"
+        ).encode("utf-8")
+    return dump_json({"arrivals": arrivals})
+
+
+def dump_json(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+class Encoded:
+    """
+    A rendered response body, with its ETag and compressed variants (made on first use).
+    """
+    def __init__(self, body: bytes, mimetype: str):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+        self._compressed = {}
+
+    def encode(self, encoding):
+        # return (body, etag, encoding) for a content coding. The identity body is returned (with
+        # encoding None) if the client doesn't accept compression or it's not worth compressing.
+        if encoding is None or len(self.body) < MIN_COMPRESS_SIZE:
+            return self.body, self.etag, None
+        if encoding not in self._compressed:
+            if encoding == "br":
+                self._compressed[encoding] = brotli.compress(self.body, quality=5)
+            else:
+                self._compressed[encoding] = gzip.compress(self.body, compresslevel=6)
+        # Each representation needs its own strong ETag
+        return self._compressed[encoding], f"{self.etag}-{encoding}", encoding
+
+
+class ResponseCache:
+    """
+    A thread-safe LRU cache of Encoded bodies. Keys should capture everything the body depends
+    on, e.g. (stops, minutes, format, live data generation, minute).
+    """
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            encoded = self._items.get(key)
+            if encoded is not None:
+                self._items.move_to_end(key)
+            return encoded
+
+    def put(self, key, encoded: Encoded):
+        with self._lock:
+            self._items[key] = encoded
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return encoded
@@ -0,0 +1,148 @@
+# Re-publication of the latest live feed to downstream consumers, filtered to the trips, routes and
+# stops they ask for.
+#
+# The feed is kept as fetched. Entities are found and indexed by walking the raw bytes (see gtfsr.py),
+# and a filtered feed is made by copying the header and the matching entities' bytes into a new
+# FeedMessage, so nothing is decoded or re-encoded. The index is only built when a consumer first asks
+# for the feed.
+#
+# Consumers can also ask for only what changed since a generation they already have. A summary of each
+# of the last few feeds (a digest of each entity, and what it refers to) is kept for working that out.
+# The answer is a DIFFERENTIAL feed of the new and changed entities, and deletions of the entities that
+# are gone.
+import hashlib
+import threading
+import collections
+
+import gtfsr
+
+# feeds to keep summaries of, for answering incremental requests
+HISTORY = 10
+
+
+class FeedSnapshot:
+    """
+    A raw FeedMessage, with an index of its entities built on first use. stop_number and route_name
+    map stop_ids and route_ids to the stop numbers and route names consumers may filter by.
+    """
+    def __init__(self, buf: bytes, generation: int, stop_number=None, route_name=None):
+        self.buf = bytes(buf)
+        self.generation = generation
+        self.timestamp = gtfsr.feed_timestamp(self.buf)
+        self.stop_number = stop_number
+        self.route_name = route_name
+        self._entities = None
+        self._lock = threading.Lock()
+
+    def entities(self):
+        # [(entity id, start, end, digest, references)], where references is a frozenset of
+        # ('trip', trip_id), ('route', route_id or name) and ('stop', stop_id or number) pairs
+        with self._lock:
+            if self._entities is None:
+                self._entities = [self._index(start, end) for start, end in gtfsr.iter_entities(self.buf)]
+            return self._entities
+
+    def _index(self, start, end):
+        entity_id, trip_ids, route_ids, stop_ids = gtfsr.entity_references(self.buf, start, end)
+        references = {('trip', trip_id) for trip_id in trip_ids}
+        for route_id in route_ids:
+            references.add(('route', route_id))
+            name = self.route_name(route_id) if self.route_name is not None else None
+            if name:
+                references.add(('route', name))
+        for stop_id in stop_ids:
+            references.add(('stop', stop_id))
+            number = self.stop_number(stop_id) if self.stop_number is not None else None
+            if number:
+                references.add(('stop', number))
+        digest = hashlib.blake2b(self.buf[start:end], digest_size=8).digest()
+        return entity_id, start, end, digest, frozenset(references)
+
+    def summary(self) -> dict:
+        # entity id -> (digest, references)
+        return {entity_id: (digest, references) for entity_id, _, _, digest, references in self.entities()}
+
+    def select(self, references: set = None):
+        # the entities referring to any of the references, or all of them if there are none
+        if not references:
+            return self.entities()
+        return [entity for entity in self.entities() if not references.isdisjoint(entity[4])]
+
+    def encode(self, entities, deleted=(), differential: bool = False) -> bytes:
+        """
+        A FeedMessage with the header of this feed and the given entities, followed by an is_deleted
+        entity for each id in deleted.
+        """
+        header = gtfsr.find_field(memoryview(self.buf), 0, len(self.buf), gtfsr.FEED_MESSAGE_HEADER)
+        header_fields = []
+        if header is not None:
+            header_fields = [
+                self.buf[start:end] for field_number, start, end in gtfsr.iter_field_spans(self.buf, *header)
+                if not (differential and field_number == gtfsr.FEED_HEADER_INCREMENTALITY)
+            ]
+        if differential:
+            header_fields.append(gtfsr.encode_varint_field(gtfsr.FEED_HEADER_INCREMENTALITY, gtfsr.DIFFERENTIAL))
+        out = [gtfsr.encode_bytes_field(gtfsr.FEED_MESSAGE_HEADER, b''.join(header_fields))]
+        for entity_id, start, end, _, _ in entities:
+            out.append(gtfsr.encode_bytes_field(gtfsr.FEED_MESSAGE_ENTITY, self.buf[start:end]))
+        for entity_id in deleted:
+            out.append(gtfsr.encode_bytes_field(gtfsr.FEED_MESSAGE_ENTITY,
+                gtfsr.encode_bytes_field(gtfsr.FEED_ENTITY_ID, entity_id) + gtfsr.encode_varint_field(gtfsr.FEED_ENTITY_IS_DELETED, 1)))
+        return b''.join(out)
+
+
+class Republisher:
+    """
+    Holds the latest feed, and summaries of the HISTORY feeds before it.
+    """
+    def __init__(self, history: int = HISTORY):
+        self.latest = None
+        # generation -> summary, oldest first
+        self.history = collections.OrderedDict()
+        self.maxlen = history
+        self.lock = threading.Lock()
+        # feeds are only indexed and summarised once a consumer has asked for one
+        self.consumed = False
+
+    def publish(self, snapshot: FeedSnapshot):
+        with self.lock:
+            previous, self.latest = self.latest, snapshot
+        if previous is not None and self.consumed:
+            summary = previous.summary()
+            with self.lock:
+                self.history[previous.generation] = summary
+                while len(self.history) > self.maxlen:
+                    self.history.popitem(last=False)
+
+    def feed(self, references: set = None, since: int = None):
+        """
+        Return (snapshot, FeedMessage bytes) for the latest feed filtered by references, or (None, None)
+        if there is no feed yet. If since is the generation of the latest feed or one in the history,
+        the message is a DIFFERENTIAL update from that feed. Otherwise it is the full (filtered) feed.
+        """
+        with self.lock:
+            self.consumed = True
+            snapshot = self.latest
+            old = self.history.get(since) if since is not None else None
+        if snapshot is None:
+            return None, None
+        entities = snapshot.select(references)
+        if since is not None and since == snapshot.generation:
+            return snapshot, snapshot.encode([], differential=True)
+        if old is None:
+            return snapshot, snapshot.encode(entities) if references else snapshot.buf
+        changed = [entity for entity in entities if old.get(entity[0], (None,))[0] != entity[3]]
+        # entities that are gone, or no longer match, are deleted if the consumer had them
+        selected_ids = {entity[0] for entity in entities}
+        deleted = sorted(
+            entity_id for entity_id, (_, old_references) in old.items()
+            if entity_id not in selected_ids and (not references or not references.isdisjoint(old_references))
+        )
+        return snapshot, snapshot.encode(changed, deleted, differential=True)
+
+
+def to_json(buf: bytes) -> dict:
+    # decode a FeedMessage into the JSON mapping of the GTFS-R protobuf
+    from google.transit import gtfs_realtime_pb2
+    from google.protobuf import json_format
+    return json_format.MessageToDict(gtfs_realtime_pb2.FeedMessage.FromString(buf))
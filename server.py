@@ -1,19 +1,36 @@
 import os
-from datetime import datetime, timezone
-from flask import Flask, request, jsonify
+import math
+import time
+import logging
+import random
+import threading
+from datetime import datetime, timezone, timedelta
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
-import requests
+
+import render
+import republish
+import singleflight
+import tracing
+
+# when this module was imported, for measuring how long the engine takes to be ready
+_imported_at = time.monotonic()
 
 # -------- helpers --------
-def normalize_stop_id(s: str) -> str:
+def normalize_stop_id(s: str, stops=None) -> str:
     """
     Accept short pole codes like '1348' and convert to a full TFI stop_id.
-    Dublin Bus pattern is '8220DB00' + 4-digit, zero-padded.
+    With a stopindex.StopIndex, any stop number or stop_id it knows is converted to its stop_id.
+    Otherwise the Dublin Bus pattern is '8220DB00' + 4-digit, zero-padded.
     If the caller already passes a full id (starts with 8220), return as-is.
     """
     s = (s or "").strip()
     if not s:
         return s
+    if stops is not None:
+        stop_number = stops.normalize(s)
+        if stop_number is not None:
+            return stops.stop_id(stop_number)
     if s.startswith("8220"):
         return s  # already full TFI stop_id
     if s.isdigit():
@@ -29,40 +46,371 @@ DEFAULT_MINUTES = int(os.getenv("MINUTES", "30"))
 
 # mode:
 #   ROLE=public  -> this service proxies to a "core" upstream
-#   ROLE=core    -> this service computes locally (here: demo data placeholder)
+#   ROLE=core    -> this service computes locally from the GTFS data
 ROLE = (os.getenv("ROLE") or "core").lower()
 LIVE_URL = (os.getenv("LIVE_URL") or "").strip()  # upstream base URL when ROLE=public
+# ROLE=public: seconds to reuse an upstream response for, and to serve it for (flagged as stale)
+# when the upstream fails
+UPSTREAM_TTL = float(os.getenv("UPSTREAM_TTL", "10"))
+UPSTREAM_STALE_TTL = float(os.getenv("UPSTREAM_STALE_TTL", "600"))
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "3"))
+# consecutive upstream failures after which it isn't called for UPSTREAM_RESET seconds
+UPSTREAM_FAILURES = int(os.getenv("UPSTREAM_FAILURES", "5"))
+UPSTREAM_RESET = float(os.getenv("UPSTREAM_RESET", "30"))
+
+# stop numbers whose departure boards are precomputed after each live feed refresh (ROLE=core)
+HOT_STOPS = [stop.strip() for stop in (os.getenv("HOT_STOPS") or "").split(",") if stop.strip()]
+
+# nearby stop queries
+DEFAULT_COUNT = 10
+MAX_COUNT = 50
+DEFAULT_RADIUS = 500  # metres
+MAX_RADIUS = 5000
+
+# longest window that can be asked for with at= and until=
+MAX_WINDOW = timedelta(days=2)
+
+# how long (in seconds) a request waits for an identical arrivals query in progress, before
+# computing its own result
+COALESCE_TIMEOUT = float(os.getenv("COALESCE_TIMEOUT", "5"))
+
+# ROLE=core: start loading the engine as soon as the server starts, rather than on the first request
+PRELOAD = (os.getenv("PRELOAD") or "1") != "0"
+
+# TRACE=1 times the phases of queries and live feed parses (see tracing.py), for TRACE_SAMPLE of
+# requests, for requests with an X-Trace header and the API key, and for every live feed refresh.
+# The last TRACE_KEEP traces are returned by /admin/traces.
+TRACE = (os.getenv("TRACE") or "0") == "1"
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "0.01"))
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", "100"))
+# longest profile that can be asked for from /admin/profile, in seconds
+MAX_PROFILE_SECONDS = 60
+
+# formats of the re-published live feed
+FEED_MIMETYPES = {"pb": "application/x-protobuf", "json": "application/json"}
+
+# -------- engine --------
+_engine = None
+_engine_lock = threading.Lock()
+_boards = None
+_responses = render.ResponseCache()
+# concurrent identical arrivals queries share one computation
+_flights = singleflight.SingleFlight(COALESCE_TIMEOUT)
+# polls the live feeds (ROLE=core)
+_ingester = None
+_upstream = None
+_upstream_lock = threading.Lock()
+_traces = tracing.Recorder(TRACE_KEEP)
+if TRACE:
+    tracing.instrument(render, ('render', 'format_arrival'))
+# seconds taken to get the engine ready
+_startup = {}
+# set once the engine (ROLE=core) has loaded its data and started polling the live feeds
+_ready = threading.Event()
+
+def _configure_logging():
+    # log at LOG_LEVEL, unless whatever is running the app has configured logging already
+    import settings
+    logging.basicConfig(level=getattr(logging, settings.LOG_LEVEL))
+
+_configure_logging()
+
+def get_upstream():
+    """
+    Return the client of the core upstream (ROLE=public), creating it on first use.
+    """
+    global _upstream
+    with _upstream_lock:
+        if _upstream is None:
+            # imported here, as requests is slow to import and only needed by public nodes
+            import proxy
+            _upstream = proxy.Upstream(
+                LIVE_URL, API_KEY, ttl=UPSTREAM_TTL, stale_ttl=UPSTREAM_STALE_TTL, timeout=UPSTREAM_TIMEOUT,
+                failure_threshold=UPSTREAM_FAILURES, reset_timeout=UPSTREAM_RESET,
+            )
+            if TRACE:
+                tracing.instrument(_upstream, ('get', '_fetch'), prefix='upstream')
+    return _upstream
+
+def get_engine():
+    """
+    Return the GTFS engine (ROLE=core), loading it on first use and starting the
+    thread that polls the live feed.
+    """
+    global _engine, _boards
+    with _engine_lock:
+        if _engine is None:
+            start_time = time.monotonic()
+            import gtfs
+            import settings
+            _engine = gtfs.GTFS(
+                live_url=settings.GTFS_LIVE_URL,
+                api_key=settings.API_KEY,
+                redis_url=settings.REDIS_URL,
+                filter_stops=settings.FILTER_STOPS,
+                partitions=settings.PARTITIONS,
+                partition_memory_mb=settings.PARTITION_MEMORY_MB,
+            )
+            if TRACE:
+                _engine.instrument()
+            if settings.ARCHIVE_DIR:
+                import archive
+                _engine.recorder = archive.Recorder(settings.ARCHIVE_DIR, timedelta(days=settings.ARCHIVE_RETENTION_DAYS))
+            polling_period = int(settings.POLLING_PERIOD)
+            if HOT_STOPS:
+                import boards
+                _boards = boards.DepartureBoards(
+                    {normalize_stop_id(stop, _engine.stops): stop for stop in HOT_STOPS},
+                    DEFAULT_MINUTES,
+                    timedelta(seconds=polling_period),
+                )
+            start_ingesting(_engine, _boards, polling_period)
+            _startup["engine_seconds"] = round(time.monotonic() - start_time, 3)
+            _startup["since_import_seconds"] = round(time.monotonic() - _imported_at, 3)
+            logging.info(f"Engine ready in {_startup['engine_seconds']}s, {_startup['since_import_seconds']}s after the server started")
+            _ready.set()
+    return _engine
+
+def start_ingesting(engine, boards, polling_period: int):
+    # poll the live feeds, each in a thread of its own (see ingest.py)
+    global _ingester
+    import ingest
+    import settings
+    max_bytes = settings.FEED_MAX_MB * 1024 * 1024
+    feeds = [ingest.Feed("trip_updates", engine.live_url, polling_period, engine.load_trip_updates, max_bytes)]
+    if settings.GTFS_VEHICLES_URL:
+        feeds.append(ingest.Feed("vehicle_positions", settings.GTFS_VEHICLES_URL, settings.VEHICLES_POLLING_PERIOD, engine.load_vehicle_positions, max_bytes))
+    if settings.GTFS_ALERTS_URL:
+        feeds.append(ingest.Feed("service_alerts", settings.GTFS_ALERTS_URL, settings.ALERTS_POLLING_PERIOD, engine.load_service_alerts, max_bytes))
+    on_update = None
+    if boards is not None:
+        # recompute the hot stops' boards once per feed loaded, rather than once per request
+        on_update = lambda feed: boards.refresh(engine, current_minute())
+    _ingester = ingest.Ingester(feeds, engine.api_key, on_update, _traces if TRACE else None)
+    _ingester.start()
 
 # -------- core logic --------
-def compute_arrivals(stop_id: str, minutes: int):
+def fetch_upstream(path: str, params: dict):
+    """
+    PUBLIC role: proxy a request to the core upstream. Returns the decoded JSON, or None if the
+    upstream failed and no recent response was cached. Stale or missing upstream data is noted
+    for the response headers (see upstream_headers).
+    """
+    data, status = get_upstream().get(path, params)
+    upstream = g.setdefault("upstream", {"stale": False, "age": 0, "unavailable": False, "rejected": None})
+    if status["stale"]:
+        upstream["stale"] = True
+        upstream["age"] = max(upstream["age"], status["age"])
+    if data is None:
+        upstream["unavailable"] = True
+    if status.get("rejected") is not None:
+        upstream["rejected"] = status["rejected"]
+    return data
+
+def upstream_unavailable():
+    # the response for when the upstream gave no data: its own answer if it refused the request
+    # (a 4xx), else a 503 for when it failed with nothing cached to fall back on
+    rejected = g.get("upstream", {}).get("rejected")
+    if rejected is not None:
+        return Response(rejected.body, status=rejected.status_code, content_type=rejected.content_type)
+    response = jsonify({"error": "upstream unavailable"})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(max(1, round(get_upstream().breaker.retry_after())))
+    return response
+
+def current_minute() -> datetime:
+    # Queries are answered as of the start of the current minute, so that identical
+    # queries within a minute give identical results, which can be cached.
+    return datetime.now().replace(second=0, microsecond=0)
+
+def parse_time(value: str) -> datetime:
+    # parse an ISO 8601 time from a query parameter into a naive local time, as used by the engine
+    t = datetime.fromisoformat(value)
+    if t.tzinfo is not None:
+        t = t.astimezone().replace(tzinfo=None)
+    return t
+
+def requested_window(minutes: int):
+    """
+    Return the (start, end) of the window asked for by the at= and until= query parameters,
+    defaulting to the current minute and `minutes` after the start.
+    Raises ValueError if they are invalid.
+    """
+    start = parse_time(request.args["at"]) if request.args.get("at") else current_minute()
+    end = parse_time(request.args["until"]) if request.args.get("until") else start + timedelta(minutes=minutes)
+    if end < start or end - start > MAX_WINDOW:
+        raise ValueError(f"until must be after at, and at most {MAX_WINDOW} after it")
+    return start, end
+
+def compute_arrivals(stop_id: str, minutes: int, now: datetime = None, until: datetime = None):
     """
     Return a list of dicts: [{route, destination, expected (ISO), stop_id}, ...]
+    for the arrivals between now and until (by default, `minutes` after now).
     """
     if not stop_id:
         return []
 
     # PUBLIC role: proxy to upstream /api/v1/arrivals
     if ROLE == "public" and LIVE_URL:
-        try:
-            url = f"{LIVE_URL}/api/v1/arrivals?stop={stop_id}&minutes={minutes}"
-            r = requests.get(url, headers={"x-api-key": API_KEY}, timeout=10)
-            if r.status_code == 200:
-                return r.json().get("arrivals", [])
-            print("Upstream error:", r.status_code, r.text)
-            return []
-        except Exception as e:
-            print("Upstream call failed:", e)
-            return []
-
-    # CORE role: local compute (replace with your real GTFS logic later)
-    now = datetime.now(timezone.utc).replace(microsecond=0, second=0)
-    return [
-        {"route": "9",  "destination": "Charlestown",    "expected": now.isoformat(), "stop_id": stop_id},
-        {"route": "16", "destination": "Dublin Airport", "expected": now.isoformat(), "stop_id": stop_id},
-        {"route": "68", "destination": "Poolbeg St",     "expected": now.isoformat(), "stop_id": stop_id},
-    ]
+        params = {"stop": stop_id, "minutes": minutes}
+        # only pass on a window other than the default, so that requests for the upcoming arrivals
+        # share cached upstream responses
+        if now is not None and now != current_minute():
+            params["at"] = now.isoformat()
+        if until is not None and until != (now or current_minute()) + timedelta(minutes=minutes):
+            params["until"] = until.isoformat()
+        return (fetch_upstream("/api/v1/arrivals", params) or {}).get("arrivals", [])
+
+    # CORE role: serve from a precomputed board if there is one, else compute locally
+    engine = get_engine()
+    now = now or current_minute()
+    until = until or now + timedelta(minutes=minutes)
+    board = _boards.get(stop_id) if _boards is not None else None
+    if board is not None and until == now + timedelta(minutes=minutes):
+        arrivals = board.arrivals(now, minutes)
+        if arrivals is not None:
+            return arrivals
+    stop_number = engine.stops.normalize(stop_id)
+    if stop_number is None:
+        return []
+    # callers must not modify the list returned, as it may be shared with concurrent requests
+    return _flights.do(
+        (stop_id, now, until, engine.live_generation),
+        lambda: [render.format_arrival(arrival, stop_id) for arrival in engine.get_arrivals_in_window(stop_number, now, until)],
+    )
+
+def render_arrivals(stop_ids: tuple, minutes: int, fmt: str, now: datetime, until: datetime) -> bytes:
+    # a single hot stop may have a pre-rendered body
+    if len(stop_ids) == 1 and ROLE != "public" and _boards is not None and _boards.get(stop_ids[0]) is not None \
+            and until == now + timedelta(minutes=minutes):
+        body = _boards.get(stop_ids[0]).body(fmt, now, minutes)
+        if body is not None:
+            return body
+    arrivals = [arrival for stop_id in stop_ids for arrival in compute_arrivals(stop_id, minutes, now, until)]
+    if len(stop_ids) > 1:
+        arrivals.sort(key=lambda arrival: arrival["expected"])
+    return render.render(fmt, arrivals)
+
+def arrivals_response(stop_ids: list, minutes: int):
+    """
+    Render the arrivals at one or more stops in the format negotiated from the Accept header.
+    Encoded bodies are cached until the live data or the minute changes, compressed per
+    Accept-Encoding, and answered with 304 Not Modified if the client already has them.
+    """
+    try:
+        now, until = requested_window(minutes)
+    except ValueError as e:
+        return jsonify({"error": f"expected ISO 8601 times for at and until ({e})"}), 400
+    fmt = render.negotiate(request.accept_mimetypes)
+    stop_ids = tuple(sorted(set(stop_id for stop_id in stop_ids if stop_id)))
+    key = None
+    encoded = None
+    if ROLE != "public":
+        generation = (get_engine().live_generation, _boards.generation if _boards is not None else 0)
+        key = (stop_ids, minutes, fmt, generation, now, until)
+        encoded = _responses.get(key)
+    if encoded is None:
+        encoded = render.Encoded(render_arrivals(stop_ids, minutes, fmt, now, until), render.MIMETYPES[fmt])
+        if key is not None:
+            _responses.put(key, encoded)
+    if g.get("upstream", {}).get("unavailable"):
+        return upstream_unavailable()
+
+    return encoded_response(encoded)
+
+def encoded_response(encoded):
+    # a response with the body compressed per Accept-Encoding, or 304 Not Modified if the client has it
+    body, etag, encoding = encoded.encode(render.negotiate_encoding(request.accept_encodings))
+    response = Response(body, mimetype=encoded.mimetype)
+    response.set_etag(etag)
+    response.vary.update(("Accept", "Accept-Encoding"))
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response.make_conditional(request)
+
+def requested_stops():
+    # one or more stop (or stopId) query parameters, normalized
+    stops = request.args.getlist("stop") + request.args.getlist("stopId")
+    index = get_engine().stops if ROLE != "public" else None
+    return [normalize_stop_id(stop, index) for stop in stops]
+
+def find_stops(args):
+    """
+    Return the stops selected by either a point (lat, lon, count, radius) or a
+    bounding box (min_lat, min_lon, max_lat, max_lon) in the query args.
+    Raises ValueError if the args are missing or invalid.
+    """
+    if "lat" in args or "lon" in args:
+        count = min(int(args.get("count", DEFAULT_COUNT)), MAX_COUNT)
+        radius = min(float(args.get("radius", DEFAULT_RADIUS)), MAX_RADIUS)
+        if not radius >= 0:
+            raise ValueError("radius must be a number of metres")
+        lat, lon = coordinate(args["lat"], 90), coordinate(args["lon"], 180)
+        return get_engine().get_nearby_stops(lat, lon, count, radius)
+    bbox = coordinate(args["min_lat"], 90), coordinate(args["min_lon"], 180), coordinate(args["max_lat"], 90), coordinate(args["max_lon"], 180)
+    return get_engine().get_stops_in_bbox(*bbox)
+
+def coordinate(value: str, limit: float) -> float:
+    # a latitude (limit 90) or longitude (limit 180) in degrees. Raises ValueError if it is out of range.
+    degrees = float(value)
+    if not math.isfinite(degrees) or abs(degrees) > limit:
+        raise ValueError(f"{value} is not a coordinate between -{limit} and {limit}")
+    return degrees
+
+def compute_nearby(args, minutes: int, with_arrivals: bool):
+    """
+    Return {"stops": [...]} and, if requested, the merged upcoming arrivals
+    at those stops as {"arrivals": [...]}.
+    """
+    if ROLE == "public" and LIVE_URL:
+        path = "/api/v1/arrivals/nearby" if with_arrivals else "/api/v1/stops"
+        return fetch_upstream(path, dict(args, minutes=minutes))
+
+    stops = find_stops(args)
+    result = {"stops": stops}
+    if with_arrivals:
+        start, end = requested_window(minutes)
+        arrivals = get_engine().get_arrivals_for_stops([stop["stop_number"] for stop in stops], start, end - start)
+        result["arrivals"] = [render.format_arrival(arrival, arrival["stop_number"]) for arrival in arrivals]
+    return result
 
 # -------- routes --------
+@app.after_request
+def upstream_headers(response):
+    # ROLE=public: flag responses made from stale upstream data
+    upstream = g.get("upstream")
+    if upstream and upstream["stale"]:
+        response.headers["X-Upstream-Stale"] = "true"
+        response.headers["Age"] = str(int(upstream["age"]))
+        response.headers["Warning"] = '110 - "Response is Stale"'
+    return response
+
+@app.before_request
+def start_trace():
+    # TRACE=1: trace a sample of requests, and those asking for it with an X-Trace header
+    if not TRACE:
+        return
+    requested = bool(request.headers.get("X-Trace")) and bool(API_KEY) and request.headers.get("x-api-key") == API_KEY
+    if requested or random.random() < TRACE_SAMPLE:
+        g.trace_requested = requested
+        tracing.start(f"{request.method} {request.full_path.rstrip('?')}")
+
+@app.after_request
+def finish_trace(response):
+    # keep the trace, and return its spans to a client that asked for it
+    trace = tracing.stop() if TRACE else None
+    if trace is not None:
+        _traces.record(trace)
+        if g.get("trace_requested"):
+            response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+@app.teardown_request
+def clear_trace(exception):
+    # a request that failed may not have been through finish_trace
+    if TRACE:
+        tracing.stop()
+
 @app.route("/")
 def root():
     return "App is running"
@@ -70,13 +418,22 @@ def root():
 @app.route("/health")
 @app.route("/healthz")
 def health():
-    return jsonify({"status": "ok"}), 200
+    # liveness: the server is up, even while a core node is still loading its data
+    return jsonify({"status": "ok", "ready": ROLE == "public" or _ready.is_set()}), 200
+
+@app.route("/ready")
+@app.route("/readyz")
+def ready():
+    # readiness: 503 until a core node has loaded its data, so that it isn't sent traffic before then
+    if ROLE == "public" or _ready.is_set():
+        return jsonify({"status": "ok", "ready": True}), 200
+    response = jsonify({"status": "loading", "ready": False})
+    response.status_code = 503
+    response.headers["Retry-After"] = "5"
+    return response
 
 @app.route("/api/v1/arrivals")
 def secure_arrivals():
-    # normalize the stop id here
-    stop_raw = (request.args.get("stop") or request.args.get("stopId") or "").strip()
-    stop = normalize_stop_id(stop_raw)
     try:
         minutes = int(request.args.get("minutes", DEFAULT_MINUTES))
     except ValueError:
@@ -87,19 +444,172 @@ def secure_arrivals():
     if not API_KEY or header_key != API_KEY:
         return jsonify({"error": "unauthorized"}), 401
 
-    return jsonify({"arrivals": compute_arrivals(stop, minutes)})
+    return arrivals_response(requested_stops(), minutes)
+
+@app.route("/api/v1/stops")
+@app.route("/api/v1/arrivals/nearby")
+def nearby():
+    try:
+        minutes = int(request.args.get("minutes", DEFAULT_MINUTES))
+    except ValueError:
+        minutes = DEFAULT_MINUTES
+
+    # API key required
+    header_key = request.headers.get("x-api-key", "")
+    if not API_KEY or header_key != API_KEY:
+        return jsonify({"error": "unauthorized"}), 401
+
+    try:
+        result = compute_nearby(request.args, minutes, with_arrivals=request.path.endswith("/nearby"))
+        return jsonify(result) if result is not None else upstream_unavailable()
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": f"expected lat and lon, or min_lat, min_lon, max_lat and max_lon ({e})"}), 400
 
 @app.route("/public/arrivals")
 def public_arrivals():
-    # normalize the stop id here
-    stop_raw = (request.args.get("stop") or request.args.get("stopId") or "").strip()
-    stop = normalize_stop_id(stop_raw)
     try:
         minutes = int(request.args.get("minutes", DEFAULT_MINUTES))
     except ValueError:
         minutes = DEFAULT_MINUTES
 
-    return jsonify({"arrivals": compute_arrivals(stop, minutes)})
+    return arrivals_response(requested_stops(), minutes)
+
+@app.route("/api/v1/feed")
+def live_feed():
+    # The latest live feed, as GTFS-R protobuf (the default) or JSON (format=json or Accept:
+    # application/json). With stop, route and/or trip parameters, only the entities referring to any
+    # of them are included. since=<generation> returns a DIFFERENTIAL feed of what changed since that
+    # generation, which is given in the X-Feed-Generation header of every response.
+    header_key = request.headers.get("x-api-key", "")
+    if not API_KEY or header_key != API_KEY:
+        return jsonify({"error": "unauthorized"}), 401
+    if ROLE == "public":
+        return jsonify({"error": "not available on a public node"}), 404
+    try:
+        since = int(request.args["since"]) if request.args.get("since") else None
+    except ValueError:
+        return jsonify({"error": "expected an integer generation for since"}), 400
+    fmt = request.args.get("format")
+    if fmt not in FEED_MIMETYPES:
+        best = request.accept_mimetypes.best_match(list(FEED_MIMETYPES.values()), default=FEED_MIMETYPES["pb"])
+        fmt = next(fmt for fmt, mimetype in FEED_MIMETYPES.items() if mimetype == best)
+
+    engine = get_engine()
+    references = set()
+    for stop in request.args.getlist("stop"):
+        stop_number = engine.stops.normalize(stop)
+        references.add(("stop", stop_number or stop.strip()))
+    references.update(("route", route.strip()) for route in request.args.getlist("route"))
+    references.update(("trip", trip.strip()) for trip in request.args.getlist("trip"))
+
+    latest = engine.republisher.latest
+    if latest is None:
+        return jsonify({"error": "no live feed has been fetched yet"}), 503
+    generation = latest.generation
+    encoded = _responses.get(("feed", frozenset(references), since, fmt, generation))
+    if encoded is None:
+        # a newer feed may have landed since, so the key is made from the feed actually used
+        snapshot, body = engine.republisher.feed(references, since)
+        generation = snapshot.generation
+        if fmt == "json":
+            body = render.dump_json(republish.to_json(body))
+        encoded = _responses.put(("feed", frozenset(references), since, fmt, generation), render.Encoded(body, FEED_MIMETYPES[fmt]))
+    response = encoded_response(encoded)
+    response.headers["X-Feed-Generation"] = str(generation)
+    return response
+
+@app.route("/api/v1/alerts")
+def alerts():
+    # the service alerts (GTFS_ALERTS_URL) currently active at the stop and route query parameters
+    header_key = request.headers.get("x-api-key", "")
+    if not API_KEY or header_key != API_KEY:
+        return jsonify({"error": "unauthorized"}), 401
+    stops = request.args.getlist("stop")
+    routes = [route.strip() for route in request.args.getlist("route")]
+    if ROLE == "public" and LIVE_URL:
+        result = fetch_upstream("/api/v1/alerts", {"stop": tuple(stops), "route": tuple(routes)})
+        return jsonify(result) if result is not None else upstream_unavailable()
+
+    engine = get_engine()
+    now = datetime.now()
+    result = {"stops": {}, "routes": {}}
+    for stop in stops:
+        stop_number = engine.stops.normalize(stop)
+        if stop_number is not None:
+            result["stops"][stop_number] = engine.get_alerts(stop_number=stop_number, now=now)
+    for route in routes:
+        result["routes"][route] = engine.get_alerts(route=route, now=now)
+    return jsonify(result)
+
+@app.route("/admin/filter-stops", methods=["GET", "POST"])
+def admin_filter_stops():
+    # GET returns the stops that the loaded data is filtered for (null for all stops). POST with
+    # {"stops": ["1358", ...]} or {"stops": null} cuts a new dataset from the master index.
+    header_key = request.headers.get("x-api-key", "")
+    if not API_KEY or header_key != API_KEY:
+        return jsonify({"error": "unauthorized"}), 401
+    if ROLE == "public":
+        return jsonify({"error": "not available on a public node"}), 404
+
+    engine = get_engine()
+    if request.method == "POST":
+        body = request.get_json(silent=True)
+        stops = body.get("stops") if isinstance(body, dict) else None
+        if not isinstance(body, dict) or not (stops is None or (isinstance(stops, list) and all(isinstance(stop, str) for stop in stops))):
+            return jsonify({"error": "expected {\"stops\": [stop numbers]} or {\"stops\": null}"}), 400
+        engine.set_filter_stops(stops)
+    return jsonify({"stops": sorted(engine.filter_stops) if engine.filter_stops else None})
+
+@app.route("/admin/stats")
+def admin_stats():
+    # counts of coalesced arrivals queries, of the store's in-memory caches and of loaded partitions,
+    # or on a public node, of calls to the upstream
+    header_key = request.headers.get("x-api-key", "")
+    if not API_KEY or header_key != API_KEY:
+        return jsonify({"error": "unauthorized"}), 401
+    if ROLE == "public":
+        return jsonify({"upstream": get_upstream().stats()})
+
+    engine = get_engine()
+    return jsonify({
+        "coalescing": _flights.stats(),
+        "store_caches": engine.store.cache_stats(),
+        "partitions": engine.partitions.stats() if engine.partitions is not None else None,
+        "startup": dict(_startup, new_static_data=engine.new_static_data),
+        "feeds": _ingester.stats() if _ingester is not None else None,
+    })
+
+@app.route("/admin/traces")
+def admin_traces():
+    # the most recent traces (TRACE=1), newest first
+    header_key = request.headers.get("x-api-key", "")
+    if not API_KEY or header_key != API_KEY:
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify({"enabled": TRACE, "sample": TRACE_SAMPLE, "traces": _traces.to_list()})
+
+@app.route("/admin/profile")
+def admin_profile():
+    # sample the stacks of the server's threads for `seconds` (default 10), every `interval` seconds
+    # (default 0.005), and return them as collapsed stacks for flamegraph.pl or speedscope
+    header_key = request.headers.get("x-api-key", "")
+    if not API_KEY or header_key != API_KEY:
+        return jsonify({"error": "unauthorized"}), 401
+    try:
+        seconds = float(request.args.get("seconds", 10))
+        interval = float(request.args.get("interval", 0.005))
+        if not (0 < seconds <= MAX_PROFILE_SECONDS and 0.001 <= interval <= 1):
+            raise ValueError()
+    except ValueError:
+        return jsonify({"error": f"expected seconds up to {MAX_PROFILE_SECONDS} and an interval between 0.001 and 1"}), 400
+    stacks = tracing.profile(seconds, interval)
+    if stacks is None:
+        return jsonify({"error": "a profile is already being taken"}), 409
+    response = Response(stacks, mimetype="text/plain")
+    response.headers["Content-Disposition"] = f"attachment; filename=profile-{datetime.now():%Y%m%dT%H%M%S}.folded"
+    return response
+
+if ROLE != "public" and PRELOAD:
+    threading.Thread(target=get_engine, daemon=True).start()
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "8080"))
@@ -4,10 +4,22 @@ from pathlib import Path
 
 GTFS_STATIC_URL = os.environ.get('GTFS_STATIC_URL', "https://www.transportforireland.ie/transitData/Data/GTFS_Realtime.zip")
 GTFS_LIVE_URL = os.environ.get('GTFS_LIVE_URL', "https://api.nationaltransport.ie/gtfsr/v2/TripUpdates")
+# Optional VehiclePositions and ServiceAlerts feeds, polled alongside GTFS_LIVE_URL. The NTA's vehicle
+# positions are at https://api.nationaltransport.ie/gtfsr/v2/Vehicles
+GTFS_VEHICLES_URL = os.environ.get('GTFS_VEHICLES_URL', None)
+GTFS_ALERTS_URL = os.environ.get('GTFS_ALERTS_URL', None)
 API_KEY = os.environ.get('API_KEY')
 # Redis URL, probably something like redis://localhost:6379
 REDIS_URL = os.environ.get('REDIS_URL', None)
+# Alternatively, another data store backend: "sqlite:///data/store.sqlite" or "lmdb:///data/store.lmdb"
+# (relative paths; use four slashes for an absolute path).
+# REDIS_URL takes precedence if both are set.
+STORE_URL = os.environ.get('STORE_URL', None)
 POLLING_PERIOD = os.environ.get('POLLING_PERIOD', 60)
+VEHICLES_POLLING_PERIOD = int(os.environ.get('VEHICLES_POLLING_PERIOD', 30))
+ALERTS_POLLING_PERIOD = int(os.environ.get('ALERTS_POLLING_PERIOD', 300))
+# Largest live feed response to accept, in megabytes
+FEED_MAX_MB = int(os.environ.get('FEED_MAX_MB', 32))
 MAX_MINUTES = os.environ.get('MAX_MINUTES', 60)
 HOST = os.environ.get('HOST', 'localhost')
 PORT = os.environ.get('PORT', 7341)
@@ -27,6 +39,17 @@ FILTER_STOPS = os.environ.get('FILTER_STOPS', None)
 if FILTER_STOPS:
     FILTER_STOPS = [stop.strip() for stop in FILTER_STOPS.split(',')]
 
+# Load the static data for all stops lazily, in this many partitions by stop, as stops are queried.
+# 0 loads everything at startup. Ignored with FILTER_STOPS or a data store outside the process.
+PARTITIONS = int(os.environ.get('PARTITIONS', 0))
+# Memory to allow partitions loaded on demand, in megabytes
+PARTITION_MEMORY_MB = int(os.environ.get('PARTITION_MEMORY_MB', 256))
+
+# Keep each fetched live feed in this directory, for replaying later with `archive.py`
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', None)
+# Days of recorded live feeds to keep
+ARCHIVE_RETENTION_DAYS = int(os.environ.get('ARCHIVE_RETENTION_DAYS', 7))
+
 # Optionally create a `local_settings.py` file to override these settings
 # during development. This file will be ignored by git.
 try:
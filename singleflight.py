@@ -0,0 +1,88 @@
+# Coalescing of concurrent identical computations.
+#
+# When many clients ask for the same thing at the same moment (a network of displays refreshing in
+# lockstep, or everyone at the top of the minute after a new live feed lands), only the first caller
+# for a key does the work. Callers arriving while it is in progress wait for it and share its result
+# or its exception. A waiter gives up after a bounded time and computes the result itself, so a slow
+# or stuck computation can't hold up every request for its key.
+import threading
+import collections
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs at most one computation per key at a time. Counts, per key (for the `maxkeys` most recently
+    used keys) and in total, how many calls computed a result, shared one, timed out waiting or failed.
+    """
+    def __init__(self, timeout: float = 5.0, maxkeys: int = 1024):
+        self.timeout = timeout
+        self.maxkeys = maxkeys
+        # key -> _Call in progress
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._totals = collections.Counter()
+        self._key_stats = collections.OrderedDict()
+
+    def _count(self, key, outcome: str):
+        # must be called with the lock held
+        self._totals[outcome] += 1
+        stats = self._key_stats.get(key)
+        if stats is None:
+            stats = self._key_stats[key] = collections.Counter()
+            while len(self._key_stats) > self.maxkeys:
+                self._key_stats.popitem(last=False)
+        self._key_stats.move_to_end(key)
+        stats[outcome] += 1
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Return fn(*args, **kwargs), sharing the result with concurrent calls for the same key.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._count(key, 'computed')
+
+        if not leader:
+            if call.done.wait(self.timeout):
+                with self._lock:
+                    self._count(key, 'shared')
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            # the computation in progress is taking too long, so don't wait for it any more
+            with self._lock:
+                self._count(key, 'timed_out')
+            return fn(*args, **kwargs)
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            with self._lock:
+                self._count(key, 'errors')
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self, keys: int = 20) -> dict:
+        # total counts, the number of computations in progress and the counts of the `keys` busiest keys
+        with self._lock:
+            busiest = sorted(self._key_stats.items(), key=lambda item: -sum(item[1].values()))[:keys]
+            return {
+                'in_flight': len(self._calls),
+                'totals': dict(self._totals),
+                'keys': [{'key': repr(key), **counts} for key, counts in busiest],
+            }
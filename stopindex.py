@@ -0,0 +1,117 @@
+# An immutable, compact index of the stops in the static feed, held in process memory.
+#
+# The stop set only changes with the static feed, but is consulted on every request and for every
+# stop of every update in the live feed. Rather than asking the store each time (a round trip with
+# redis), the index is built once at load time and answers from sorted, fixed-width byte arrays:
+# stop_ids and stop numbers are padded to the longest of each, so a lookup is a binary search over
+# slices of a single bytes object. For the ~10k stops in Ireland it takes a few hundred KB.
+from array import array
+
+
+def _pack(strings):
+    # sorted strings -> (fixed width blob, width)
+    encoded = [s.encode('utf-8') for s in strings]
+    width = max((len(s) for s in encoded), default=1)
+    return b''.join(s.ljust(width, b'\0') for s in encoded), width
+
+
+def _find(blob: bytes, width: int, s: str):
+    # position of s in a blob made by _pack, or -1
+    key = s.encode('utf-8')
+    if len(key) > width:
+        return -1
+    key = key.ljust(width, b'\0')
+    lo, hi = 0, len(blob) // width
+    while lo < hi:
+        mid = (lo + hi) // 2
+        value = blob[mid * width:(mid + 1) * width]
+        if value < key:
+            lo = mid + 1
+        elif value > key:
+            hi = mid
+        else:
+            return mid
+    return -1
+
+
+def _unpad(value: bytes) -> str:
+    return value.rstrip(b'\0').decode('utf-8')
+
+
+class StopIndex:
+    def __init__(self, stops, names: dict = None):
+        """
+        stops is an iterable of (stop_id, stop_number) pairs, and names maps stop numbers to names.
+        """
+        stops = sorted(stops)
+        numbers = sorted(set(stop_number for _, stop_number in stops))
+        names = names or {}
+        self._ids, self._id_width = _pack(stop_id for stop_id, _ in stops)
+        self._numbers, self._number_width = _pack(numbers)
+        number_positions = {stop_number: i for i, stop_number in enumerate(numbers)}
+        # position in _numbers of the number of each stop_id
+        self._id_numbers = array('I', (number_positions[stop_number] for _, stop_number in stops))
+        # position in _ids of the first stop_id of each number
+        self._number_ids = array('I', [0] * len(numbers))
+        for i, (_, stop_number) in reversed(list(enumerate(stops))):
+            self._number_ids[number_positions[stop_number]] = i
+        # names of each number, as one blob with offsets
+        encoded_names = [(names.get(stop_number) or "").encode('utf-8') for stop_number in numbers]
+        self._names = b''.join(encoded_names)
+        self._name_offsets = array('I', [0])
+        for name in encoded_names:
+            self._name_offsets.append(self._name_offsets[-1] + len(name))
+
+    @classmethod
+    def from_store(cls, store):
+        # build the index from the 'stop' (stop_id -> stop number) and 'stop_names' namespaces
+        return cls(store.items('stop'), dict(store.items('stop_names')))
+
+    def __len__(self):
+        return len(self._numbers) // self._number_width
+
+    def __contains__(self, stop_number: str):
+        return _find(self._numbers, self._number_width, stop_number) >= 0
+
+    def stop_numbers(self):
+        for i in range(len(self)):
+            yield _unpad(self._numbers[i * self._number_width:(i + 1) * self._number_width])
+
+    def stop_number(self, stop_id: str):
+        # the stop number of a stop_id, or None
+        i = _find(self._ids, self._id_width, stop_id)
+        if i < 0:
+            return None
+        position = self._id_numbers[i]
+        return _unpad(self._numbers[position * self._number_width:(position + 1) * self._number_width])
+
+    def stop_id(self, stop_number: str):
+        # a stop_id of a stop number, or None
+        position = _find(self._numbers, self._number_width, stop_number)
+        if position < 0:
+            return None
+        i = self._number_ids[position]
+        return _unpad(self._ids[i * self._id_width:(i + 1) * self._id_width])
+
+    def name(self, stop_number: str):
+        position = _find(self._numbers, self._number_width, stop_number)
+        if position < 0:
+            return None
+        return self._names[self._name_offsets[position]:self._name_offsets[position + 1]].decode('utf-8') or None
+
+    def normalize(self, s: str):
+        """
+        Return the stop number for a stop number, a stop_id or a zero-padded stop number, or None
+        if it isn't a known stop.
+        """
+        s = (s or "").strip()
+        if not s:
+            return None
+        if s in self:
+            return s
+        stop_number = self.stop_number(s)
+        if stop_number is not None:
+            return stop_number
+        if s.isdigit() and str(int(s)) in self:
+            return str(int(s))
+        return None
@@ -1,145 +1,736 @@
-# A class with a dictionary interface that stores data either in memory
-# of in redis, depending on how it is initialized.
+# A class with a dictionary interface that stores data in one of several backends, depending on
+# how it is initialized:
+#  - in-process dicts, persisted to a pickle file (the default)
+#  - redis ("redis://host:port")
+#  - SQLite ("sqlite:///relative/path.sqlite" or "sqlite:////absolute/path.sqlite")
+#  - LMDB, a memory-mapped key-value store ("lmdb:///relative/path" or "lmdb:////absolute/path",
+#    needs the `lmdb` package)
+#
+# Data is organised in namespaces, each of which holds either key-value pairs or a set of strings.
+# The in-process backend keeps values as python objects. The other backends store bytes, encoded
+# with a codec chosen per namespace, so that packed binary values aren't pickled again.
 import os
+import json
 import pickle
-import redis
+import struct
 import time
 import logging
+import threading
 import collections
+from urllib.parse import urlparse
 
 import settings
 import size
 
+# Faster serialisation of simple values, if installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 CACHE_FILE = settings.DATA_DIR / "cache.pickle"
+# Bump when the encoding of stored values changes, so that old data in persistent backends is discarded
+FORMAT_VERSION = "2"
+# Prefix of the namespaces a new dataset is written to in a backend shared with other processes,
+# before it is swapped in (see Store.staged)
+STAGING_PREFIX = "_staging:"
+# Maximum size of an LMDB database
+LMDB_MAP_SIZE = int(os.environ.get('LMDB_MAP_SIZE', 8 * 1024 ** 3))
+
+
+class Codec:
+    # Converts the values of a namespace to and from bytes. The default pickles them.
+    def encode(self, value) -> bytes:
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data: bytes):
+        return pickle.loads(data)
+
+class BytesCodec(Codec):
+    # for values that are already packed
+    def encode(self, value):
+        return value
+
+    def decode(self, data):
+        return bytes(data)
+
+class StrCodec(Codec):
+    def encode(self, value):
+        return value.encode('utf-8')
+
+    def decode(self, data):
+        return bytes(data).decode('utf-8')
+
+class IntCodec(Codec):
+    def encode(self, value):
+        return struct.pack('<q', value)
+
+    def decode(self, data):
+        return struct.unpack('<q', data)[0]
+
+class FixedWidthListCodec(Codec):
+    # for lists of packed records that are all `width` bytes long
+    def __init__(self, width: int):
+        self.width = width
+
+    def encode(self, value):
+        return b''.join(value)
+
+    def decode(self, data):
+        data = bytes(data)
+        return [data[i:i + self.width] for i in range(0, len(data), self.width)]
+
+class MsgpackCodec(Codec):
+    # for dicts, lists, strings and numbers. Uses JSON if msgpack isn't installed.
+    def encode(self, value):
+        if msgpack is not None:
+            return msgpack.packb(value)
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, data):
+        if msgpack is not None:
+            return msgpack.unpackb(data)
+        return json.loads(data)
+
+PICKLE = Codec()
+BYTES = BytesCodec()
+STR = StrCodec()
+INT = IntCodec()
+MSGPACK = MsgpackCodec()
+
+
+class DictBackend:
+    # in-process dicts (and sets) of python objects, persisted to CACHE_FILE
+    is_local = True
+
+    def __init__(self):
+        self.data = collections.defaultdict(dict)
+
+    def get(self, namespace, key):
+        return self.data.get(namespace, {}).get(key)
+
+    def set(self, namespace, key, value):
+        self.data[namespace][key] = value
+
+    def delete(self, namespace, key):
+        ns = self.data.get(namespace, {})
+        if key in ns:
+            del ns[key]
+
+    def add(self, namespace, value):
+        self.data.setdefault(namespace, set()).add(value)
+
+    def remove(self, namespace, value):
+        self.data.setdefault(namespace, set()).discard(value)
+
+    def has(self, namespace, value):
+        return value in self.data.get(namespace, ())
+
+    def cardinality(self, namespace):
+        return len(self.data.get(namespace, ()))
+
+    def members(self, namespace):
+        return iter(list(self.data.get(namespace, ())))
+
+    def items(self, namespace):
+        return iter(list(self.data.get(namespace, {}).items()))
+
+    def clear(self, keep=()):
+        data = collections.defaultdict(dict)
+        for namespace in keep:
+            if namespace in self.data:
+                data[namespace] = self.data[namespace]
+        self.data = data
+
+    def save(self):
+        with open(CACHE_FILE, "wb") as f:
+            pickle.dump(self.data, f)
+
+    def load(self):
+        if os.path.exists(CACHE_FILE):
+            with open(CACHE_FILE, "rb") as f:
+                logging.info("Loading GTFS static data from cache.")
+                self.data = pickle.load(f)
+
+    def close(self):
+        pass
+
+    def memory_usage(self):
+        return {f"In-process '{namespace}'": size.total_size(self.data[namespace]) for namespace in self.data}
+
+
+class RedisBackend:
+    # a hash per key-value namespace and a set per set namespace. The database may hold other data,
+    # so only the namespaces given (and their staged copies) are ever cleared.
+    is_local = False
+
+    def __init__(self, url: str, codec, namespaces=()):
+        import redis
+        logging.info("Using redis for data storage at %s", url)
+        self.redis = redis.from_url(url)
+        self.codec = codec
+        self.namespaces = set(namespaces)
+        if self.redis.hget('_store', 'format') != FORMAT_VERSION.encode('utf-8'):
+            if any(self._owned_keys()):
+                logging.warning("Discarding data stored in redis in an older format.")
+            self.clear()
+
+    def get(self, namespace, key):
+        data = self.redis.hget(namespace, key)
+        return None if data is None else self.codec(namespace).decode(data)
+
+    def set(self, namespace, key, value):
+        self.redis.hset(namespace, key, self.codec(namespace).encode(value))
+
+    def delete(self, namespace, key):
+        self.redis.hdel(namespace, key)
+
+    def add(self, namespace, value):
+        self.redis.sadd(namespace, value)
+
+    def remove(self, namespace, value):
+        self.redis.srem(namespace, value)
+
+    def has(self, namespace, value):
+        return self.redis.sismember(namespace, value) == 1
+
+    def cardinality(self, namespace):
+        return self.redis.scard(namespace)
+
+    def members(self, namespace):
+        for value in self.redis.sscan_iter(namespace):
+            yield value.decode('utf-8')
+
+    def items(self, namespace):
+        codec = self.codec(namespace)
+        for key, data in self.redis.hscan_iter(namespace):
+            yield key.decode('utf-8'), codec.decode(data)
+
+    def _owned_keys(self):
+        # the keys of this store's namespaces, staged or not
+        for key in self.redis.scan_iter():
+            key = key.decode('utf-8')
+            if key.startswith(STAGING_PREFIX) or key in self.namespaces:
+                yield key
+
+    def clear(self, keep=()):
+        for key in list(self._owned_keys()):
+            if key not in keep:
+                self.redis.delete(key)
+        self.redis.hset('_store', 'format', FORMAT_VERSION)
+
+    def clear_staged(self):
+        for key in self.redis.scan_iter(match=f"{STAGING_PREFIX}*"):
+            self.redis.delete(key)
+
+    def swap_in_staged(self, keep=()):
+        # in one transaction, drop the namespaces not kept and rename the staged ones in their place
+        keys = list(self._owned_keys())
+        staged = [key for key in keys if key.startswith(STAGING_PREFIX)]
+        pipeline = self.redis.pipeline(transaction=True)
+        for key in keys:
+            if key not in keep and not key.startswith(STAGING_PREFIX):
+                pipeline.delete(key)
+        for key in staged:
+            pipeline.rename(key, key[len(STAGING_PREFIX):])
+        pipeline.execute()
+
+    def save(self):
+        self.redis.save()
+
+    def load(self):
+        pass
+
+    def close(self):
+        self.redis.close()
+
+    def memory_usage(self):
+        res = {'redis': self.redis.info('memory')['used_memory']}
+        for key in self.redis.scan_iter():
+            res[f"Redis '{key.decode('utf-8')}'"] = self.redis.memory_usage(key, samples=0)
+        return res
+
+
+class SqliteBackend:
+    # a table of key-value pairs and a table of set members, keyed on namespace
+    is_local = False
+    # commit writes at least this often (in seconds), so that other processes see them
+    COMMIT_INTERVAL = 1.0
+
+    def __init__(self, path: str, codec):
+        import sqlite3
+        logging.info("Using SQLite for data storage at %s", path)
+        self.path = path
+        self.codec = codec
+        # the connection is shared by request threads, so access to it is serialised
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS kv (namespace TEXT, key TEXT, value BLOB, PRIMARY KEY (namespace, key)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS members (namespace TEXT, value TEXT, PRIMARY KEY (namespace, value)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'format'").fetchone()
+        if row is None or row[0] != FORMAT_VERSION:
+            self.clear()
+        self.db.commit()
+        self.last_commit = time.monotonic()
+
+    def _write(self, sql, params):
+        with self.lock:
+            self.db.execute(sql, params)
+            if time.monotonic() - self.last_commit > self.COMMIT_INTERVAL:
+                self.db.commit()
+                self.last_commit = time.monotonic()
+
+    def _read(self, sql, params):
+        with self.lock:
+            return self.db.execute(sql, params).fetchone()
+
+    def get(self, namespace, key):
+        row = self._read("SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+        return None if row is None else self.codec(namespace).decode(row[0])
+
+    def set(self, namespace, key, value):
+        self._write("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", (namespace, key, self.codec(namespace).encode(value)))
+
+    def delete(self, namespace, key):
+        self._write("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def add(self, namespace, value):
+        self._write("INSERT OR IGNORE INTO members VALUES (?, ?)", (namespace, str(value)))
+
+    def remove(self, namespace, value):
+        self._write("DELETE FROM members WHERE namespace = ? AND value = ?", (namespace, str(value)))
+
+    def has(self, namespace, value):
+        return self._read("SELECT 1 FROM members WHERE namespace = ? AND value = ?", (namespace, str(value))) is not None
+
+    def cardinality(self, namespace):
+        return self._read("SELECT COUNT(*) FROM members WHERE namespace = ?", (namespace,))[0]
+
+    def members(self, namespace):
+        with self.lock:
+            values = [row[0] for row in self.db.execute("SELECT value FROM members WHERE namespace = ?", (namespace,))]
+        return iter(values)
+
+    def items(self, namespace):
+        with self.lock:
+            rows = self.db.execute("SELECT key, value FROM kv WHERE namespace = ?", (namespace,)).fetchall()
+        codec = self.codec(namespace)
+        return ((key, codec.decode(value)) for key, value in rows)
+
+    def clear(self, keep=()):
+        with self.lock:
+            placeholders = ",".join("?" * len(keep))
+            for table in ("kv", "members"):
+                self.db.execute(f"DELETE FROM {table} WHERE namespace NOT IN ({placeholders})", tuple(keep))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('format', ?)", (FORMAT_VERSION,))
+            self.db.commit()
+
+    def clear_staged(self):
+        with self.lock:
+            for table in ("kv", "members"):
+                self.db.execute(f"DELETE FROM {table} WHERE substr(namespace, 1, ?) = ?", (len(STAGING_PREFIX), STAGING_PREFIX))
+            self.db.commit()
+
+    def swap_in_staged(self, keep=()):
+        # in one transaction, drop the namespaces not kept and rename the staged ones in their place
+        with self.lock:
+            placeholders = ",".join("?" * len(keep))
+            for table in ("kv", "members"):
+                self.db.execute(f"DELETE FROM {table} WHERE namespace NOT IN ({placeholders}) AND substr(namespace, 1, ?) != ?",
+                                tuple(keep) + (len(STAGING_PREFIX), STAGING_PREFIX))
+                self.db.execute(f"UPDATE {table} SET namespace = substr(namespace, ?) WHERE substr(namespace, 1, ?) = ?",
+                                (len(STAGING_PREFIX) + 1, len(STAGING_PREFIX), STAGING_PREFIX))
+            self.db.commit()
+            self.last_commit = time.monotonic()
+
+    def save(self):
+        with self.lock:
+            self.db.commit()
+            self.last_commit = time.monotonic()
+
+    def load(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+    def memory_usage(self):
+        return {'sqlite_file': os.path.getsize(self.path)}
+
+
+class LmdbBackend:
+    # Key-value pairs and set members in two LMDB databases, keyed on "<namespace>\0<key>".
+    # Reads come straight from the memory-mapped file, which the OS shares between processes.
+    is_local = False
+
+    def __init__(self, path: str, codec):
+        import lmdb
+        logging.info("Using LMDB for data storage at %s", path)
+        # writes are made durable by save(), rather than on every commit
+        self.env = lmdb.open(path, map_size=LMDB_MAP_SIZE, max_dbs=3, sync=False, metasync=False)
+        self.kv = self.env.open_db(b'kv')
+        self.sets = self.env.open_db(b'sets')
+        self.meta = self.env.open_db(b'meta')
+        self.codec = codec
+        with self.env.begin(db=self.meta) as txn:
+            stored_format = txn.get(b'format')
+        if stored_format != FORMAT_VERSION.encode('utf-8'):
+            self.clear()
+
+    def _key(self, namespace, key):
+        return f"{namespace}\0{key}".encode('utf-8')
+
+    def get(self, namespace, key):
+        with self.env.begin(db=self.kv) as txn:
+            data = txn.get(self._key(namespace, key))
+        return None if data is None else self.codec(namespace).decode(data)
+
+    def set(self, namespace, key, value):
+        with self.env.begin(db=self.kv, write=True) as txn:
+            txn.put(self._key(namespace, key), self.codec(namespace).encode(value))
+
+    def delete(self, namespace, key):
+        with self.env.begin(db=self.kv, write=True) as txn:
+            txn.delete(self._key(namespace, key))
+
+    def add(self, namespace, value):
+        with self.env.begin(db=self.sets, write=True) as txn:
+            txn.put(self._key(namespace, value), b'')
+
+    def remove(self, namespace, value):
+        with self.env.begin(db=self.sets, write=True) as txn:
+            txn.delete(self._key(namespace, value))
+
+    def has(self, namespace, value):
+        with self.env.begin(db=self.sets) as txn:
+            return txn.get(self._key(namespace, value)) is not None
+
+    def members(self, namespace):
+        prefix = self._key(namespace, "")
+        values = []
+        with self.env.begin(db=self.sets) as txn:
+            cursor = txn.cursor()
+            if cursor.set_range(prefix):
+                for key in cursor.iternext(values=False):
+                    if not key.startswith(prefix):
+                        break
+                    values.append(key[len(prefix):].decode('utf-8'))
+        return iter(values)
+
+    def items(self, namespace):
+        prefix = self._key(namespace, "")
+        items = []
+        with self.env.begin(db=self.kv) as txn:
+            cursor = txn.cursor()
+            if cursor.set_range(prefix):
+                for key, data in cursor.iternext():
+                    if not key.startswith(prefix):
+                        break
+                    items.append((key[len(prefix):].decode('utf-8'), data))
+        codec = self.codec(namespace)
+        return ((key, codec.decode(data)) for key, data in items)
+
+    def cardinality(self, namespace):
+        return sum(1 for _ in self.members(namespace))
+
+    def clear(self, keep=()):
+        keep = tuple(self._key(namespace, "") for namespace in keep)
+        with self.env.begin(write=True) as txn:
+            for db in (self.kv, self.sets):
+                if not keep:
+                    txn.drop(db, delete=False)
+                    continue
+                cursor = txn.cursor(db)
+                for key in list(cursor.iternext(values=False)):
+                    if not key.startswith(keep):
+                        txn.delete(key, db=db)
+            txn.put(b'format', FORMAT_VERSION.encode('utf-8'), db=self.meta)
+        self.env.sync(True)
+
+    def clear_staged(self):
+        staging = STAGING_PREFIX.encode('utf-8')
+        with self.env.begin(write=True) as txn:
+            for db in (self.kv, self.sets):
+                for key in list(txn.cursor(db).iternext(values=False)):
+                    if key.startswith(staging):
+                        txn.delete(key, db=db)
+
+    def swap_in_staged(self, keep=()):
+        # in one transaction, drop the namespaces not kept and rename the staged ones in their place
+        keep = tuple(self._key(namespace, "") for namespace in keep)
+        staging = STAGING_PREFIX.encode('utf-8')
+        with self.env.begin(write=True) as txn:
+            for db in (self.kv, self.sets):
+                for key, data in list(txn.cursor(db).iternext()):
+                    if key.startswith(staging):
+                        txn.delete(key, db=db)
+                        txn.put(key[len(staging):], data, db=db)
+                    elif not key.startswith(keep):
+                        txn.delete(key, db=db)
+        self.env.sync(True)
+
+    def save(self):
+        self.env.sync(True)
+
+    def load(self):
+        pass
+
+    def close(self):
+        self.env.close()
+
+    def memory_usage(self):
+        info = self.env.info()
+        return {'lmdb_map_size': info['map_size'], 'lmdb_used': self.env.stat()['psize'] * info['last_pgno']}
+
+
+class LRUCache:
+    """
+    A thread-safe cache of values read from a backend, bounded in size, with least recently used
+    entries evicted first and entries expiring after a time to live. Values found not to exist are
+    cached as negative entries, with their own time to live.
+    """
+    MISSING = object()
+
+    def __init__(self, maxsize: int = 10000, ttl: float = None, negative_ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl if negative_ttl is not None else ttl
+        # key -> (expiry time or None, value or MISSING)
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.negative_hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key):
+        # the cached value, None for a negative entry, or MISSING if the key isn't cached
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return LRUCache.MISSING
+            expires, value = item
+            if expires is not None and time.monotonic() >= expires:
+                del self.items[key]
+                self.expirations += 1
+                self.misses += 1
+                return LRUCache.MISSING
+            self.items.move_to_end(key)
+            if value is LRUCache.MISSING:
+                self.negative_hits += 1
+                return None
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        # cache a value, or a negative entry if value is None
+        ttl = self.ttl if value is not None else self.negative_ttl
+        with self.lock:
+            self.items[key] = (time.monotonic() + ttl if ttl is not None else None, value if value is not None else LRUCache.MISSING)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'size': len(self.items),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+def _url_path(url: str) -> str:
+    # the file path in a URL like "scheme:///path", which is relative unless it starts with another '/'
+    return url.split('://', 1)[1][1:]
+
 
 class Store:
-    def __init__(self, redis_url:str=None, namespace_config:dict[dict[str]]={}):
+    def __init__(self, url:str=None, namespace_config:dict[dict[str]]={}, load_cache:bool=True):
+        # url selects the backend (see the top of this file), defaulting to in-process dicts.
         # namespace_config is a dictionary specifying treatment of different pieces of data.
         # Each key is the prefix ending before the first '%' in keys that it should be matched against.
         # Potential values are:
-        #  - cache: store the value in memory as well as redis for faster retrieval next time
-        #  - expiry: set an expiry time on the key
+        #  - cache: keep values in memory as well as in the backend for faster retrieval next time.
+        #    Only used with backends outside the process.
+        #  - cache_size: the most values to keep in memory (default: 10000)
+        #  - expiry: how long to keep cached values for, in seconds (default: forever)
+        #  - negative_expiry: how long to remember that a key doesn't exist, in seconds (default: expiry)
+        #  - codec: the Codec used by backends that store bytes (default: PICKLE)
+        # A redis database may be shared with other data, so only the namespaces listed here are
+        # cleared from it.
         self.namespace_config = namespace_config
-        self.data = collections.defaultdict(dict)
-        if redis_url:
-            logging.info("Using redis for data storage at %s", redis_url)
-            self.redis = redis.from_url(redis_url)
-        else:
-            self.redis = None
-        self.reload_cache()
-    
-    def clear_cache(self):
-        if self.redis:
-            self.redis.flushdb()
+        self.caches = {
+            namespace: LRUCache(config.get('cache_size', 10000), config.get('expiry'), config.get('negative_expiry'))
+            for namespace, config in namespace_config.items() if config.get('cache')
+        }
+        scheme = urlparse(url).scheme if url else None
+        if scheme is None:
+            self.backend = DictBackend()
+        elif scheme in ('redis', 'rediss', 'unix'):
+            self.backend = RedisBackend(url, self.codec, namespace_config.keys())
+        elif scheme == 'sqlite':
+            self.backend = SqliteBackend(_url_path(url), self.codec)
+        elif scheme == 'lmdb':
+            self.backend = LmdbBackend(_url_path(url), self.codec)
         else:
-            self.data = collections.defaultdict(dict)
+            raise ValueError(f"Unsupported data store URL {url}")
+        if self.is_local:
+            # there's no need to cache values held in the process already
+            self.caches = {}
+        if load_cache:
+            self.reload_cache()
+
+    @property
+    def is_local(self):
+        # whether the data lives in this process only
+        return self.backend.is_local
+
+    @property
+    def data(self):
+        # the namespaces of the in-process backend
+        return self.backend.data
+
+    def codec(self, namespace) -> Codec:
+        if namespace.startswith(STAGING_PREFIX):
+            namespace = namespace[len(STAGING_PREFIX):]
+        return self.namespace_config.get(namespace, {}).get('codec', PICKLE)
+
+    def _clear_caches(self):
+        for cache in self.caches.values():
+            cache.clear()
+
+    def cache_stats(self) -> dict:
+        # hit, miss and eviction counts of the in-memory cache of each namespace
+        return {namespace: cache.stats() for namespace, cache in self.caches.items()}
+
+    def clear_cache(self, keep=()):
+        # keep is a list of namespaces to leave in place
+        self.backend.clear(keep)
+        self._clear_caches()
         # Remove the cache
         if os.path.exists(CACHE_FILE):
             os.remove(CACHE_FILE)
-    
+
     def write_cache(self):
-        if self.redis:
-            self.redis.save()
-        else:
-            with open(CACHE_FILE, "wb") as f:
-                pickle.dump(self.data, f)
-    
+        self.backend.save()
+
     def reload_cache(self):
-        if os.path.exists(CACHE_FILE):
-            with open(CACHE_FILE, "rb") as f:
-                logging.info("Loading GTFS static data from cache.")
-                self.data = pickle.load(f)
-    
+        self.backend.load()
+        self._clear_caches()
+
+    def close(self):
+        # release the backend's connection or files
+        self.backend.close()
+
+    def replace_with(self, other: 'Store', keep=()):
+        # Take over the data of another in-process store, apart from the namespaces in keep. The
+        # switch is a single assignment, so readers see either the old data or the new.
+        for namespace in keep:
+            if namespace in self.data:
+                other.data[namespace] = self.data[namespace]
+        self.backend = other.backend
+        self._clear_caches()
+
+    def staged(self) -> '_StagedStore':
+        # Where to write a new dataset in a backend shared with other processes, so that they keep
+        # reading the old one until swap_in_staged() replaces it in one transaction.
+        self.backend.clear_staged()
+        return _StagedStore(self)
+
+    def swap_in_staged(self, keep=()):
+        # replace every namespace apart from those in keep with the staged dataset
+        self.backend.swap_in_staged(keep)
+        self._clear_caches()
+
     def profile_memory(self):
-        res = {}
-        if self.redis:
-            res['redis'] = self.redis.info('memory')['used_memory']
-        in_proc = {}
-        for key in self.data:
-            in_proc[f"In-process '{key}'"] = size.total_size(self.data[key])
-        res['in_process'] = sum(in_proc.values())
-        res.update(in_proc)
+        res = self.backend.memory_usage()
+        if self.is_local:
+            res['in_process'] = sum(res.values())
+        else:
+            cached = {f"Cached '{namespace}'": size.total_size(dict(cache.items)) for namespace, cache in self.caches.items()}
+            res['in_process'] = sum(cached.values())
+            res.update(cached)
         return res
 
     def get(self, namespace, key, default=None):
-        config = self.namespace_config.get(namespace, {})
-        now = int(time.time())
-        expiry = config.get('expiry')
-        is_cachable = config.get('cache')
-
-        value = None
-        cached_item = self.data.get(namespace, {}).get(key)
-        if cached_item:
-            if is_cachable:
-                t, cached_value = cached_item
-                try:
-                    if expiry is None or now - t < expiry:
-                        value = cached_value
-                    else:
-                        del self.data[namespace][key]
-                except TypeError:
-                    # Try to catch an infrequent cache where now or t is a string
-                    logging.error(f"Error unpacking cached item ns: {namespace}: {key} = {cached_item}. Now ({type(now)})={now}, t ({type(t)}))={t}", namespace, key, cached_item)
-            else:
-                value = cached_item
-        
-        if value is None and self.redis:
-            value = self.redis.hget(namespace, key)
-            if value is not None:
-                value = pickle.loads(value)
-            # if we still don't have a value, use the default
-            if value is None:
-                value = default
-            # cache the value if we're supposed to
-            if is_cachable:
-                self.data[namespace][key] = (now, value)
-        
+        cache = self.caches.get(namespace)
+        if cache is None:
+            value = self.backend.get(namespace, key)
+            return value if value is not None else default
+        value = cache.get(key)
+        if value is LRUCache.MISSING:
+            value = self.backend.get(namespace, key)
+            cache.put(key, value)
         return value if value is not None else default
 
     def set(self, namespace, key, value):
-        config = self.namespace_config.get(namespace, {})
-        if self.redis:
-            self.redis.hset(namespace, key, pickle.dumps(value))
-        else:
-            is_cachable = config.get('cache')
-            if is_cachable:
-                value = (int(time.time()), value)
-            self.data[namespace][key] = value
-    
+        self.backend.set(namespace, key, value)
+        self._invalidate(namespace, key)
+
     def delete(self, namespace, key):
-        if self.redis:
-            self.redis.hdel(namespace, key)
-        else:
-            ns = self.data.get(namespace, {})
-            if key in ns:
-                del ns[key]
-    
+        self.backend.delete(namespace, key)
+        self._invalidate(namespace, key)
+
+    def _invalidate(self, namespace, key):
+        cache = self.caches.get(namespace)
+        if cache is not None:
+            cache.invalidate(key)
+
     # set operations including add, remove and has
     def add(self, namespace, value):
-        config = self.namespace_config.get(namespace, {})
-        if self.redis:
-            self.redis.sadd(namespace, value)
-        else:
-            self.data.setdefault(namespace, set()).add(value)
-    
+        self.backend.add(namespace, value)
+        self._invalidate(namespace, value)
+
     def remove(self, namespace, value):
-        if self.redis:
-            self.redis.srem(namespace, value)
-        else:
-            self.data.setdefault(namespace, set()).discard(value)
-    
+        self.backend.remove(namespace, value)
+        self._invalidate(namespace, value)
+
     def has(self, namespace, value):
-        config = self.namespace_config.get(namespace, {})
-        if self.redis:
-            return self.redis.sismember(namespace, value) == 1
-        else:
-            return value in self.data.setdefault(namespace, set())
-    
+        cache = self.caches.get(namespace)
+        if cache is None:
+            return self.backend.has(namespace, value)
+        # membership is cached as True, or as a negative entry
+        is_member = cache.get(value)
+        if is_member is LRUCache.MISSING:
+            is_member = self.backend.has(namespace, value) or None
+            cache.put(value, is_member)
+        return bool(is_member)
+
+    def members(self, namespace):
+        # iterate over the values of a set
+        return self.backend.members(namespace)
+
+    def items(self, namespace):
+        # iterate over the (key, value) pairs of a key-value namespace, bypassing the cache
+        return self.backend.items(namespace)
+
     def cardinality(self, namespace):
-        if self.redis:
-            return self.redis.scard(namespace)
-        else:
-            return len(self.data.setdefault(namespace, set()))
+        return self.backend.cardinality(namespace)
+
 
+class _StagedStore:
+    # writes to a store's namespaces under STAGING_PREFIX
+    def __init__(self, store: Store):
+        self.store = store
 
-    
\ No newline at end of file
+    def set(self, namespace, key, value):
+        self.store.backend.set(STAGING_PREFIX + namespace, key, value)
+
+    def add(self, namespace, value):
+        self.store.backend.add(STAGING_PREFIX + namespace, value)
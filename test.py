@@ -5,12 +5,30 @@
 
 import unittest
 import os
+import json
 import datetime
 from pathlib import Path
+from unittest import mock
 
 import gtfs
 import store
 import settings
+import boards
+import render
+import archive
+import stopindex
+import singleflight
+import proxy
+import republish
+import gtfsr
+import tracing
+import ingest
+
+def skip_static_data_check(test):
+    # tests don't make requests for newer static data
+    patcher = mock.patch('gtfs.check_for_new_static_data', return_value=False)
+    patcher.start()
+    test.addCleanup(patcher.stop)
 
 class TestStore(unittest.TestCase):
     
@@ -74,17 +92,176 @@ class TestStore(unittest.TestCase):
         store.CACHE_FILE = old_cache_file
 
 
+class TestStoreBackends(unittest.TestCase):
+
+    def setUp(self):
+        skip_static_data_check(self)
+        self.urls = ["sqlite:///test_data/store_test.sqlite"]
+        try:
+            import lmdb
+            self.urls.append("lmdb:///test_data/store_test.lmdb")
+        except ImportError:
+            pass
+
+    def test_backends(self):
+        namespace_config = {'packed': {'codec': store.FixedWidthListCodec(2)}, 'number': {'codec': store.INT, 'cache': True}}
+        for url in self.urls:
+            s = store.Store(url, namespace_config)
+            s.set('packed', 'a', [b'ab', b'cd'])
+            s.set('number', 'n', 5)
+            s.set('other', 'o', {'x': [1, 2]})
+            s.add('testset', "1")
+            s.add('testset', "2")
+            self.assertEqual(s.get('packed', 'a'), [b'ab', b'cd'])
+            self.assertEqual(s.get('number', 'n'), 5)
+            s.set('number', 'n', 6)
+            self.assertEqual(s.get('number', 'n'), 6)
+            self.assertEqual(s.get('other', 'o'), {'x': [1, 2]})
+            self.assertEqual(s.get('other', 'missing', 0), 0)
+            self.assertTrue(s.has('testset', "2"))
+            self.assertEqual(sorted(s.members('testset')), ["1", "2"])
+            self.assertEqual(dict(s.items('number')), {'n': 6})
+            s.write_cache()
+            s.close()
+
+            # the data persists, and clearing can keep some namespaces
+            s = store.Store(url, namespace_config)
+            self.assertEqual(s.cardinality('testset'), 2)
+            s.clear_cache(keep=('other',))
+            self.assertIsNone(s.get('packed', 'a'))
+            self.assertEqual(s.cardinality('testset'), 0)
+            self.assertEqual(s.get('other', 'o'), {'x': [1, 2]})
+            s.close()
+
+    def test_staged_swap(self):
+        # a dataset written alongside the old one replaces it in one go
+        namespace_config = {'packed': {'codec': store.FixedWidthListCodec(2)}}
+        for url in self.urls:
+            s = store.Store(url, namespace_config)
+            s.clear_cache()
+            s.set('packed', 'a', [b'ab'])
+            s.add('testset', "1")
+            s.set('live', 'l', 1)
+            staged = s.staged()
+            staged.set('packed', 'b', [b'cd', b'ef'])
+            staged.add('testset', "2")
+            self.assertEqual(s.get('packed', 'a'), [b'ab'])
+            self.assertIsNone(s.get('packed', 'b'))
+            self.assertEqual(list(s.members('testset')), ["1"])
+            s.swap_in_staged(keep=('live',))
+            self.assertIsNone(s.get('packed', 'a'))
+            self.assertEqual(s.get('packed', 'b'), [b'cd', b'ef'])
+            self.assertEqual(list(s.members('testset')), ["2"])
+            self.assertEqual(s.get('live', 'l'), 1)
+            self.assertEqual(list(s.items(store.STAGING_PREFIX + 'packed')), [])
+            s.close()
+
+    def test_redis_shared_database(self):
+        # data in a redis database that isn't the store's survives a change of format
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest("fakeredis is not installed")
+        server = fakeredis.FakeServer()
+        with mock.patch('redis.from_url', lambda url: fakeredis.FakeRedis(server=server)):
+            client = fakeredis.FakeRedis(server=server)
+            client.hset('route', 'a', b'old')
+            client.hset('_staging:route', 'b', b'old')
+            client.set('someone_else', b'keep')
+            s = store.Store("redis://localhost", {'route': {}})
+            self.assertEqual(sorted(client.keys()), [b'_store', b'someone_else'])
+            s.set('route', 'a', 1)
+            s.clear_cache()
+            self.assertEqual(client.get('someone_else'), b'keep')
+            self.assertIsNone(s.get('route', 'a'))
+            s.close()
+
+    def test_read_through_cache(self):
+        import time
+        namespace_config = {
+            'trip': {'cache': True, 'cache_size': 2, 'negative_expiry': 0.05},
+            'stop_numbers': {'cache': True},
+        }
+        s = store.Store(self.urls[0], namespace_config)
+        for key in ('a', 'b', 'c'):
+            s.set('trip', key, key.upper())
+        s.add('stop_numbers', "1358")
+        self.assertEqual(s.get('trip', 'a'), "A")
+        self.assertEqual(s.get('trip', 'a'), "A")
+        self.assertEqual(s.get('trip', 'b'), "B")
+        # 'c' evicts 'a', the least recently used
+        self.assertEqual(s.get('trip', 'c'), "C")
+        stats = s.cache_stats()['trip']
+        self.assertEqual((stats['size'], stats['hits'], stats['misses'], stats['evictions']), (2, 1, 3, 1))
+
+        # unknown keys are cached as negative entries until they expire, or are set
+        self.assertIsNone(s.get('trip', 'x'))
+        self.assertEqual(s.get('trip', 'x', "default"), "default")
+        self.assertEqual(s.cache_stats()['trip']['negative_hits'], 1)
+        s.backend.set('trip', 'x', "X")
+        self.assertIsNone(s.get('trip', 'x'))
+        time.sleep(0.06)
+        self.assertEqual(s.get('trip', 'x'), "X")
+        s.set('trip', 'x', "Y")
+        self.assertEqual(s.get('trip', 'x'), "Y")
+
+        self.assertTrue(s.has('stop_numbers', "1358"))
+        self.assertFalse(s.has('stop_numbers', "9999"))
+        s.add('stop_numbers', "9999")
+        self.assertTrue(s.has('stop_numbers', "9999"))
+        self.assertEqual(s.cache_stats()['stop_numbers']['misses'], 3)
+        s.close()
+
+        # the in-process backend has no need of a cache
+        self.assertEqual(store.Store(namespace_config=namespace_config).cache_stats(), {})
+
+    def test_gtfs_on_backends(self):
+        # The same queries give the same results whichever backend holds the data
+        old_cache_file = store.CACHE_FILE
+        store.CACHE_FILE = Path("test_data/cache.pickle")
+        try:
+            engine = gtfs.GTFS(settings.GTFS_LIVE_URL, settings.API_KEY)
+        finally:
+            store.CACHE_FILE = old_cache_file
+        with open("test_data/test_live_response.gtfsr", 'rb') as f:
+            engine._parse_live_data(f.read())
+        now = datetime.datetime.fromisoformat("2023-09-15T09:10:00")
+        expected = engine.get_scheduled_arrivals("1358", now, datetime.timedelta(minutes=60))
+        dict_store = engine.store
+        for url in self.urls:
+            engine.store = store.Store(url, dict_store.namespace_config)
+            for namespace, values in dict_store.data.items():
+                for key in values:
+                    if isinstance(values, set):
+                        engine.store.add(namespace, key)
+                    else:
+                        engine.store.set(namespace, key, values[key])
+            self.assertEqual(engine.get_scheduled_arrivals("1358", now, datetime.timedelta(minutes=60)), expected)
+            stops = stopindex.StopIndex.from_store(engine.store)
+            self.assertEqual(list(stops.stop_numbers()), list(engine.stops.stop_numbers()))
+            self.assertEqual(stops.name("1358"), engine.stops.name("1358"))
+            engine.store.close()
+
+    def tearDown(self):
+        import shutil
+        for path in ("test_data/store_test.sqlite", "test_data/store_test.sqlite-wal", "test_data/store_test.sqlite-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree("test_data/store_test.lmdb", ignore_errors=True)
+
+
 class TestGTFS(unittest.TestCase):
 
     def setUp(self):
+        skip_static_data_check(self)
         # Load a cached dataset, which was created by filtering for stop 1358 (Dame St.)
         # on 15/9/2023 at 09:10am IST.
         self.old_cache_file = store.CACHE_FILE
         store.CACHE_FILE = Path("test_data/cache.pickle")
         self.gtfs = gtfs.GTFS(settings.GTFS_LIVE_URL, settings.API_KEY)
         with open("test_data/test_live_response.gtfsr", 'rb') as f:
-            live_data = f.read()
-            self.gtfs._parse_live_data(live_data)
+            self.live_data = f.read()
+            self.gtfs._parse_live_data(self.live_data)
 
     def test_string2bytes(self):
         test_string = "test_string123!£$"
@@ -108,9 +285,44 @@ class TestGTFS(unittest.TestCase):
         # Data in test_data/cache.pickle is filtered for stop 1358 (Dame St.)
         self.assertTrue(self.gtfs.is_valid_stop_number("1358"))
     
+    def test_startup(self):
+        # startup doesn't wait for the check for new static data
+        import time
+        import threading
+        checking, answer = threading.Event(), threading.Event()
+        def check_for_new_static_data():
+            checking.set()
+            answer.wait(10)
+            return True
+        with mock.patch('gtfs.check_for_new_static_data', check_for_new_static_data):
+            start_time = time.monotonic()
+            engine = gtfs.GTFS(settings.GTFS_LIVE_URL, settings.API_KEY)
+            self.assertLess(time.monotonic() - start_time, 5)
+            self.assertTrue(checking.wait(5))
+            self.assertIsNone(engine.new_static_data)
+            self.assertGreaterEqual(engine.startup_seconds, 0)
+            answer.set()
+            for _ in range(100):
+                if engine.new_static_data is not None:
+                    break
+                time.sleep(0.01)
+        self.assertTrue(engine.new_static_data)
+
     def test_invalid_stop_number(self):
         self.assertFalse(self.gtfs.is_valid_stop_number("9999"))
 
+    def test_stop_index(self):
+        stops = self.gtfs.stops
+        self.assertEqual(stops.stop_number("8220DB001358"), "1358")
+        self.assertIsNone(stops.stop_number("8220DB009999"))
+        self.assertEqual(stops.stop_id("1358"), "8220DB001358")
+        self.assertEqual(stops.name("1358"), self.gtfs.store.get('stop_names', "1358"))
+        for s in ("1358", "01358", " 8220DB001358"):
+            self.assertEqual(stops.normalize(s), "1358")
+        for s in ("9999", "", "8220DB0013", "DAME"):
+            self.assertIsNone(stops.normalize(s))
+        self.assertEqual(len(stops), self.gtfs.store.cardinality('stop_numbers'))
+
     def test_trip_info(self):
         # trip ID 3599_6532 is a 27 bus trip that is valid for stop 1358
         trip_info = self.gtfs.get_trip_info("3582_11643")
@@ -127,6 +339,113 @@ class TestGTFS(unittest.TestCase):
         live_delay = self.gtfs._get_live_delay(trip_id, stop_sequence)
         self.assertEqual(live_delay, 88)
 
+    def test_pack_live_delays(self):
+        # updates arrive out of order, and the update at stop 7 carried an arrival time instead of a delay
+        packed = self.gtfs._pack_live_delays([(5, 30), (2, 10), (7, None), (9, -20)])
+        self.gtfs.store.set('live_delays', 'test_trip', packed)
+        expected = {1: None, 2: 10, 3: 10, 4: 10, 5: 30, 6: 30, 7: None, 8: None, 9: -20, 40: -20}
+        for stop_sequence, delay in expected.items():
+            self.assertEqual(self.gtfs._get_live_delay('test_trip', stop_sequence), delay)
+
+    def test_selective_live_decoding(self):
+        # Decoding only the entities for trips serving stop 1358 should give the same live data
+        # as decoding the whole feed.
+        self.gtfs.filter_trips = self.gtfs._trips_for_stops(["1358"])
+        self.assertTrue(len(self.gtfs.filter_trips))
+        live_namespaces = ['live_delays', 'live_cancelations', 'live_additions']
+        results = []
+        for selective in (False, True):
+            for namespace in live_namespaces:
+                self.gtfs.store.data.pop(namespace, None)
+            self.gtfs._parse_live_data(self.live_data, selective=selective)
+            results.append({namespace: dict(self.gtfs.store.data.get(namespace, {})) for namespace in live_namespaces})
+        self.assertTrue(len(results[0]['live_delays']))
+        self.assertEqual(results[0], results[1])
+
+    def test_nearby_stops(self):
+        # test_data/cache.pickle predates stop locations, so index a few stops around Dame St.
+        self.gtfs._index_stop_locations([
+            ("1358", 53.344245, -6.263931),
+            ("1359", 53.344450, -6.262440),
+            ("1279", 53.343690, -6.266780),
+            ("7581", 53.290720, -6.136400),
+        ])
+        nearby = self.gtfs.get_nearby_stops(53.3441, -6.2645, count=2, max_distance=1000)
+        self.assertEqual([stop['stop_number'] for stop in nearby], ["1358", "1359"])
+        self.assertLess(nearby[0]['distance'], nearby[1]['distance'])
+        self.assertEqual(nearby[0]['name'], self.gtfs.get_stop_name("1358"))
+        # 7581 is in Dún Laoghaire, well outside the radius
+        self.assertNotIn("7581", [stop['stop_number'] for stop in self.gtfs.get_nearby_stops(53.3441, -6.2645, count=10)])
+        # searches near the poles end
+        self.assertEqual(self.gtfs.get_nearby_stops(90, 0, max_distance=5000), [])
+        self.assertEqual(self.gtfs.get_nearby_stops(-89.99, 0, max_distance=5000), [])
+        # whole cells are searched, so a stop just outside an east-west ring is still found
+        self.assertEqual([stop['stop_number'] for stop in self.gtfs.get_nearby_stops(53.3441, -6.2945, count=1, max_distance=5000)], ["1279"])
+
+        in_bbox = self.gtfs.get_stops_in_bbox(53.34, -6.265, 53.35, -6.26)
+        self.assertEqual(sorted(stop['stop_number'] for stop in in_bbox), ["1358", "1359"])
+        with self.assertRaises(ValueError):
+            self.gtfs.get_stops_in_bbox(51, -11, 56, -5)
+
+    def test_arrivals_for_stops(self):
+        now = datetime.datetime.fromisoformat("2023-09-15T09:10:00")
+        max_wait = datetime.timedelta(minutes=60)
+        arrivals = self.gtfs.get_arrivals_for_stops(["1358", "9999"], now, max_wait)
+        self.assertEqual(len(arrivals), len(self.gtfs.get_scheduled_arrivals("1358", now, max_wait)))
+        self.assertTrue(all(arrival['stop_number'] == "1358" for arrival in arrivals))
+
+    def test_trip_timeline(self):
+        # test_data/cache.pickle predates trip timelines, so index part of trip 3582_6405, a 15
+        # which reaches Dame St. (1358) at 07:45:21 and has live updates up to stop 78.
+        self.gtfs.store.set('trip_stops', "3582_6405", b''.join([
+            self.gtfs._pack_trip_stop("1357", 7 * 3600 + 44 * 60, 46),
+            self.gtfs._pack_trip_stop("1358", 7 * 3600 + 45 * 60 + 21, 47),
+            self.gtfs._pack_trip_stop("4521", 8 * 3600 + 30 * 60, 78),
+        ]))
+        route_id = self.gtfs.get_trip_info("3582_6405")['route_id']
+        self.gtfs.store.set('route_trips', route_id, ["3582_6405"])
+        # another agency's route of the same name
+        self.gtfs.store.set('route', "other_15", {'name': "15", 'agency': "other"})
+        self.gtfs.store.set('agency', "other", "Other Bus")
+        self.gtfs.store.set('route_trips', "other_15", ["no_such_trip"])
+        self.gtfs.store.set('route_ids', "15", [route_id, "other_15"])
+        timeline = self.gtfs.get_trip_timeline("3582_6405", datetime.date(2023, 9, 15))
+        self.assertEqual([stop['stop_number'] for stop in timeline], ["1357", "1358", "4521"])
+        self.assertEqual(timeline[1]['scheduled_arrival'].isoformat(), "2023-09-15T07:45:21")
+        self.assertEqual(timeline[2]['real_time_arrival'].isoformat(), "2023-09-15T08:31:28")
+        self.assertIsNone(self.gtfs.get_trip_timeline("no_such_trip", datetime.date(2023, 9, 15)))
+
+        trips = self.gtfs.get_route_trips("15", datetime.datetime.fromisoformat("2023-09-15T07:50:00"), datetime.timedelta(minutes=60))
+        self.assertEqual([trip['trip_id'] for trip in trips], ["3582_6405"])
+        self.assertEqual([stop['stop_number'] for stop in trips[0]['stops']], ["4521"])
+        self.assertEqual(trips[0]['route_id'], route_id)
+        # routes can be picked out by agency, by agency_id or name
+        self.assertEqual(self.gtfs._route_ids("15", "other"), ["other_15"])
+        self.assertEqual(self.gtfs._route_ids("15", trips[0]['agency']), [route_id])
+        self.assertEqual(self.gtfs.get_route_trips("15", datetime.datetime.fromisoformat("2023-09-15T07:50:00"), datetime.timedelta(minutes=60), agency="Other Bus"), [])
+        trips = self.gtfs.get_route_trips("15", datetime.datetime.fromisoformat("2023-09-15T07:50:00"), datetime.timedelta(minutes=60), agency=trips[0]['agency'])
+        self.assertEqual([trip['trip_id'] for trip in trips], ["3582_6405"])
+        # the trip doesn't run on Sundays
+        self.assertEqual(self.gtfs.get_route_trips("15", datetime.datetime.fromisoformat("2023-09-17T07:50:00"), datetime.timedelta(minutes=60)), [])
+
+    def test_route_headways(self):
+        now = datetime.datetime.fromisoformat("2023-09-15T09:10:00")
+        headways = self.gtfs.get_route_headways("1358", now=now, max_wait=datetime.timedelta(minutes=60))
+        # routes are told apart by route_id, not just by name
+        self.assertIn("68", [route_headways['route'] for route_headways in headways.values()])
+        for route_id, route_headways in headways.items():
+            self.assertEqual(self.gtfs._route_name(route_id), route_headways['route'])
+        route_id = next(route_id for route_id, route_headways in headways.items() if route_headways['route'] == "68")
+        self.gtfs.store.set('route_ids', "68", [route_id])
+        self.assertEqual(list(self.gtfs.get_route_headways("1358", now, datetime.timedelta(minutes=60), route="68")), [route_id])
+        self.assertEqual(self.gtfs.get_route_headways("1358", now, datetime.timedelta(minutes=60), route="68", agency="Other Bus"), {})
+        for route_headways in headways.values():
+            if route_headways['arrivals'] > 1:
+                self.assertLessEqual(route_headways['min_headway'], route_headways['mean_headway'])
+                self.assertLessEqual(route_headways['mean_headway'], route_headways['max_headway'])
+            else:
+                self.assertIsNone(route_headways['mean_headway'])
+
     def test_scheduled_arrivals(self):
 
         scheduled_arrivals = self.gtfs.get_scheduled_arrivals(
@@ -149,8 +468,645 @@ class TestGTFS(unittest.TestCase):
         self.assertEqual(scheduled_arrivals[5]['scheduled_arrival'].isoformat(), "2023-09-15T09:24:16")
         self.assertIsNone(scheduled_arrivals[5]['real_time_arrival'])
 
+    def test_arrivals_in_window(self):
+        # A trip of the 15th's service that arrives after midnight, at 24:30:00
+        trip_id = self.gtfs._unpack_stop_data(self.gtfs.store.get('stop_times', '1358:9')[0])[0]
+        self.gtfs.store.set('trip', "N1", self.gtfs.store.get('trip', trip_id))
+        self.gtfs.store.set('stop_times', "9999:0", [self.gtfs._pack_stop_data("N1", 24, 30, 0, 5)])
+        arrivals = self.gtfs.get_arrivals_in_window(
+            "9999",
+            datetime.datetime.fromisoformat("2023-09-15T23:50:00"),
+            datetime.datetime.fromisoformat("2023-09-16T01:00:00"),
+        )
+        self.assertEqual([arrival['scheduled_arrival'].isoformat() for arrival in arrivals], ["2023-09-16T00:30:00"])
+        self.assertEqual(self.gtfs.get_arrivals_in_window(
+            "9999",
+            datetime.datetime.fromisoformat("2023-09-16T00:31:00"),
+            datetime.datetime.fromisoformat("2023-09-16T12:00:00"),
+        ), [])
+
+        # A window is exact, and spans as many hours as asked
+        start = datetime.datetime.fromisoformat("2023-09-15T09:10:00")
+        end = datetime.datetime.fromisoformat("2023-09-15T12:10:00")
+        arrivals = self.gtfs.get_arrivals_in_window("1358", start, end)
+        self.assertTrue(all((a['real_time_arrival'] or a['scheduled_arrival']) <= end for a in arrivals))
+        self.assertGreater(arrivals[-1]['scheduled_arrival'], datetime.datetime.fromisoformat("2023-09-15T11:30:00"))
+
+        # Live data is about today's runs of trips, so it isn't applied a week later
+        arrivals = self.gtfs.get_arrivals_in_window("1358", start + datetime.timedelta(days=7), end + datetime.timedelta(days=7))
+        self.assertTrue(len(arrivals))
+        self.assertTrue(all(arrival['real_time_arrival'] is None for arrival in arrivals))
+
+    def test_export_departures(self):
+        service_date = datetime.date(2023, 9, 15)
+        rows = list(self.gtfs.iter_departures(service_date))
+        self.assertTrue(len(rows))
+        self.assertTrue(all(row[0] == "1358" for row in rows))
+        self.assertEqual([row[3] for row in rows], sorted(row[3] for row in rows))
+        # the arrivals in an hour match those scheduled by the calendar
+        hour = [row for row in rows if "09:10:00" <= row[3] <= "10:10:00"]
+        scheduled = self.gtfs._scheduled_stop_times(
+            "1358", datetime.datetime(2023, 9, 15, 9, 10), datetime.datetime(2023, 9, 15, 10, 10)
+        )
+        self.assertEqual(sorted(row[8] for row in hour), sorted(trip_id for trip_id, _, _, _ in scheduled))
+        # shards partition the stops
+        self.assertEqual(sum(len(list(self.gtfs.iter_departures(service_date, shard, 3))) for shard in range(3)), len(rows))
+
+        path = "test_data/departures_test.ndjson"
+        try:
+            self.assertEqual(self.gtfs.export_departures(service_date, path, "ndjson"), len(rows))
+            with open(path) as f:
+                first = json.loads(f.readline())
+            self.assertEqual(list(first.keys()), gtfs.EXPORT_FIELDS)
+            self.assertEqual(first['trip_id'], rows[0][8])
+        finally:
+            os.remove(path)
+
+    def write_test_master(self):
+        # Write the test dataset as a master index, with another stop served by a trip of its own.
+        # Returns the trip_id of a trip serving stop 1358.
+        data = self.gtfs.store.data
+        trip_id = self.gtfs._unpack_stop_data(data['stop_times']['1358:9'][0])[0]
+        master = {namespace: dict(values) if isinstance(values, dict) else set(values)
+                  for namespace, values in data.items() if namespace not in gtfs.LIVE_NAMESPACES + ('status',)}
+        master['stop_times']['9999:9'] = [self.gtfs._pack_stop_data("X1", 9, 30, 0, 1)]
+        master['trip']['X1'] = data['trip'][trip_id]
+        master['route_trips'] = {"X": ["X1"]}
+        with open(gtfs.MASTER_FILE, "wb") as f:
+            for namespace in ['stop_times'] + [namespace for namespace in master if namespace != 'stop_times']:
+                gtfs._write_master_namespace(f, namespace, master[namespace])
+        return trip_id
+
+    def test_derive_from_master(self):
+        old_files = gtfs.MASTER_FILE, gtfs.CACHE_INFO_FILE, store.CACHE_FILE
+        gtfs.MASTER_FILE = Path("test_data/master_test.pickle")
+        gtfs.CACHE_INFO_FILE = Path("test_data/cache_info_test.txt")
+        store.CACHE_FILE = Path("test_data/derived_test.pickle")
+        data = self.gtfs.store.data
+        try:
+            trip_id = self.write_test_master()
+
+            derived = store.Store(load_cache=False)
+            filter_trips = self.gtfs._derive_from_master({"1358"}, derived)
+            self.assertIn(trip_id, filter_trips)
+            self.assertNotIn("X1", filter_trips)
+            self.assertEqual(derived.data['stop_times'], data['stop_times'])
+            self.assertEqual(derived.data['trip'], data['trip'])
+            self.assertEqual(derived.data['stop_numbers'], data['stop_numbers'])
+            self.assertNotIn('route_trips', derived.data)
+
+            # Changing the filter at runtime swaps in the new dataset and keeps live data
+            self.gtfs.set_filter_stops(None)
+            self.assertIsNone(self.gtfs.filter_trips)
+            self.assertEqual(self.gtfs.store.get('route_trips', "X"), ["X1"])
+            self.assertIsNotNone(self.gtfs.store.get('trip', "X1"))
+            self.assertEqual(self.gtfs.store.data['live_delays'], data['live_delays'])
+            self.assertTrue(gtfs.check_cache_info(None))
+            self.assertFalse(gtfs.check_cache_info(["1358"]))
+        finally:
+            for file in (gtfs.MASTER_FILE, gtfs.CACHE_INFO_FILE, store.CACHE_FILE):
+                if os.path.exists(file):
+                    os.remove(file)
+            gtfs.MASTER_FILE, gtfs.CACHE_INFO_FILE, store.CACHE_FILE = old_files
+
+    def test_stream_stop_times(self):
+        # stop times are parsed in batches and the sorted runs merged into the master index
+        old_settings = gtfs.MASTER_FILE, gtfs.STOP_TIMES_BATCH_ROWS, settings.DATA_DIR, self.gtfs.store
+        gtfs.MASTER_FILE = Path("test_data/master_test.pickle")
+        gtfs.STOP_TIMES_BATCH_ROWS = 2
+        settings.DATA_DIR = Path("test_data")
+        self.gtfs.store = store.Store(load_cache=False)
+        self.gtfs.store.set('stop', "S1", "1")
+        self.gtfs.store.set('stop', "S2", "2")
+        try:
+            with open(settings.DATA_DIR / "stop_times.txt", "w") as f:
+                f.write("trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+                        "T1,09:00:00,09:00:00,S1,1\n"
+                        "T2,09:10:00,09:10:00,S1,1\n"
+                        "T2,09:20:00,09:20:00,S2,2\n"
+                        "T1,09:05:00,09:05:00,S2,2\n"
+                        "T3,25:00:00,25:00:00,S1,1\n")
+            with open(gtfs.MASTER_FILE, "wb") as f:
+                self.gtfs._read_stop_times(f)
+            self.assertFalse(os.path.exists(f"{gtfs.MASTER_FILE}.runs"))
+            master = {}
+            for namespace, chunk in gtfs.read_master_index():
+                master.setdefault(namespace, {}).update(chunk)
+            self.assertEqual(list(master), ['stop_times', 'trip_stops'])
+            self.assertEqual([self.gtfs._unpack_stop_data(value)[0] for value in master['stop_times']['1:9']], ["T1", "T2"])
+            self.assertEqual(len(master['stop_times']['2:9']), 2)
+            self.assertEqual(len(master['stop_times']['1:1']), 1)
+            self.assertEqual(list(self.gtfs._unpack_trip_stops(master['trip_stops']['T1'])), [("1", 32400, 1), ("2", 32700, 2)])
+            self.assertEqual([stop[0] for stop in self.gtfs._unpack_trip_stops(master['trip_stops']['T2'])], ["1", "2"])
+        finally:
+            for file in (gtfs.MASTER_FILE, settings.DATA_DIR / "stop_times.txt"):
+                if os.path.exists(file):
+                    os.remove(file)
+            gtfs.MASTER_FILE, gtfs.STOP_TIMES_BATCH_ROWS, settings.DATA_DIR, self.gtfs.store = old_settings
+
+    def test_lazy_partitions(self):
+        import shutil
+        old_files = gtfs.MASTER_FILE, gtfs.PARTITIONS_DIR, store.CACHE_FILE
+        gtfs.MASTER_FILE = Path("test_data/master_test.pickle")
+        gtfs.PARTITIONS_DIR = Path("test_data/partitions_test")
+        # there is no cache to load
+        store.CACHE_FILE = Path("test_data/missing_test.pickle")
+        try:
+            trip_id = self.write_test_master()
+            # stops 1358 and 9999 are in different partitions, and only one fits the memory budget
+            engine = gtfs.GTFS(settings.GTFS_LIVE_URL, settings.API_KEY, partitions=4, partition_memory_mb=0)
+            self.assertEqual(engine.store.data.get('stop_times', {}), {})
+            self.assertTrue(engine.is_valid_stop_number("1358"))
+            engine._parse_live_data(self.live_data)
+
+            now = datetime.datetime.fromisoformat("2023-09-15T09:10:00")
+            window = datetime.timedelta(minutes=60)
+            self.assertEqual(engine.get_scheduled_arrivals("1358", now, window), self.gtfs.get_scheduled_arrivals("1358", now, window))
+            self.assertEqual(engine.partitions.stats()['loads'], 1)
+            self.assertEqual(len(engine.get_scheduled_arrivals("9999", now, window)), 1)
+            stats = engine.partitions.stats()
+            self.assertEqual((stats['loaded'], stats['loads'], stats['evictions']), (1, 2, 1))
+            self.assertNotIn("1358:9", engine.store.data['stop_times'])
+            self.assertIsNone(engine.store.get('trip', trip_id))
+            # trips looked up directly load their partition too
+            self.assertEqual(engine.get_trip_timeline(trip_id, now.date()), self.gtfs.get_trip_timeline(trip_id, now.date()))
+            self.assertFalse(os.path.exists(store.CACHE_FILE))
+
+            # a partition in use isn't dropped when another is loaded, even over the budget
+            with engine.partitions.pin_stop("1358"):
+                self.assertEqual(len(engine.get_scheduled_arrivals("9999", now, window)), 1)
+                self.assertIn("1358:9", engine.store.data['stop_times'])
+                self.assertEqual(engine.partitions.stats()['pinned'], 1)
+            self.assertEqual(engine.partitions.stats()['loaded'], 1)
+
+            # the trips of a route are read a partition at a time, loading each partition once
+            trip_ids = list(dict.fromkeys(self.gtfs._unpack_stop_data(value)[0] for value in self.gtfs.store.data['stop_times']['1358:9']))
+            engine.store.set('route_trips', "X", [trip_ids[0], "X1", trip_ids[1]])
+            engine.store.set('route_ids', "X", ["X"])
+            loads = engine.partitions.stats()['loads']
+            engine.get_route_trips("X", now, window)
+            # rather than three times, one per trip
+            self.assertEqual(engine.partitions.stats()['loads'], loads + 2)
+            self.assertEqual(engine.partitions.stats()['pinned'], 0)
+
+            # queries of stops in different partitions, one at a time in the budget, stay complete
+            import threading
+            expected = {stop_number: engine.get_scheduled_arrivals(stop_number, now, window) for stop_number in ("1358", "9999")}
+            failures = []
+            def query(stop_number):
+                for _ in range(20):
+                    if engine.get_scheduled_arrivals(stop_number, now, window) != expected[stop_number]:
+                        failures.append(stop_number)
+            threads = [threading.Thread(target=query, args=(stop_number,)) for stop_number in ("1358", "9999") * 3]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(failures, [])
+            self.assertEqual(engine.partitions.stats()['pinned'], 0)
+        finally:
+            if os.path.exists(gtfs.MASTER_FILE):
+                os.remove(gtfs.MASTER_FILE)
+            shutil.rmtree(gtfs.PARTITIONS_DIR, ignore_errors=True)
+            gtfs.MASTER_FILE, gtfs.PARTITIONS_DIR, store.CACHE_FILE = old_files
+
+    def test_vehicle_positions(self):
+        from google.transit import gtfs_realtime_pb2
+        now = datetime.datetime.fromisoformat("2023-09-15T09:10:00")
+        window = datetime.timedelta(minutes=60)
+        # 3582_11652 is due at stop 1358 (stop_sequence 45) at 09:24:16, and has no trip update
+        trip_id = "3582_11652"
+        self.assertNotIn(trip_id, self.gtfs.trip_update_trips)
+        self.gtfs.store.set('trip_stops', trip_id, self.gtfs._pack_trip_stop("1357", 9 * 3600 + 20 * 60, 44) + self.gtfs._pack_trip_stop("1358", 9 * 3600 + 24 * 60 + 16, 45))
+        before = self.gtfs.get_scheduled_arrivals("1358", now, window)
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = "2.0"
+        feed.header.timestamp = int(datetime.datetime(2023, 9, 15, 9, 23).timestamp())
+        # the vehicle is at the stop before, three minutes late
+        vehicle = feed.entity.add(id="V1").vehicle
+        vehicle.trip.trip_id = trip_id
+        vehicle.current_stop_sequence = 44
+        vehicle.current_status = gtfs_realtime_pb2.VehiclePosition.STOPPED_AT
+        # vehicles of trips with trip updates don't change their delays
+        feed.entity.add(id="V2").vehicle.trip.trip_id = "3582_11653"
+        delays = self.gtfs.store.get('live_delays', "3582_11653")
+        generation = self.gtfs.live_generation
+        self.gtfs.load_vehicle_positions(feed.SerializeToString())
+
+        self.assertGreater(self.gtfs.live_generation, generation)
+        self.assertEqual(self.gtfs.store.get('live_delays', "3582_11653"), delays)
+        self.assertIsNotNone(self.gtfs.store.get('live_vehicles', trip_id))
+        after = self.gtfs.get_scheduled_arrivals("1358", now, window)
+        self.assertEqual(len(after), len(before))
+        estimated = [arrival for arrival in after if arrival not in before]
+        self.assertEqual(len(estimated), 1)
+        self.assertEqual(estimated[0]['scheduled_arrival'], datetime.datetime(2023, 9, 15, 9, 24, 16))
+        self.assertEqual(estimated[0]['real_time_arrival'], datetime.datetime(2023, 9, 15, 9, 27, 16))
+
+        # a trip update loaded while the vehicles are being loaded takes precedence over their estimates
+        self.gtfs.store.delete('live_delays', trip_id)
+        vehicle_delay = self.gtfs._vehicle_delay
+        def trip_update_landing(trip_id, vehicle, timestamp):
+            self.gtfs.trip_update_trips.add(trip_id)
+            return vehicle_delay(trip_id, vehicle, timestamp)
+        self.gtfs._vehicle_delay = trip_update_landing
+        self.gtfs.trip_update_trips.discard(trip_id)
+        self.gtfs.load_vehicle_positions(feed.SerializeToString())
+        self.assertIsNone(self.gtfs.store.get('live_delays', trip_id))
+
+    def test_service_alerts(self):
+        from google.transit import gtfs_realtime_pb2
+        route_id = self.gtfs._unpack_trip(self.gtfs.store.get('trip', "3582_11652"))[0]
+        route_name = self.gtfs._route_name(route_id)
+        now = datetime.datetime.fromisoformat("2023-09-15T09:10:00")
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = "2.0"
+        alert = feed.entity.add(id="A1").alert
+        alert.informed_entity.add(stop_id="8220DB001358")
+        alert.effect = gtfs_realtime_pb2.Alert.DETOUR
+        alert.header_text.translation.add(text="Stop closed", language="en")
+        alert.active_period.add(start=int(now.timestamp()) - 60, end=int(now.timestamp()) + 3600)
+        alert = feed.entity.add(id="A2").alert
+        alert.informed_entity.add(route_id=route_id)
+        alert.header_text.translation.add(text="Diversion")
+        self.gtfs.load_service_alerts(feed.SerializeToString())
+
+        alerts = self.gtfs.get_alerts(stop_number="1358", now=now)
+        self.assertEqual([(alert['id'], alert['effect'], alert['header']) for alert in alerts], [("A1", "DETOUR", "Stop closed")])
+        self.assertEqual(self.gtfs.get_alerts(stop_number="1358", now=now + datetime.timedelta(hours=2)), [])
+        self.assertEqual([alert['header'] for alert in self.gtfs.get_alerts(route=route_name, now=now)], ["Diversion"])
+        # alerts that are no longer in the feed are dropped
+        del feed.entity[0]
+        self.gtfs.load_service_alerts(feed.SerializeToString())
+        self.assertEqual(self.gtfs.get_alerts(stop_number="1358"), [])
+        self.assertEqual(len(self.gtfs.get_alerts(stop_number="1358", route=route_name)), 1)
+
     def tearDown(self):
         store.CACHE_FILE = self.old_cache_file
 
+
+class TestBoards(unittest.TestCase):
+
+    def setUp(self):
+        skip_static_data_check(self)
+        self.old_cache_file = store.CACHE_FILE
+        store.CACHE_FILE = Path("test_data/cache.pickle")
+        self.gtfs = gtfs.GTFS(settings.GTFS_LIVE_URL, settings.API_KEY)
+        with open("test_data/test_live_response.gtfsr", 'rb') as f:
+            self.gtfs._parse_live_data(f.read())
+        self.now = datetime.datetime.fromisoformat("2023-09-15T09:10:00")
+        self.boards = boards.DepartureBoards({"8220DB001358": "1358"}, 30, datetime.timedelta(seconds=60))
+        self.boards.refresh(self.gtfs, self.now)
+
+    def expected_arrivals(self, now, minutes):
+        until = now + datetime.timedelta(minutes=minutes)
+        return [
+            render.format_arrival(arrival, "8220DB001358")
+            for arrival in self.gtfs.get_scheduled_arrivals("1358", now, datetime.timedelta(minutes=minutes))
+            if (arrival['real_time_arrival'] or arrival['scheduled_arrival']) <= until
+        ]
+
+    def test_board_arrivals(self):
+        board = self.boards.get("8220DB001358")
+        self.assertIsNotNone(board)
+        later = self.now + datetime.timedelta(seconds=50)
+        self.assertEqual(board.arrivals(later, 30), self.expected_arrivals(later, 30))
+        # the board only covers the polling period beyond its window
+        self.assertIsNone(board.arrivals(self.now + datetime.timedelta(minutes=2), 30))
+        self.assertIsNone(board.arrivals(self.now, 60))
+
+    def test_board_bodies(self):
+        board = self.boards.get("8220DB001358")
+        body = board.body("json", self.now, 30)
+        self.assertEqual(body, render.render("json", self.expected_arrivals(self.now, 30)))
+        self.assertIsNone(board.body("json", self.now, 20))
+        # once the first bus has come and gone, the pre-rendered body is stale
+        first = board.entries[0]
+        gone = max(first[0], first[1] or first[0])
+        self.assertIsNone(board.body("json", gone, 30))
+
+class TestRender(unittest.TestCase):
+
+    arrivals = [
+        {"route": "68", "destination": "Hawkins Street", "expected": "2023-09-15T09:13:38+01:00", "scheduled": "2023-09-15T09:15:50+01:00", "real_time": True, "agency": "Dublin Bus", "stop_id": "8220DB001358"},
+        {"route": "150", "destination": "Hawkins Street & <Co>", "expected": "2023-09-15T09:15:06+01:00", "scheduled": "2023-09-15T09:15:06+01:00", "real_time": False, "agency": "Dublin Bus", "stop_id": "8220DB001358"},
+    ]
+
+    def test_formats(self):
+        import json, csv, io, yaml
+        self.assertEqual(json.loads(render.render("json", self.arrivals)), {"arrivals": self.arrivals})
+        self.assertEqual(yaml.safe_load(render.render("yaml", self.arrivals)), {"arrivals": self.arrivals})
+        rows = list(csv.DictReader(io.StringIO(render.render("csv", self.arrivals).decode('utf-8'))))
+        self.assertEqual([row['route'] for row in rows], ["68", "150"])
+        self.assertEqual(render.render("text", self.arrivals), render.render("csv", self.arrivals))
+        self.assertIn(b"Hawkins Street &amp; &lt;Co&gt;", render.render("html", self.arrivals))
+
+    def test_negotiate(self):
+        from werkzeug.datastructures import MIMEAccept, Accept
+        self.assertEqual(render.negotiate(MIMEAccept([("text/html", 1), ("*/*", 0.8)])), "html")
+        self.assertEqual(render.negotiate(MIMEAccept([("*/*", 1)])), "json")
+        self.assertEqual(render.negotiate(MIMEAccept([])), "json")
+        self.assertEqual(render.negotiate_encoding(Accept([("gzip", 1)])), "gzip")
+        self.assertIsNone(render.negotiate_encoding(Accept([])))
+
+    def test_encoded_cache(self):
+        import gzip
+        encoded = render.Encoded(render.render("json", self.arrivals * 10), render.MIMETYPES["json"])
+        body, etag, encoding = encoded.encode("gzip")
+        self.assertEqual(encoding, "gzip")
+        self.assertEqual(gzip.decompress(body), encoded.body)
+        self.assertNotEqual(etag, encoded.encode(None)[1])
+        # small bodies are sent uncompressed
+        self.assertIsNone(render.Encoded(b"{}", render.MIMETYPES["json"]).encode("gzip")[2])
+
+        cache = render.ResponseCache(maxsize=2)
+        cache.put("a", encoded)
+        cache.put("b", encoded)
+        cache.get("a")
+        cache.put("c", encoded)
+        self.assertIsNone(cache.get("b"))
+        self.assertIs(cache.get("a"), encoded)
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        skip_static_data_check(self)
+        self.directory = "test_data/archive_test"
+        with open("test_data/test_live_response.gtfsr", 'rb') as f:
+            self.live_data = f.read()
+
+    def test_record(self):
+        recorder = archive.Recorder(self.directory, retention=datetime.timedelta(days=1))
+        path = recorder.record(self.live_data)
+        self.assertTrue(path.endswith("1694765519.pb.gz"))
+        # the same feed isn't recorded twice
+        self.assertIsNone(recorder.record(self.live_data))
+        # recordings older than the retention period are dropped
+        recorder.record(self.live_data, 1694765519 + 3600)
+        recorder.record(self.live_data, 1694765519 + 2 * 86400)
+        recordings = [timestamp for timestamp, _ in archive.iter_recordings(self.directory)]
+        self.assertEqual(recordings, [1694765519 + 2 * 86400])
+        self.assertEqual(list(archive.iter_feeds(self.directory)), [(1694765519 + 2 * 86400, self.live_data)])
+
+    def test_replay(self):
+        old_cache_file = store.CACHE_FILE
+        store.CACHE_FILE = Path("test_data/cache.pickle")
+        try:
+            engine = gtfs.GTFS(settings.GTFS_LIVE_URL, settings.API_KEY)
+        finally:
+            store.CACHE_FILE = old_cache_file
+        feeds = [(1694765519, self.live_data), (1694765519 + 60, self.live_data)]
+        stats = archive.replay(engine, feeds, speed=0, queries_per_second=0, stops=["1358"], threads=1)
+        self.assertEqual(stats['feeds'], 2)
+        self.assertEqual(stats['replayed_seconds'], 60)
+        self.assertEqual(engine.live_generation, 2)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_coalescing(self):
+        import threading
+        flights = singleflight.SingleFlight(timeout=5)
+        release = threading.Event()
+        calls = []
+        def compute():
+            calls.append(1)
+            release.wait()
+            return ["arrival"]
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flights.do("1358", compute))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while flights.stats()['in_flight'] == 0:
+            release.wait(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        # callers that arrived while the first was computing shared its result
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(result == ["arrival"] for result in results))
+        stats = flights.stats()
+        self.assertEqual(len(calls), stats['totals']['computed'])
+        self.assertEqual(stats['totals']['computed'] + stats['totals'].get('shared', 0), 5)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_errors_and_timeouts(self):
+        import threading
+        flights = singleflight.SingleFlight(timeout=0.01)
+        with self.assertRaises(ValueError):
+            flights.do("a", int, "x")
+        self.assertEqual(flights.stats()['totals']['errors'], 1)
+        # a waiter that times out computes its own result
+        release = threading.Event()
+        leader = threading.Thread(target=flights.do, args=("b", release.wait))
+        leader.start()
+        while flights.stats()['in_flight'] == 0:
+            release.wait(0.001)
+        self.assertEqual(flights.do("b", lambda: "own"), "own")
+        release.set()
+        leader.join()
+        self.assertEqual(flights.stats()['totals']['timed_out'], 1)
+
+class TestProxy(unittest.TestCase):
+
+    class FakeSession:
+        # answers GETs with the queued (status, json) responses, or raises if the queue holds an exception
+        def __init__(self):
+            self.responses = []
+            self.calls = 0
+
+        def get(self, url, params=None, headers=None, timeout=None):
+            import requests
+            self.calls += 1
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            r = requests.Response()
+            r.status_code = response[0]
+            # bytes are sent as they are, anything else as JSON
+            r._content = response[1] if isinstance(response[1], bytes) else json.dumps(response[1]).encode("utf-8")
+            r.headers["Content-Type"] = "application/json"
+            return r
+
+    def test_cache_stale_and_breaker(self):
+        import time
+        import requests
+        session = self.FakeSession()
+        upstream = proxy.Upstream("http://core", "key", ttl=0.05, stale_ttl=10, failure_threshold=2, reset_timeout=0.05, session=session)
+        params = {"stop": "1358", "minutes": 30}
+        session.responses.append((200, {"arrivals": [1]}))
+        self.assertEqual(upstream.get("/api/v1/arrivals", params), ({"arrivals": [1]}, {'stale': False, 'age': 0}))
+        # served from the cache until the ttl passes
+        self.assertEqual(upstream.get("/api/v1/arrivals", params)[0], {"arrivals": [1]})
+        self.assertEqual(session.calls, 1)
+
+        # when the upstream fails, the last response is served as stale
+        time.sleep(0.06)
+        session.responses += [requests.ConnectionError("down"), (503, {})]
+        data, status = upstream.get("/api/v1/arrivals", params)
+        self.assertEqual(data, {"arrivals": [1]})
+        self.assertTrue(status['stale'])
+        self.assertEqual(upstream.get("/api/v1/arrivals", {"stop": "7581", "minutes": 30})[0], None)
+        # two failures open the breaker, so the upstream isn't called until it resets
+        self.assertEqual(upstream.breaker.state, "open")
+        self.assertIsNone(upstream.get("/api/v1/stops", {})[0])
+        self.assertEqual(session.calls, 3)
+        time.sleep(0.06)
+        session.responses.append((200, {"arrivals": [2]}))
+        self.assertEqual(upstream.get("/api/v1/arrivals", params)[0], {"arrivals": [2]})
+        self.assertEqual(upstream.breaker.state, "closed")
+        # errors in the request don't count against the upstream
+        session.responses += [(400, {}), (400, {})]
+        upstream.get("/api/v1/arrivals", {"stop": ""})
+        upstream.get("/api/v1/arrivals", {"stop": ""})
+        self.assertEqual(upstream.breaker.state, "closed")
+
+    def test_rejected_and_invalid(self):
+        session = self.FakeSession()
+        upstream = proxy.Upstream("http://core", "key", ttl=0, stale_ttl=10, failure_threshold=1, session=session)
+        params = {"stop": "1358"}
+        session.responses.append((200, {"arrivals": [1]}))
+        upstream.get("/api/v1/arrivals", params)
+        # the upstream's refusal of a request is passed on, rather than serving stale data
+        session.responses.append((400, {"error": "bad request"}))
+        data, status = upstream.get("/api/v1/arrivals", params)
+        self.assertIsNone(data)
+        self.assertFalse(status['stale'])
+        self.assertEqual(status['rejected'].status_code, 400)
+        self.assertEqual(json.loads(status['rejected'].body), {"error": "bad request"})
+        self.assertEqual(upstream.breaker.state, "closed")
+        # a response that isn't JSON is a failure of the upstream
+        session.responses.append((200, b"<html>"))
+        data, status = upstream.get("/api/v1/arrivals", params)
+        self.assertEqual(data, {"arrivals": [1]})
+        self.assertTrue(status['stale'])
+        self.assertNotIn('rejected', status)
+        self.assertEqual(upstream.breaker.state, "open")
+
+class TestRepublish(unittest.TestCase):
+
+    def setUp(self):
+        with open("test_data/test_live_response.gtfsr", 'rb') as f:
+            self.live_data = f.read()
+
+    def test_filtered_feed(self):
+        from google.transit import gtfs_realtime_pb2
+        snapshot = republish.FeedSnapshot(self.live_data, 1, stop_number=lambda stop_id: {"8220DB001358": "1358"}.get(stop_id))
+        # the whole feed is copied unchanged
+        self.assertEqual(snapshot.encode(snapshot.entities()), self.live_data)
+        feed = gtfs_realtime_pb2.FeedMessage.FromString(snapshot.encode(snapshot.select({('stop', "1358")})))
+        self.assertGreater(len(feed.entity), 0)
+        for entity in feed.entity:
+            self.assertIn("8220DB001358", [update.stop_id for update in entity.trip_update.stop_time_update])
+        trip_id = feed.entity[0].trip_update.trip.trip_id
+        self.assertEqual(republish.to_json(snapshot.encode(snapshot.select({('trip', trip_id)})))['entity'][0]['tripUpdate']['trip']['tripId'], trip_id)
+
+    def test_differential_feed(self):
+        from google.transit import gtfs_realtime_pb2
+        republisher = republish.Republisher()
+        self.assertEqual(republisher.feed(), (None, None))
+        republisher.publish(republish.FeedSnapshot(self.live_data, 1))
+        # the next feed drops all but ten entities, and changes one of those
+        message = gtfs_realtime_pb2.FeedMessage.FromString(self.live_data)
+        del message.entity[10:]
+        message.entity[0].trip_update.stop_time_update[0].arrival.delay += 60
+        republisher.publish(republish.FeedSnapshot(message.SerializeToString(), 2))
+
+        snapshot, buf = republisher.feed(since=1)
+        self.assertEqual(snapshot.generation, 2)
+        feed = gtfs_realtime_pb2.FeedMessage.FromString(buf)
+        self.assertEqual(feed.header.incrementality, gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL)
+        self.assertEqual([entity.id for entity in feed.entity if not entity.is_deleted], [message.entity[0].id])
+        self.assertEqual(sum(entity.is_deleted for entity in feed.entity), len(list(gtfsr.iter_entities(self.live_data))) - 10)
+        # filtered to one trip, only that trip's changes are sent
+        references = {('trip', message.entity[1].trip_update.trip.trip_id)}
+        self.assertEqual(len(gtfs_realtime_pb2.FeedMessage.FromString(republisher.feed(references, since=1)[1]).entity), 0)
+        # nothing has changed since the latest feed, and unknown generations get the full feed
+        self.assertEqual(len(gtfs_realtime_pb2.FeedMessage.FromString(republisher.feed(since=2)[1]).entity), 0)
+        self.assertEqual(len(gtfs_realtime_pb2.FeedMessage.FromString(republisher.feed(since=0)[1]).entity), 10)
+
+class TestTracing(unittest.TestCase):
+
+    class Engine:
+        def query(self, n):
+            return sum(self.lookup(i) for i in self.times(n))
+
+        def times(self, n):
+            yield from range(n)
+
+        def lookup(self, i):
+            return i
+
+    def test_spans(self):
+        engine = self.Engine()
+        tracing.instrument(engine, ('query', 'times', 'lookup'), prefix='engine')
+        # instrumented methods work as before when no trace is active
+        self.assertEqual(engine.query(4), 6)
+        trace = tracing.start("query")
+        self.assertEqual(engine.query(4), 6)
+        self.assertIs(tracing.stop(), trace)
+        self.assertIsNone(tracing.current())
+        spans = {span['name']: span for span in trace.to_dict()['spans']}
+        self.assertEqual(spans['engine.query']['calls'], 1)
+        self.assertEqual(spans['engine.lookup']['calls'], 4)
+        # each step of the generator, and the final one, is timed
+        self.assertEqual(spans['engine.times']['calls'], 5)
+        self.assertLessEqual(spans['engine.query']['self_ms'], spans['engine.query']['total_ms'])
+        self.assertGreaterEqual(trace.total, sum(span[2] for span in trace.spans.values()))
+        self.assertIn("engine.lookup;dur=", trace.server_timing())
+        recorder = tracing.Recorder(maxlen=1)
+        recorder.record(tracing.Trace("older"))
+        recorder.record(trace)
+        self.assertEqual([trace['name'] for trace in recorder.to_list()], ["query"])
+
+    def test_profile(self):
+        import threading
+        stop = threading.Event()
+        def busy_worker():
+            while not stop.is_set():
+                sum(range(1000))
+        thread = threading.Thread(target=busy_worker, name="busy worker")
+        thread.start()
+        try:
+            stacks = tracing.profile(0.2, interval=0.01)
+        finally:
+            stop.set()
+            thread.join()
+        lines = stacks.splitlines()
+        self.assertTrue(any(line.startswith("busy_worker;") and "test:busy_worker" in line for line in lines))
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertGreater(int(count), 0)
+
+class TestIngest(unittest.TestCase):
+
+    def test_poller(self):
+        path = Path("test_data/test_live_response.gtfsr").resolve()
+        loaded, updated = [], []
+        feed = ingest.Feed("trip_updates", path.as_uri(), 10, loaded.append)
+        poller = ingest.Poller(feed, "key", on_update=updated.append)
+        self.assertEqual(poller.poll(), 10)
+        self.assertEqual(loaded, [path.read_bytes()])
+        self.assertEqual(updated, [feed])
+
+        # failures back off exponentially, up to a limit
+        feed.url = path.with_name("missing.gtfsr").as_uri()
+        self.assertEqual([poller.poll() for _ in range(7)], [20, 40, 80, 160, 320, 320, 320])
+        # responses over the byte budget aren't loaded
+        feed.url, feed.max_bytes = path.as_uri(), 1000
+        self.assertEqual(poller.poll(), 320)
+        stats = poller.stats()
+        self.assertEqual((stats['polls'], stats['failures'], stats['oversized']), (9, 8, 1))
+        self.assertEqual(len(loaded), 1)
+        # a handler failing doesn't stop the feed being polled
+        feed.max_bytes, feed.handler = None, lambda buf: 1 / 0
+        self.assertEqual(poller.poll(), 320)
+        feed.handler = loaded.append
+        self.assertEqual(poller.poll(), 10)
+        self.assertEqual(len(updated), 2)
+
 if __name__ == '__main__':
     unittest.main()
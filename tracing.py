@@ -0,0 +1,201 @@
+# Opt-in instrumentation of the query path and the live feed parse, and a sampling profiler.
+#
+# Nothing here is wired in unless tracing is turned on: instrument() swaps the methods it is given for
+# timing wrappers, so the code paths of an uninstrumented server are unchanged. While a trace is active
+# in a thread, each call to an instrumented method adds to a span of the same name: how many calls
+# there were, their total time, and their self time (excluding instrumented calls made within them).
+# Calls made while no trace is active only pay for a check of the current thread's trace.
+#
+# The profiler samples the stacks of every other thread at an interval for a number of seconds, and
+# returns them in the "collapsed" format read by flamegraph.pl, speedscope and similar tools:
+#
+#   thread;module:function;module:function... <number of samples>
+import os
+import sys
+import time
+import inspect
+import threading
+import functools
+import collections
+from datetime import datetime
+
+_local = threading.local()
+
+
+class Trace:
+    """
+    The spans of one request or live feed parse.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.started = datetime.now()
+        self.start = time.perf_counter()
+        self.total = None
+        # span name -> [calls, total seconds, self seconds]
+        self.spans = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        # seconds spent in instrumented calls, for each call in progress
+        self.child_time = []
+
+    def finish(self):
+        self.total = time.perf_counter() - self.start
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'started': self.started.isoformat(),
+            'total_ms': round(self.total * 1000, 3) if self.total is not None else None,
+            'spans': [
+                {'name': name, 'calls': calls, 'total_ms': round(total * 1000, 3), 'self_ms': round(self_time * 1000, 3)}
+                for name, (calls, total, self_time) in sorted(self.spans.items(), key=lambda item: -item[1][2])
+            ],
+        }
+
+    def server_timing(self) -> str:
+        # a Server-Timing header value, of the self time of each span
+        timings = [f"{name};dur={self_time * 1000:.3f}" for name, (_, _, self_time) in self.spans.items()]
+        if self.total is not None:
+            timings.append(f"total;dur={self.total * 1000:.3f}")
+        return ", ".join(timings)
+
+
+def current():
+    return getattr(_local, 'trace', None)
+
+
+def start(name: str) -> Trace:
+    # start tracing the calls made in this thread
+    _local.trace = Trace(name)
+    return _local.trace
+
+
+def stop():
+    # stop tracing this thread, returning its trace
+    trace = current()
+    _local.trace = None
+    if trace is not None:
+        trace.finish()
+    return trace
+
+
+def _enter(trace):
+    trace.child_time.append(0.0)
+    return time.perf_counter()
+
+
+def _exit(trace, name, started):
+    elapsed = time.perf_counter() - started
+    child_time = trace.child_time.pop()
+    span = trace.spans[name]
+    span[0] += 1
+    span[1] += elapsed
+    span[2] += elapsed - child_time
+    if trace.child_time:
+        trace.child_time[-1] += elapsed
+
+
+def _wrap(fn, name):
+    if inspect.isgeneratorfunction(fn):
+        # time each step of a generator, rather than only its creation
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            iterator = fn(*args, **kwargs)
+            while True:
+                trace = current()
+                if trace is None:
+                    try:
+                        value = next(iterator)
+                    except StopIteration:
+                        return
+                else:
+                    started = _enter(trace)
+                    try:
+                        value = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        _exit(trace, name, started)
+                yield value
+        return wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        trace = current()
+        if trace is None:
+            return fn(*args, **kwargs)
+        started = _enter(trace)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _exit(trace, name, started)
+    return wrapper
+
+
+def instrument(target, names, prefix: str = None):
+    """
+    Replace the named methods of an object (or functions of a module) with wrappers adding to spans
+    named "<prefix>.<name>". prefix defaults to the name of the object's class or module.
+    """
+    if prefix is None:
+        prefix = target.__name__ if inspect.ismodule(target) else type(target).__name__
+    for name in names:
+        fn = getattr(target, name)
+        if getattr(fn, '__traced__', False):
+            continue
+        wrapper = _wrap(fn, f"{prefix}.{name}")
+        wrapper.__traced__ = True
+        setattr(target, name, wrapper)
+
+
+class Recorder:
+    """
+    Keeps the last `maxlen` finished traces.
+    """
+    def __init__(self, maxlen: int = 100):
+        self.traces = collections.deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+
+    def record(self, trace: Trace):
+        with self.lock:
+            self.traces.append(trace)
+
+    def to_list(self) -> list:
+        # the recorded traces, newest first
+        with self.lock:
+            return [trace.to_dict() for trace in reversed(self.traces)]
+
+
+# only one profile may be taken at a time
+_profiling = threading.Lock()
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.splitext(os.path.basename(code.co_filename))[0]}:{code.co_name}"
+
+
+def profile(seconds: float, interval: float = 0.005) -> str:
+    """
+    Sample the stacks of the other threads every `interval` seconds for `seconds`, and return them in
+    the collapsed stack format. Returns None if another profile is being taken.
+    """
+    if not _profiling.acquire(blocking=False):
+        return None
+    try:
+        this_thread = threading.get_ident()
+        stacks = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == this_thread:
+                    continue
+                names = []
+                while frame is not None:
+                    names.append(_frame_name(frame))
+                    frame = frame.f_back
+                names.append(thread_names.get(thread_id, str(thread_id)).replace(" ", "_"))
+                stacks[";".join(reversed(names))] += 1
+            time.sleep(interval)
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+    finally:
+        _profiling.release()